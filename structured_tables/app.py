@@ -1,11 +1,22 @@
-""" Flask application to parse STF Files
+""" Bottle application to parse STF Files
+
+POST a CSV file, or a JSON list of rows, to /v1/parse. Results are cached in the result cache of
+structured_tables.service. With a Redis host configured, declare documents and results are shared
+with the other instances that use the same Redis server.
+
+The WSGI application is the module's 'application', which serves metrics in the Prometheus text format
+at /metrics. See structured_tables.metrics.
+
+Posted documents may only Declare or Include local files in the directory set in the app's
+'structured_tables.base_dir' config value, the --base-dir option.
 """
 
 from six import string_types
-from bottle import error, hook, get, request, response  # , redirect, put, post
-from bottle import HTTPResponse, install  # , static_file, url
+from bottle import error, hook, get, post, request, response  # , redirect, put
+from bottle import HTTPResponse, install, default_app  # , static_file, url
 from bottle import run  # , debug  # @UnresolvedImport
 from decorator import decorator  # @UnresolvedImport
+from structured_tables.metrics import MetricsMiddleware, record_errors
 import logging
 import string
 
@@ -25,7 +36,7 @@ class NotAuthorized(Exception):
 
 
 class TooManyRequests(Exception):
-    pass
+    code = 429
 
 
 def capture_return_exception(e):
@@ -52,6 +63,7 @@ def _CaptureException(f, *args, **kwargs):
     except HTTPResponse:
         raise  # redirect() uses exceptions
     except Exception as e:
+        record_errors([e])
         r = capture_return_exception(e)
         if hasattr(e, 'code'):
             response.status = e.code
@@ -70,7 +82,7 @@ class AllJSONPlugin(object):
     """A copy of the bottle JSONPlugin, but this one tries to convert all
     objects to json."""
 
-    from json import dumps as json_dumps
+    from structured_tables.serialize import dumps as json_dumps
 
     name = 'json'
     remote = 2
@@ -110,6 +122,100 @@ class AllJSONPlugin(object):
 install(AllJSONPlugin())
 
 
+class RateLimitPlugin(object):
+    """Reject requests with a 429 response when the client has exceeded the rate limit for the tier of its
+    access key, or when too many requests are already being handled. The access key is taken from the
+    X-Access-Key header or the access_key query parameter. Clients without a registered or authoritative
+    key are limited by address. """
+
+    name = 'ratelimit'
+    api = 2
+
+    def __init__(self, limiter, admission, keys, trusted_proxies=0):
+        """
+
+        :param limiter: A structured_tables.limits.RateLimiter
+        :param admission: A structured_tables.limits.AdmissionControl
+        :param keys: Dict with the registered_key and authoritative_key
+        :param trusted_proxies: Number of reverse proxies in front of the server, whose X-Forwarded-For
+        addresses are trusted
+        """
+
+        self.limiter = limiter
+        self.admission = admission
+        self.keys = keys
+        self.trusted_proxies = trusted_proxies
+
+    def client_address(self):
+        """Return the address of the client. Clients can send any X-Forwarded-For header, so it is only used
+        behind trusted proxies, and only the address added by the outermost one is used. """
+
+        addr = request.environ.get('REMOTE_ADDR')
+
+        if self.trusted_proxies:
+            forwarded = [a.strip() for a in request.environ.get('HTTP_X_FORWARDED_FOR', '').split(',') if a.strip()]
+
+            if forwarded:
+                addr = forwarded[-min(self.trusted_proxies, len(forwarded))]
+
+        return addr
+
+    @staticmethod
+    def too_many(message, retry_after):
+        import json
+        import math
+
+        record_errors([TooManyRequests(message)])
+
+        return HTTPResponse(json.dumps({'exception': {'class': TooManyRequests.__name__, 'args': [message]}}),
+                            status=429, headers={'Retry-After': str(int(math.ceil(retry_after))),
+                                                 'Content-Type': 'application/json'})
+
+    def apply(self, callback, route):
+        from structured_tables.limits import key_tier, UNREGISTERED
+
+        def wrapper(*a, **ka):
+
+            access_key = request.headers.get('X-Access-Key') or request.query.get('access_key')
+            tier = key_tier(access_key, self.keys)
+            client = self.client_address() if tier == UNREGISTERED else access_key
+
+            wait = self.limiter.acquire('{}:{}'.format(tier, client), tier)
+
+            if wait:
+                raise self.too_many('Rate limit exceeded for {} access'.format(tier), wait)
+
+            if not self.admission.acquire():
+                raise self.too_many('Server is busy', 1)
+
+            try:
+                return callback(*a, **ka)
+            finally:
+                self.admission.release()
+
+        return wrapper
+
+
+def install_limits(keys, redis_client=None, max_in_flight=None, max_queued=None, trusted_proxies=0):
+    """Install the RateLimitPlugin. With a Redis client, the rate limits apply across all of the servers
+    that use it. Returns the plugin"""
+    from structured_tables.limits import RateLimiter, RedisRateLimiter, AdmissionControl
+    from structured_tables.limits import DEFAULT_MAX_IN_FLIGHT, DEFAULT_MAX_QUEUED
+
+    from structured_tables.metrics import registry, CallbackMetric
+
+    limiter = RedisRateLimiter(redis_client) if redis_client is not None else RateLimiter()
+    admission = AdmissionControl(max_in_flight or DEFAULT_MAX_IN_FLIGHT, max_queued or DEFAULT_MAX_QUEUED)
+
+    registry.register(CallbackMetric('structured_tables_requests_queued', 'Requests waiting to be handled',
+                                     lambda: admission.queued))
+    registry.register(CallbackMetric('structured_tables_requests_rejected_total',
+                                     'Requests rejected because too many were in flight or queued',
+                                     lambda: admission.rejected, 'counter'))
+
+    return install(RateLimitPlugin(limiter, admission, keys, trusted_proxies))
+
+
 
 @error(404)
 @CaptureException
@@ -132,12 +238,73 @@ def get_root():
     return ['Nothing Here']
 
 
-def _run(host, port, reloader=False, **kwargs):
+def etag_matches(etag, header):
+    """Return True if an If-None-Match header, a comma separated list of quoted ETags, or '*', has etag. Weak
+    tags don't match, as with werkzeug's ETags.contains() in the Flask server"""
+
+    quoted = '"{}"'.format(etag)
+
+    return any(tag.strip() in ('*', quoted) for tag in header.split(','))
+
+
+@post('/v1/parse')
+def post_parse():
+    from structured_tables.service import parse_cached, BadDocument, CONTENT_TYPES
+
+    content_type = request.content_type.split(';')[0].strip()
+
+    if content_type not in CONTENT_TYPES:
+        response.status = 415
+        return {'result': None, 'errors': [{'error': 'Unsupported media type: {}'.format(content_type)}]}
+
+    try:
+        etag, data = parse_cached(request.body.read(), content_type,
+                                  base_dir=request.app.config.get('structured_tables.base_dir') or False)
+    except BadDocument as e:
+        record_errors([e])
+        response.status = 400
+        return {'result': None, 'errors': [{'error': str(e)}]}
+
+    if etag is not None:
+        if etag_matches(etag, request.headers.get('If-None-Match', '')):
+            return HTTPResponse(status=304, ETag='"{}"'.format(etag))
+
+        response.set_header('ETag', '"{}"'.format(etag))
 
+    response.content_type = 'application/json'
+    return data
 
-    logging.info('Listening on {} {}'.format(host, port))
 
-    return run(host=host, port=port, reloader=reloader, server='paste')
+application = MetricsMiddleware(default_app())
+
+
+def configure_redis(host, port=6379, **kwargs):
+    """Share declare documents and parse results with other instances, through a Redis server. Returns
+    the Redis client"""
+    from structured_tables.cache import RedisCache, redis_client, configure_shared_cache
+
+    logging.info('Sharing caches through Redis at {}:{}'.format(host, port))
+
+    client = redis_client(host, port)
+
+    configure_shared_cache(RedisCache(client))
+
+    return client
+
+
+def _run(host, port, reloader=False, server='paste', redis=None, max_in_flight=None, max_queued=None,
+         base_dir=None, trusted_proxies=0, **kwargs):
+
+    client = configure_redis(**redis) if redis and redis.get('host') else None
+
+    if base_dir:
+        default_app().config['structured_tables.base_dir'] = base_dir
+
+    install_limits(kwargs, client, max_in_flight, max_queued, trusted_proxies)
+
+    logging.info('Listening on {} {} with {}'.format(host, port, server))
+
+    return run(application, host=host, port=port, reloader=reloader, server=server)
 
 
 if __name__ == '__main__':
@@ -159,6 +326,7 @@ if __name__ == '__main__':
         'reloader': False,
         'host': numbers_host,
         'port': 80,
+        'server': os.getenv('BOTTLE_SERVER', 'paste'),
         'redis': {
             'host': docker_host,
             'port': docker_port
@@ -175,9 +343,21 @@ if __name__ == '__main__':
     parser.add_argument('-H', '--server-host', default=None, help="Server host. ")
 
     parser.add_argument('-p', '--server-port', default=None, help="Server port.")
+    parser.add_argument('-s', '--server', default=None,
+                        help="Bottle server adapter, such as paste, gunicorn, waitress or cherrypy. Default: paste")
     parser.add_argument('-R', '--redis-host', default=docker_host, help="Redis host.")
     parser.add_argument('-r', '--redis-port', default=docker_port, help="Redis port.")
     parser.add_argument('-d', '--debug', default=False, action='store_true')
+    parser.add_argument('-i', '--max-in-flight', default=None, type=int,
+                        help="Number of requests to handle at once. Default: 16")
+    parser.add_argument('-q', '--max-queued', default=None, type=int,
+                        help="Number of requests that can wait to be handled before more are rejected. Default: 32")
+    parser.add_argument('-b', '--base-dir', default=None,
+                        help="Directory of the local Declare and Include documents that posted documents may "
+                             "reference. Without it, they may only reference URLs")
+    parser.add_argument('-x', '--trusted-proxies', default=0, type=int,
+                        help="Number of reverse proxies in front of the server, whose X-Forwarded-For addresses "
+                             "are used to rate limit clients. Default: 0")
     parser.add_argument('-u', '--unregistered-key', default=None, help="access_key value for unregistered access")
     parser.add_argument('-g', '--registered-key', default=None, help="access_key value for registered access")
     parser.add_argument('-a', '--authoritative-key', default=None, help="access_key value for authoritative access")
@@ -194,6 +374,9 @@ if __name__ == '__main__':
     if args.server_host:
         d['host'] = args.server_host
 
+    if args.server:
+        d['server'] = args.server
+
     if args.redis_port:
         d['redis']['port'] = args.redis_port
 
@@ -218,5 +401,10 @@ if __name__ == '__main__':
     if args.debug:
         d['reloader'] = args.debug
 
+    d['base_dir'] = args.base_dir
+    d['trusted_proxies'] = args.trusted_proxies
+    d['max_in_flight'] = args.max_in_flight
+    d['max_queued'] = args.max_queued
+
     _run(**d)
 
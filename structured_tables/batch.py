@@ -0,0 +1,114 @@
+# Copyright (c) 2016 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Parse many files at once, across a pool of processes. Declarations can be compiled once,
+in the parent process, and shared with all of the workers as a bundle.
+
+"""
+
+_worker_bundle = None  # Declaration bundle for the files parsed in a worker process
+
+
+def _init_worker(bundle):
+    global _worker_bundle
+    _worker_bundle = bundle
+
+
+def parse_file(ref, bundle=None):
+    """Parse a single file, returning a dict with the path, the result of as_dict(), and
+    the output of errors_as_dict(). Errors that stop the parse, such as a missing file, are
+    returned in the errors list, with a result of None, as are unexpected errors, such as a malformed CSV
+    file or a bad encoding, so one file can't stop a batch
+
+    :param ref: Path or URL of the file
+    :param bundle: Optional declaration bundle, or path to one
+    """
+    from .parser import TermGenerator, TermInterpreter, CsvPathRowGenerator, ParserError
+
+    try:
+        ti = TermInterpreter(TermGenerator(CsvPathRowGenerator(ref)), bundle=bundle)
+        result = ti.as_dict()
+        errors = ti.errors_as_dict()
+    except ParserError as e:
+        result = None
+        errors = [{'file': ref, 'row': None, 'col': None, 'term': None, 'error': str(e)}]
+    except Exception as e:
+        result = None
+        errors = [{'file': ref, 'row': None, 'col': None, 'term': None,
+                   'error': '{}: {}'.format(type(e).__name__, e)}]
+
+    return {'path': ref, 'result': result, 'errors': errors}
+
+
+def _parse_indexed(arg):
+    i, ref = arg
+
+    r = parse_file(ref, _worker_bundle)
+    r['index'] = i
+
+    return r
+
+
+def _make_bundle(declare):
+    from .bundle import compile_bundle, load_bundle
+
+    if declare is None or isinstance(declare, dict):
+        return declare
+    elif isinstance(declare, (list, tuple)):
+        return compile_bundle(declare)
+    else:
+        return load_bundle(declare)
+
+
+def iparse_files(refs, declare=None, processes=None, ordered=True, chunksize=1):
+    """Parse files in a pool of processes, generating a result dict, as returned by parse_file(), for each.
+    Each result also has an 'index' key, with the position of the file in refs.
+
+    :param refs: Paths or URLs of the files to parse
+    :param declare: Declarations to share with the workers: a bundle, the path to a bundle file, or a list of
+    Declare documents to compile into a bundle. Without it, each worker parses each Declare document once.
+    :param processes: Number of worker processes. Defaults to the number of CPUs. With 1, files are
+    parsed in this process.
+    :param ordered: If True, generate results in the order of refs. Otherwise, generate them as they
+    are completed.
+    :param chunksize: Number of files sent to a worker at a time.
+    """
+    from multiprocessing import Pool
+    from .fetch import get_fetcher
+
+    bundle = _make_bundle(declare)
+
+    tasks = list(enumerate(refs))
+
+    if processes == 1:
+        _init_worker(bundle)
+        for task in tasks:
+            yield _parse_indexed(task)
+        return
+
+    # Compiling the bundle may have fetched Declare documents; don't leave the connections for the workers
+    get_fetcher().close_idle()
+
+    pool = Pool(processes, _init_worker, (bundle,))
+
+    try:
+        if ordered:
+            results = pool.imap(_parse_indexed, tasks, chunksize)
+        else:
+            results = pool.imap_unordered(_parse_indexed, tasks, chunksize)
+
+        for r in results:
+            yield r
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def parse_files(refs, declare=None, processes=None, chunksize=1):
+    """Parse files in a pool of processes, and return a list of the result dicts, in the order of refs.
+    See iparse_files() for the arguments. """
+
+    return list(iparse_files(refs, declare=declare, processes=processes, ordered=True, chunksize=chunksize))
@@ -0,0 +1,435 @@
+# Copyright (c) 2016 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Benchmarks for the parser pipeline. Synthetic documents of configurable size and shape are written to
+a file, and each stage of the pipeline is timed separately, by materializing the output of the stage
+before it. The results can be saved as a baseline, and later runs compared with it to find regressions:
+
+    python -m structured_tables.benchmark --save baseline.json
+    python -m structured_tables.benchmark --baseline baseline.json
+
+Baselines are only comparable on the machine and Python version that produced them.
+
+With --encoders, the JSON encoders in structured_tables.serialize that are installed are compared instead,
+on the parse results of the same documents:
+
+    python -m structured_tables.benchmark --encoders
+"""
+
+import os
+import sys
+
+# Timing comparisons in the tests depend on the load of the machine, so they only run when this is set
+BENCHMARK = bool(os.getenv('STRUCT_TAB_BENCH'))
+
+STAGES = ('CsvPathRowGenerator', 'TermGenerator', 'TermInterpreter', 'link_terms', 'convert_to_dict')
+
+DEFAULT_DOCUMENT = dict(n_rows=10000, n_sections=4, arg_width=3, n_declared=100, n_synonyms=10,
+                        elided_density=0.5)
+
+# Document shapes, as changes to DEFAULT_DOCUMENT
+SUITES = {
+    'rows': dict(n_rows=50000),
+    'wide': dict(n_rows=20000, arg_width=20),
+    'sections': dict(n_rows=20000, n_sections=200),
+    'synonyms': dict(n_rows=20000, n_declared=1000, n_synonyms=500),
+    'elided': dict(n_rows=20000, elided_density=0.9),
+}
+
+DEFAULT_TOLERANCE = 0.25
+
+
+def synthetic_document(n_rows, n_sections, arg_width, n_declared, n_synonyms, elided_density):
+    """Return the rows of a synthetic metadata document, and a declare document for it, in the form produced
+    by DeclareTermInterpreter.as_dict()
+
+    :param n_rows: Number of term rows, excluding the Section rows
+    :param n_sections: Number of sections, which divide the rows evenly
+    :param arg_width: Number of arguments in each row
+    :param n_declared: Number of declared parent terms. Term<i> has a child term, Child<i>.
+    :param n_synonyms: Number of child terms with a synonym, which lets them be written without the parent,
+    like Column for Table.Column. Some of the rows for those terms use the synonym.
+    :param elided_density: Fraction of the child terms that are written with an elided parent, as '.Child<i>'
+    """
+
+    rows = []
+    declare = []
+
+    for i in range(n_declared):
+        declare.append({'term_name': 'Term{}'.format(i)})
+        declare.append({'term_name': 'Term{0}.Child{0}'.format(i)})
+
+    for i in range(min(n_synonyms, n_declared)):
+        declare.append({'term_name': 'Child{}'.format(i), 'synonym': 'Term{0}.Child{0}'.format(i)})
+
+    # A multiple of 4, so each section starts with a parent term
+    rows_per_section = max(4, n_rows // max(1, n_sections) // 4 * 4)
+    args = ['Arg{}'.format(i) for i in range(arg_width)]
+
+    parent = 0
+    n_children = 0
+
+    for k in range(n_rows):
+
+        if k % rows_per_section == 0 and k // rows_per_section < n_sections:
+            rows.append(['Section', 'Section{}'.format(k // rows_per_section)] + args)
+
+        values = ['value {}'.format(k)] + ['a{}'.format(j) for j in range(arg_width)]
+
+        if k % 4 == 0:
+            parent = (k // 4) % n_declared
+            rows.append(['Term{}'.format(parent)] + values)
+            continue
+
+        elided = int((n_children + 1) * elided_density) > int(n_children * elided_density)
+        n_children += 1
+
+        if parent < n_synonyms and k % 4 == 1:
+            rows.append(['Child{}'.format(parent)] + values)
+        elif elided:
+            rows.append(['.Child{}'.format(parent)] + values)
+        else:
+            rows.append(['Term{0}.Child{0}'.format(parent)] + values)
+
+    return rows, {'declareterm': declare}
+
+
+def write_rows(rows, path):
+    import csv
+
+    with open(path, 'w') as f:
+        csv.writer(f).writerows(rows)
+
+
+def best_time(f, repeat=3, setup=None):
+    """Return the lowest time to run f, over repeat runs. If setup is given, f is called with its result, and
+    the time for setup is not counted. """
+    from timeit import default_timer as timer
+
+    times = []
+
+    for i in range(repeat):
+        arg = setup() if setup else None
+
+        t0 = timer()
+        f(arg) if setup else f()
+        times.append(timer() - t0)
+
+    return min(times)
+
+
+def have_tracemalloc():
+    """Return True if peak memory can be measured for each stage, which needs tracemalloc, from Python 3.4"""
+
+    try:
+        import tracemalloc
+        return True
+    except ImportError:
+        return False
+
+
+def peak_memory(f, setup=None):
+    """Return the peak memory allocated while running f, in bytes, or None if tracemalloc is not available"""
+
+    try:
+        import tracemalloc
+    except ImportError:  # Python 2
+        return None
+
+    arg = setup() if setup else None
+
+    tracemalloc.start()
+
+    try:
+        f(arg) if setup else f()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def max_rss():
+    """Return the peak resident memory of the process, in bytes, or None if it isn't available"""
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def run_benchmark(directory, repeat=3, memory=True, **kwargs):
+    """Time each stage of the pipeline on a synthetic document. Returns a dict with the document
+    configuration and, for each stage, the time in seconds, the number of rows or terms it produced,
+    their rate per second, and the peak memory allocated.
+
+    :param directory: Directory for the document file
+    :param repeat: Number of times to run each stage. The lowest time is reported.
+    :param memory: If true, run each stage once more with tracemalloc, to measure peak memory
+    :param kwargs: Changes to DEFAULT_DOCUMENT
+    """
+    from os.path import join
+    from .parser import CsvPathRowGenerator, RowGenerator, TermGenerator, TermInterpreter
+    from .parser import link_terms, convert_to_dict
+
+    config = dict(DEFAULT_DOCUMENT, **kwargs)
+
+    rows, declare = synthetic_document(**config)
+
+    path = join(directory, 'benchmark.csv')
+    write_rows(rows, path)
+
+    def read(_=None):
+        return list(CsvPathRowGenerator(path))
+
+    def generate(rows):
+        return list(TermGenerator(RowGenerator(rows, path)))
+
+    def interpret(terms):
+        ti = TermInterpreter(terms)
+        ti.import_declare_doc(declare)
+        return list(ti)
+
+    csv_rows = read()
+    terms = generate(csv_rows)
+    n_interpreted = len(interpret(terms))
+
+    # Each stage, the number of rows or terms it produces, and a setup function that produces its input
+    # from the output of the earlier stages
+    stages = [
+        ('CsvPathRowGenerator', read, len(csv_rows), None),
+        ('TermGenerator', generate, len(terms), lambda: csv_rows),
+        ('TermInterpreter', interpret, n_interpreted, lambda: terms),
+        ('link_terms', link_terms, n_interpreted, lambda: interpret(terms)),  # link_terms modifies the terms
+        ('convert_to_dict', convert_to_dict, n_interpreted, lambda: link_terms(interpret(terms)))
+    ]
+
+    results = {'config': config, 'stages': {}}
+
+    for name, f, items, setup in stages:
+
+        t = best_time(f, repeat, setup)
+
+        results['stages'][name] = {
+            'seconds': t,
+            'items': items,
+            'items_per_second': items / t if t else None,
+            'peak_bytes': peak_memory(f, setup) if memory else None
+        }
+
+    results['max_rss'] = max_rss()
+
+    return results
+
+
+def run_suites(names=None, repeat=3, scale=1.0, memory=True):
+    """Run benchmarks for the named SUITES, or all of them, returning a dict of results by suite name
+
+    :param scale: Multiplier for the number of rows in each document
+    """
+    import shutil
+    import tempfile
+
+    d = tempfile.mkdtemp()
+
+    try:
+        results = {}
+
+        for name in names or sorted(SUITES):
+            config = dict(DEFAULT_DOCUMENT, **SUITES[name])
+            config['n_rows'] = max(1, int(config['n_rows'] * scale))
+
+            results[name] = run_benchmark(d, repeat, memory, **config)
+
+        return results
+    finally:
+        shutil.rmtree(d)
+
+
+def run_encoders(names=None, repeat=3, scale=1.0):
+    """Time each installed JSON encoder, for the whole result and streamed with iterencode(), on the parse
+    results of the documents of the named SUITES, or all of them. Returns a dict of results by suite name,
+    then encoder name.
+    """
+    import shutil
+    import tempfile
+    from os.path import join
+    from .parser import CsvPathRowGenerator, TermGenerator, TermInterpreter
+    from .serialize import make_encoder, available_encoders
+
+    encoders = [make_encoder(name) for name in available_encoders()]
+
+    d = tempfile.mkdtemp()
+
+    try:
+        results = {}
+
+        for name in names or sorted(SUITES):
+            config = dict(DEFAULT_DOCUMENT, **SUITES[name])
+            config['n_rows'] = max(1, int(config['n_rows'] * scale))
+
+            rows, declare = synthetic_document(**config)
+
+            path = join(d, 'benchmark.csv')
+            write_rows(rows, path)
+
+            ti = TermInterpreter(TermGenerator(CsvPathRowGenerator(path)))
+            ti.import_declare_doc(declare)
+            result = {'result': ti.as_dict(), 'errors': ti.errors_as_dict()}
+
+            results[name] = {}
+
+            for e in encoders:
+                size = len(e.dumps(result))
+
+                t = best_time(lambda: e.dumps(result), repeat)
+                t_stream = best_time(lambda: sum(len(chunk) for chunk in e.iterencode(result)), repeat)
+
+                results[name][e.name] = {
+                    'bytes': size,
+                    'seconds': t,
+                    'stream_seconds': t_stream,
+                    'bytes_per_second': size / t if t else None
+                }
+
+        return results
+    finally:
+        shutil.rmtree(d)
+
+
+def format_encoder_results(results):
+    """Return a table of the results of run_encoders(), as a string"""
+
+    lines = ['{:10s} {:12s} {:>12s} {:>10s} {:>10s} {:>10s}'.format(
+        'Suite', 'Encoder', 'Bytes', 'Seconds', 'Stream', 'MB/s')]
+
+    for name, r in sorted(results.items()):
+        for encoder, e in sorted(r.items(), key=lambda item: item[1]['seconds']):
+            lines.append('{:10s} {:12s} {:12d} {:10.4f} {:10.4f} {:10.1f}'.format(
+                name, encoder, e['bytes'], e['seconds'], e['stream_seconds'],
+                (e['bytes_per_second'] or 0) / (1024.0 * 1024)))
+
+    return '\n'.join(lines)
+
+
+def save_baseline(results, path):
+    import json
+
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=4, sort_keys=True)
+
+
+def load_baseline(path):
+    import json
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def find_regressions(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Compare results from run_suites() with a baseline, returning a list of messages for each stage that is
+    slower, or uses more memory, than the baseline by more than the tolerance. Suites and stages that are not
+    in the baseline, or that have a different document configuration, are skipped. """
+
+    regressions = []
+
+    for name, r in sorted(results.items()):
+        base = baseline.get(name)
+
+        if base is None or base['config'] != r['config']:
+            continue
+
+        for stage in STAGES:
+            s, b = r['stages'].get(stage), base['stages'].get(stage)
+
+            if s is None or b is None:
+                continue
+
+            for metric in ('seconds', 'peak_bytes'):
+                if s.get(metric) is not None and b.get(metric) and s[metric] > b[metric] * (1 + tolerance):
+                    regressions.append('{} {} {}: {:0.4g} > {:0.4g} (+{:0.0f}%)'.format(
+                        name, stage, metric, s[metric], b[metric], (s[metric] / float(b[metric]) - 1) * 100))
+
+    return regressions
+
+
+def format_results(results):
+    """Return a table of the results of run_suites(), as a string. The last row of each suite is the peak
+    resident memory of the process, which is the only memory measurement on Python 2"""
+
+    lines = ['{:10s} {:20s} {:>10s} {:>10s} {:>14s} {:>12s}'.format(
+        'Suite', 'Stage', 'Items', 'Seconds', 'Items/s', 'Peak KB')]
+
+    for name, r in sorted(results.items()):
+        for stage in STAGES:
+            s = r['stages'][stage]
+
+            lines.append('{:10s} {:20s} {:10d} {:10.4f} {:14.0f} {:>12s}'.format(
+                name, stage, s['items'], s['seconds'], s['items_per_second'] or 0,
+                '{:0.0f}'.format(s['peak_bytes'] / 1024.0) if s['peak_bytes'] is not None else '-'))
+
+        if r.get('max_rss') is not None:
+            lines.append('{:10s} {:20s} {:>49s}'.format(name, 'Process max RSS', '{:0.0f}'.format(r['max_rss'] / 1024.0)))
+
+    if not have_tracemalloc():
+        lines.append('')
+        lines.append('Peak KB for each stage needs tracemalloc, from Python 3.4. The process max RSS includes '
+                     'all of the stages and suites run before it.')
+
+    return '\n'.join(lines)
+
+
+def main(sys_args):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m structured_tables.benchmark',
+                                     description='Benchmark the stages of the parser pipeline')
+
+    parser.add_argument('suite', nargs='*',
+                        help='Suites to run, from: {}. Defaults to all of them'.format(', '.join(sorted(SUITES))))
+    parser.add_argument('-n', '--repeat', default=3, type=int, help='Number of times to run each stage')
+    parser.add_argument('-s', '--scale', default=1.0, type=float, help='Multiplier for the document sizes')
+    parser.add_argument('-M', '--no-memory', default=False, action='store_true',
+                        help="Don't measure peak memory, which runs each stage again with tracemalloc")
+    parser.add_argument('-S', '--save', default=None, help='Save the results as a baseline file')
+    parser.add_argument('-b', '--baseline', default=None,
+                        help='Compare the results with a baseline file, and exit with 1 if there are regressions')
+    parser.add_argument('-t', '--tolerance', default=DEFAULT_TOLERANCE, type=float,
+                        help='Fraction by which a stage may be slower than the baseline. Default: 0.25')
+    parser.add_argument('-e', '--encoders', default=False, action='store_true',
+                        help='Compare the installed JSON encoders, instead of the stages of the pipeline')
+
+    args = parser.parse_args(sys_args)
+
+    for name in args.suite:
+        if name not in SUITES:
+            parser.error('Unknown suite: {}'.format(name))
+
+    if args.encoders:
+        print(format_encoder_results(run_encoders(args.suite, args.repeat, args.scale)))
+        return 0
+
+    results = run_suites(args.suite, args.repeat, args.scale, not args.no_memory)
+
+    print(format_results(results))
+
+    if args.save:
+        save_baseline(results, args.save)
+
+    if args.baseline:
+        regressions = find_regressions(results, load_baseline(args.baseline), args.tolerance)
+
+        for r in regressions:
+            print('REGRESSION: ' + r)
+
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,87 @@
+# Copyright (c) 2016 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Precompiled declaration bundles. A bundle holds the sections, terms and synonyms of one or more
+Declare documents, so a TermInterpreter can be loaded with a vocabulary without parsing its CSV
+files. Value sets are already substituted into the terms that use them. Each bundle has a hash of its
+contents, so caches can tell a rebuilt bundle from the old one. Bundles are written as compact JSON, and
+compressed with gzip when the file name ends in '.gz'
+
+"""
+
+BUNDLE_VERSION = 1
+
+
+class BundleError(Exception):
+    pass
+
+
+def compile_bundle(refs):
+    """Parse a set of Declare documents and return a bundle dict.
+
+    :param refs: Paths or URLs of Declare documents, in the order they should be declared
+    :return: a bundle dict
+    """
+    from .parser import TermInterpreter, DeclareTermInterpreter, TermGenerator, CsvPathRowGenerator
+    from .cache import resolve_ref
+
+    target = TermInterpreter([])
+
+    for ref in refs:
+        target.import_declare_doc(DeclareTermInterpreter(TermGenerator(CsvPathRowGenerator(ref))).as_dict())
+
+    bundle = {
+        'version': BUNDLE_VERSION,
+        'sources': [resolve_ref(ref) for ref in refs],
+        'sections': target.sections,
+        'terms': target.terms,
+        'synonyms': target.synonyms
+    }
+
+    bundle['hash'] = bundle_hash(bundle)
+
+    return bundle
+
+
+def bundle_hash(bundle):
+    """Return a hash of the contents of a bundle, which changes when it is rebuilt from changed documents. The
+    hash is stored in the bundle, so it is only computed once"""
+    import json
+    from hashlib import sha1
+
+    if 'hash' not in bundle:
+        data = json.dumps({k: v for k, v in bundle.items() if k != 'hash'}, separators=(',', ':'), sort_keys=True)
+        bundle['hash'] = sha1(data.encode('utf8')).hexdigest()
+
+    return bundle['hash']
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        import gzip
+        return gzip.open(path, mode)
+    else:
+        return open(path, mode)
+
+
+def write_bundle(bundle, path):
+    """Write a bundle to a file"""
+    import json
+
+    with _open(path, 'wb') as f:
+        f.write(json.dumps(bundle, separators=(',', ':'), sort_keys=True).encode('utf8'))
+
+
+def load_bundle(path):
+    """Load a bundle from a file"""
+    import json
+
+    with _open(path, 'rb') as f:
+        bundle = json.loads(f.read().decode('utf8'))
+
+    if bundle.get('version') != BUNDLE_VERSION:
+        raise BundleError("Bundle '{}' has version {}, expected {}"
+                          .format(path, bundle.get('version'), BUNDLE_VERSION))
+
+    return bundle
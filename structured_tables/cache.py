@@ -0,0 +1,444 @@
+# Copyright (c) 2016 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Caches that are shared by all of the parsers in a process. The most important one is the
+declare_cache, which holds the parsed contents of Declare documents so that documents that all
+declare the same vocabulary only parse it once. The fragment_cache does the same for the terms of
+Include documents. The ResultCache holds whole parse results for servers.
+
+Declare documents and parse results can also be shared by the processes on many hosts, with a
+RedisCache behind the in-process caches. configure_shared_cache() sets it up.
+
+"""
+
+from threading import RLock
+
+DEFAULT_DECLARE_CACHE_SIZE = 64
+DEFAULT_FRAGMENT_CACHE_SIZE = 64
+DEFAULT_RESULT_CACHE_SIZE = 256
+DEFAULT_REDIS_PREFIX = 'structured_tables:'
+
+
+class LRUCache(object):
+    """A size-bounded, thread safe mapping that discards the least recently used entries"""
+
+    def __init__(self, max_size):
+        from collections import OrderedDict
+
+        self._max_size = max_size
+        self._data = OrderedDict()
+        self._lock = RLock()
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    @max_size.setter
+    def max_size(self, v):
+        with self._lock:
+            self._max_size = v
+            self._evict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                v = self._data.pop(key)
+            except KeyError:
+                return default
+
+            self._data[key] = v  # Re-insert, to make it the most recently used
+            return v
+
+    def put(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            self._evict()
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def keys(self):
+        with self._lock:
+            return list(self._data.keys())
+
+    def _evict(self):
+        while len(self._data) > self._max_size:
+            self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+def json_version(version):
+    """Return a version as it is after a round trip through JSON, for comparing with versions from a RedisCache"""
+    import json
+
+    return json.loads(json.dumps(version))
+
+
+def resolve_ref(ref):
+    """Return a cache key for a path or URL. Paths are made absolute, so the same file
+    referenced from different directories has one key"""
+    from os.path import abspath, realpath
+
+    if ref.startswith('http'):
+        return ref
+
+    return realpath(abspath(ref))
+
+
+def ref_version(ref):
+    """Return a value that changes when the document at ref changes: the modification time
+    and size for files, and the ETag or Last-Modified header for URLs. Returns None if
+    the version can't be determined, in which case the document should not be cached. """
+    import os
+
+    if ref.startswith('http'):
+        from .fetch import get_fetcher
+
+        headers = get_fetcher().head(ref)
+
+        if headers is None:
+            return None
+
+        return headers.get('ETag') or headers.get('Last-Modified')
+
+    try:
+        st = os.stat(ref)
+    except OSError:
+        return None
+
+    return (st.st_mtime, st.st_size)
+
+
+def parse_declare_doc(ref):
+    """Parse a Declare document and return its sections and terms, as they would be
+    in a TermInterpreter after a call to import_declare_doc() """
+    from .parser import TermInterpreter, DeclareTermInterpreter, TermGenerator, CsvPathRowGenerator
+
+    ti = DeclareTermInterpreter(TermGenerator(CsvPathRowGenerator(ref)))
+
+    # Import into a plain interpreter, so the dicts don't include the bootstrap
+    # declarations of the DeclareTermInterpreter
+    target = TermInterpreter([])
+    target.import_declare_doc(ti.as_dict())
+
+    return target.declare_dict
+
+
+def parse_fragment(ref):
+    """Parse an Include document and return a list of its terms. Include terms in the
+    document are not expanded. """
+    from .parser import TermGenerator, CsvPathRowGenerator
+
+    return list(TermGenerator(CsvPathRowGenerator(ref)).generate_terms())
+
+
+class DeclareDocCache(object):
+    """A cache of parsed Declare documents, keyed by resolved path or URL. Entries are
+    revalidated on each access, by file modification time or by HTTP ETag / Last-Modified
+    header, and the least recently used entries are evicted when the cache is full.
+
+    The cached dicts are shared, so callers must copy them before modifying them;
+    TermInterpreter.merge_declare_dict() does this.
+    """
+
+    parse = staticmethod(parse_declare_doc)
+
+    def __init__(self, max_size=DEFAULT_DECLARE_CACHE_SIZE, shared=None):
+        """
+
+        :param max_size: Number of documents to keep in memory
+        :param shared: Optional RedisCache, for documents parsed by other processes.
+        :return:
+        """
+        self._cache = LRUCache(max_size)
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def max_size(self):
+        return self._cache.max_size
+
+    @max_size.setter
+    def max_size(self, v):
+        self._cache.max_size = v
+
+    def get(self, ref):
+        """Return the parsed document for a path or URL, parsing the document only if
+        it isn't in the cache, or has changed since it was cached """
+
+        key = resolve_ref(ref)
+        version = ref_version(key)
+
+        entry = self._cache.get(key)
+
+        if entry is not None and version is not None and entry[0] == version:
+            self.hits += 1
+            return entry[1]
+
+        if self.shared is not None and version is not None:
+            entry = self.shared.get('declare:' + key)
+
+            if entry is not None and entry[0] == json_version(version):
+                self.hits += 1
+                self._cache.put(key, (version, entry[1]))
+                return entry[1]
+
+        self.misses += 1
+
+        d = self.parse(key)
+
+        if version is not None:
+            self._cache.put(key, (version, d))
+
+            if self.shared is not None:
+                self.shared.put('declare:' + key, (version, d))
+
+        return d
+
+    def clear(self):
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, ref):
+        return resolve_ref(ref) in self._cache
+
+    def __len__(self):
+        return len(self._cache)
+
+
+class FragmentCache(DeclareDocCache):
+    """A cache of the terms of Include documents, which works like the DeclareDocCache. The cached
+    terms are shared, so TermGenerator clones them as it generates them."""
+
+    parse = staticmethod(parse_fragment)
+
+    def __init__(self, max_size=DEFAULT_FRAGMENT_CACHE_SIZE):
+        super(FragmentCache, self).__init__(max_size)
+
+
+class BatchDeclareCache(object):
+    """A declare cache for parsing a batch of documents together. Each Declare document is looked up in the
+    underlying cache once per batch, so it is parsed or revalidated once, rather than once per document. """
+
+    def __init__(self, cache=None):
+        """
+
+        :param cache: The DeclareDocCache to look up documents in. Defaults to the process-wide declare_cache
+        :return:
+        """
+
+        self._cache = cache if cache is not None else declare_cache
+        self._docs = {}
+        self.refs = []  # Resolved refs of all of the documents looked up, including ones that failed to load
+
+    def get(self, ref):
+
+        key = resolve_ref(ref)
+
+        try:
+            return self._docs[key]
+        except KeyError:
+            pass
+
+        if key not in self.refs:
+            self.refs.append(key)
+
+        d = self._docs[key] = self._cache.get(key)
+        return d
+
+    def __contains__(self, ref):
+        return resolve_ref(ref) in self._docs
+
+    def __len__(self):
+        return len(self._docs)
+
+
+class ResultCache(object):
+    """A cache of serialized parse results, keyed by a hash of the document and its content type. Each
+    entry records the Declare and Include documents used by the parse and their versions, and is only returned
+    while those documents are unchanged. Entries are kept in an in-memory LRU cache, and optionally in a
+    DiskCache, so they survive restarts and can be shared by processes. """
+
+    def __init__(self, max_size=DEFAULT_RESULT_CACHE_SIZE, directory=None, disk_size=None, shared=None):
+        """
+
+        :param max_size: Number of results to keep in memory
+        :param directory: Optional directory for the disk tier
+        :param disk_size: Maximum size of the disk tier, in bytes
+        :param shared: Optional RedisCache, for results shared with other processes and hosts
+        :return:
+        """
+        from .fetch import DiskCache, DEFAULT_CACHE_SIZE
+
+        self._cache = LRUCache(max_size)
+        self._disk = DiskCache(directory, disk_size or DEFAULT_CACHE_SIZE) if directory else None
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(data, content_type):
+        """Return the cache key for a document"""
+        from hashlib import sha1
+
+        h = sha1((content_type or '').encode('utf8') + b'\0')
+        h.update(data)
+
+        return h.hexdigest()
+
+    @staticmethod
+    def versions(refs):
+        """Return a string of the versions of the Declare and Include documents at refs"""
+        import json
+
+        return json.dumps([ref_version(ref) for ref in refs])
+
+    def get(self, key):
+        """Return a tuple of the ETag and serialized result for a key, or None if there is no entry, or
+        the Declare or Include documents it used have changed """
+        import json
+
+        entry = self._cache.get(key)
+
+        if entry is None and self._disk is not None and self._disk.get(key) is not None:
+            try:
+                entry = tuple(json.loads(self._disk.read(key).decode('utf8')))
+            except (AttributeError, ValueError):  # Evicted between get() and read(), or corrupt
+                entry = None
+
+        if entry is None and self.shared is not None:
+            entry = self.shared.get('result:' + key)
+
+        if entry is not None:
+            refs, versions, etag, value = entry
+
+            if self.versions(refs) == versions:
+                self._cache.put(key, entry)
+                self.hits += 1
+                return etag, value
+
+        self.misses += 1
+        return None
+
+    def put(self, key, refs, value):
+        """Store a serialized result, and return its ETag. Results aren't stored, and None is returned, if
+        the version of a remote Declare or Include document can't be determined.
+
+        :param key: Key from key()
+        :param refs: Resolved refs of the Declare and Include documents used by the parse
+        :param value: The serialized result, as text
+        """
+        import json
+        from hashlib import sha1
+
+        versions = self.versions(refs)
+
+        if any(v is None and ref.startswith('http') for ref, v in zip(refs, json.loads(versions))):
+            return None
+
+        etag = sha1((key + versions).encode('utf8')).hexdigest()
+        entry = (list(refs), versions, etag, value)
+
+        self._cache.put(key, entry)
+
+        if self._disk is not None:
+            self._disk.put(key, {}, json.dumps(entry).encode('utf8'))
+
+        if self.shared is not None:
+            self.shared.put('result:' + key, entry)
+
+        return etag
+
+    def clear(self):
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+
+class RedisCache(object):
+    """A cache of JSON-serializable values in Redis, shared by all of the processes that use the same
+    server. It is used as the shared tier behind the in-process caches, so Redis errors are logged and
+    treated as cache misses. """
+
+    def __init__(self, client, prefix=DEFAULT_REDIS_PREFIX, ttl=None):
+        """
+
+        :param client: A redis.StrictRedis client, or an object with compatible get() and set() methods
+        :param prefix: Prefix for the Redis keys
+        :param ttl: Optional expiry time for entries, in seconds
+        :return:
+        """
+
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key):
+        import json
+        import logging
+
+        try:
+            v = self.client.get(self.prefix + key)
+        except Exception as e:  # redis.RedisError, but redis is an optional dependency
+            logging.warning('Failed to get {} from Redis: {}'.format(key, e))
+            return None
+
+        if v is None:
+            return None
+
+        return json.loads(v.decode('utf8') if isinstance(v, bytes) else v)
+
+    def put(self, key, value):
+        import json
+        import logging
+
+        try:
+            self.client.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+        except Exception as e:
+            logging.warning('Failed to put {} to Redis: {}'.format(key, e))
+
+
+def redis_client(host, port=6379, db=0):
+    """Return a Redis client. Requires the redis package"""
+    import redis
+
+    return redis.StrictRedis(host=host, port=int(port), db=db)
+
+
+def configure_shared_cache(shared):
+    """Use a RedisCache as the shared tier of the process-wide declare_cache, and of ResultCaches created
+    by servers after this call.
+
+    :param shared: A RedisCache, or None to stop sharing
+    """
+    global shared_cache
+
+    shared_cache = shared
+    declare_cache.shared = shared
+
+
+# The process-wide cache used by TermInterpreter.handle_declare()
+declare_cache = DeclareDocCache()
+
+# The RedisCache set by configure_shared_cache()
+shared_cache = None
+
+# The process-wide cache used by TermGenerator.include_term_generator()
+fragment_cache = FragmentCache()
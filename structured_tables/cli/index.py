@@ -0,0 +1,90 @@
+# Copyright (c) 2016 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+The struct_tab index command, which maintains and queries a structured_tables.index.TermIndex:
+
+    struct_tab index update metadata/
+    struct_tab index find datafile -a grain=Tract
+
+"""
+
+import os
+
+DEFAULT_DATABASE = 'struct_tab_index.db'
+
+
+def make_parser():
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='struct_tab index',
+                                     description='Index the terms of STF documents, and query the index')
+
+    parser.add_argument('-D', '--database', default=os.getenv('STRUCT_TAB_INDEX', DEFAULT_DATABASE),
+                        help='Path of the index database. Defaults to $STRUCT_TAB_INDEX, or {}'
+                        .format(DEFAULT_DATABASE))
+
+    commands = parser.add_subparsers(dest='command')
+
+    update = commands.add_parser('update', help='Index new and changed files')
+    update.add_argument('-P', '--prune', default=False, action='store_true',
+                        help='Remove files from the index that no longer exist in the directories')
+    update.add_argument('path', nargs='+', help='CSV files, or directories to search for CSV files')
+
+    find = commands.add_parser('find', help='Find the records of a term')
+    find.add_argument('-a', '--arg', default=[], action='append', metavar='NAME=VALUE',
+                      help='Value of an argument or child term of the record. May be given more than once')
+    find.add_argument('-s', '--section', default=None, help='Only find records in this section')
+    find.add_argument('-l', '--files', default=False, action='store_true',
+                      help='Print only the paths of the files with matching records')
+    find.add_argument('term', help="Record term, like 'datafile', or parent and record term, like 'table.column'")
+    find.add_argument('value', nargs='?', default=None, help='Value of the record term')
+
+    commands.add_parser('files', help='List the indexed files')
+
+    return parser
+
+
+def index(sys_args):
+    from structured_tables.index import TermIndex
+
+    parser = make_parser()
+    args = parser.parse_args(sys_args)
+
+    if not args.command:
+        parser.error('Expected a command: update, find or files')
+
+    idx = TermIndex(args.database)
+
+    try:
+        if args.command == 'update':
+            counts = idx.update(args.path, prune=args.prune)
+            print(', '.join('{} {}'.format(counts[k], k)
+                            for k in ('added', 'updated', 'unchanged', 'removed', 'failed')))
+
+        elif args.command == 'find':
+            kwargs = {}
+
+            for a in args.arg:
+                if '=' not in a:
+                    parser.error('Expected NAME=VALUE for --arg: {}'.format(a))
+
+                k, v = a.split('=', 1)
+                kwargs[k.strip()] = v
+
+            records = idx.find(args.term, args.value, args.section, **kwargs)
+
+            if args.files:
+                for path in sorted(set(r['file'] for r in records)):
+                    print(path)
+            else:
+                for r in records:
+                    print(u'{}:{}: {} {}: {}'.format(r['file'], r['row'], r['section'], r['term'], r['value']))
+
+        elif args.command == 'files':
+            for f in idx.files():
+                print(u'{} {} terms{}'.format(f['path'], f['n_terms'], ' ({})'.format(f['error']) if f['error'] else ''))
+    finally:
+        idx.close()
+
+    return 0
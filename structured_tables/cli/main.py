@@ -4,17 +4,33 @@
 import sys
 
 
+def print_profile(stats):
+    if stats is not None:
+        sys.stderr.write(stats.format() + '\n')
+
+
 def main(sys_args):
     import argparse
+
+    if sys_args[1:2] == ['serve']:
+        from .serve import serve
+        return serve(sys_args[2:])
+
+    if sys_args[1:2] == ['index']:
+        from .index import index
+        return index(sys_args[2:])
+
     from structured_tables import __meta__
     from structured_tables.parser import TermInterpreter, TermGenerator
-    from structured_tables.parser import RowGenerator, DeclareTermInterpreter
+    from structured_tables.parser import CsvPathRowGenerator, DeclareTermInterpreter
     from structured_tables.parser import convert_to_dict, link_terms
     import csv
 
     parser = argparse.ArgumentParser(
         prog='struct_tab',
-        description='Simple Structured Table format parser. '.format(__meta__.__version__))
+        description='Simple Structured Table format parser. Run "struct_tab serve -h" for the '
+                    'options for running the parse API, and "struct_tab index -h" for indexing and '
+                    'querying the terms of many documents. '.format(__meta__.__version__))
 
     g = parser.add_mutually_exclusive_group(required=True)
     g.add_argument('-t', '--terms', default=False, action='store_true',
@@ -25,41 +41,91 @@ def main(sys_args):
                    help='Parse a file and print out a JSON representation')
     g.add_argument('-y', '--yaml', default=False, action='store_true',
                    help='Parse a file and print out a YAML representation')
+    g.add_argument('-c', '--compile', default=False, metavar='BUNDLE',
+                   help='Compile one or more declaration files into a bundle file, for use with -b. '
+                        'The bundle is compressed if the name ends in .gz')
+    g.add_argument('-e', '--export', default=False, metavar='DIRECTORY',
+                   help='Parse a file and write the records of each section to a columnar file for each record '
+                        'term, in the directory. Requires pyarrow')
 
     parser.add_argument('-d', '--declare', default=False, action='store_true',
                  help='Parse a declaration file and print out declaration dict. Use -j or -y for the format')
 
-    parser.add_argument('file', help='Path to a CSV file with STF data.')
+    parser.add_argument('-b', '--bundle', default=None,
+                        help='Load declarations from a bundle file, created with -c, before parsing')
+
+    parser.add_argument('-f', '--format', default='parquet', choices=['parquet', 'arrow'],
+                        help='File format for -e: parquet, or arrow for Arrow IPC files. Default: parquet')
+
+    parser.add_argument('-s', '--section', default=[], action='append',
+                        help='Name of a section to export with -e. May be given more than once. '
+                             'Defaults to all sections')
+
+    parser.add_argument('-p', '--profile', default=False, action='store_true',
+                        help='Print counts and times for each stage of the parser to stderr')
+
+    parser.add_argument('file', nargs='+', help='Path to a CSV file with STF data. '
+                                                'Only -c accepts more than one file')
 
     args = parser.parse_args(sys_args[1:])
 
-    rg = RowGenerator(args.file)
+    if args.compile:
+        from structured_tables.bundle import compile_bundle, write_bundle
+        write_bundle(compile_bundle(args.file), args.compile)
+        exit(0)
+
+    if len(args.file) > 1:
+        parser.error('Only -c accepts more than one file')
+
+    if args.profile:
+        from structured_tables.stats import ParserStats
+        stats = ParserStats()
+    else:
+        stats = None
+
+    rg = CsvPathRowGenerator(args.file[0])
 
-    term_gen = list(TermGenerator(rg))
+    term_gen = list(TermGenerator(rg, stats=stats))
 
     if args.declare:
-        term_interp = DeclareTermInterpreter(term_gen)
+        term_interp = DeclareTermInterpreter(term_gen, bundle=args.bundle, stats=stats)
     else:
-        term_interp = TermInterpreter(term_gen)
+        term_interp = TermInterpreter(term_gen, bundle=args.bundle, stats=stats)
 
     if args.interp:
         for t in list(term_interp):
             print(t)
+        print_profile(stats)
         exit(0)
     elif args.terms:
         for t in term_gen:
             print(t)
+        print_profile(stats)
+        exit(0)
+    elif args.export:
+        from structured_tables.columnar import export
+
+        try:
+            paths = export(term_interp, args.export, args.format, sections=args.section)
+        except ImportError as e:
+            parser.error(str(e))
+
+        for name, path in sorted(paths.items()):
+            print('{}: {}'.format(name, path))
+        print_profile(stats)
         exit(0)
 
     dicts = term_interp.as_dict()
 
+    print_profile(stats)
+
     if args.declare:
         term_interp.import_declare_doc(dicts)
         dicts = term_interp.declare_dict
 
     if args.json:
-        import json
-        print(json.dumps(dicts, indent=4))
+        from structured_tables.serialize import dumps
+        print(dumps(dicts, indent=4))
     elif args.yaml:
         import yaml
         print(yaml.dump(dicts, default_flow_style=False, indent=4))
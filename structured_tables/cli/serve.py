@@ -0,0 +1,181 @@
+# Copyright (c) 2016 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+The struct_tab serve command, which runs the parse API in structured_tables.server. With gunicorn installed,
+the API runs in a pool of worker processes, each with a pool of threads. The parser modules, declare
+vocabularies and bundle are loaded before the workers are forked, so the workers share that memory, and
+gunicorn reloads the workers gracefully on SIGHUP. Without gunicorn, the API runs in one threaded process.
+
+Each worker keeps its own metrics, so with more than one worker they are shared through files in a
+directory, which is a temporary directory unless --metrics-dir is given, and /metrics reports the totals
+of all of the workers.
+"""
+
+import logging
+import os
+
+DEFAULT_THREADS = 4
+DEFAULT_KEEP_ALIVE = 5  # Seconds
+DEFAULT_TIMEOUT = 60  # Seconds
+DEFAULT_MAX_REQUEST_SIZE = 64 * 1024 * 1024  # Bytes
+
+
+def default_workers():
+    import multiprocessing
+
+    return multiprocessing.cpu_count() * 2 + 1
+
+
+def make_parser():
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='struct_tab serve',
+                                     description='Run the structured tables parse API')
+
+    parser.add_argument('-H', '--host', default='127.0.0.1', help='Host address to listen on')
+    parser.add_argument('-p', '--port', default=5000, type=int, help='Port to listen on')
+    parser.add_argument('-w', '--workers', default=default_workers(), type=int,
+                        help='Number of worker processes. Defaults to twice the number of CPUs, plus one')
+    parser.add_argument('-t', '--threads', default=DEFAULT_THREADS, type=int,
+                        help='Number of threads in each worker')
+    parser.add_argument('-k', '--keep-alive', default=DEFAULT_KEEP_ALIVE, type=int,
+                        help='Seconds to wait for another request on a keep-alive connection')
+    parser.add_argument('-T', '--timeout', default=DEFAULT_TIMEOUT, type=int,
+                        help='Seconds a worker may take to handle a request before it is restarted. Also the '
+                             'time workers have to finish their requests on a graceful reload')
+    parser.add_argument('-m', '--max-request-size', default=DEFAULT_MAX_REQUEST_SIZE, type=int,
+                        help='Maximum size of a request body, in bytes. Larger requests get a 413 response')
+    parser.add_argument('-d', '--declare', default=[], action='append',
+                        help='Path or URL of a Declare document to parse before starting the workers. '
+                             'May be given more than once')
+    parser.add_argument('-b', '--bundle', default=None,
+                        help='Declaration bundle to load before starting the workers, and to use for every request')
+    parser.add_argument('-B', '--base-dir', default=None,
+                        help='Directory of the local Declare and Include documents that posted documents may '
+                             'reference. Without it, they may only reference URLs')
+    parser.add_argument('-c', '--result-cache-dir', default=None,
+                        help='Directory for the disk tier of the parse result cache')
+    parser.add_argument('-M', '--metrics-dir', default=None,
+                        help='Directory the workers share their metrics through. Defaults to a temporary '
+                             'directory when there is more than one worker')
+    parser.add_argument('-R', '--redis-host', default=os.getenv('REDIS_PORT_6379_TCP_ADDR'),
+                        help='Redis host, for sharing declare documents and parse results with other servers. '
+                             'Defaults to the address of a linked Docker Redis container')
+    parser.add_argument('-r', '--redis-port', default=os.getenv('REDIS_PORT_6379_TCP_PORT', 6379), type=int,
+                        help='Redis port')
+
+    return parser
+
+
+def preload(args):
+    """Load the parse API, vocabularies and bundle, and configure the app. Returns the app"""
+    from structured_tables.server import app
+    from structured_tables.cache import declare_cache
+    from structured_tables.fetch import get_fetcher
+
+    app.config['MAX_CONTENT_LENGTH'] = args.max_request_size
+
+    if args.redis_host:
+        from structured_tables.cache import RedisCache, redis_client, configure_shared_cache
+        configure_shared_cache(RedisCache(redis_client(args.redis_host, args.redis_port)))
+
+    if args.result_cache_dir:
+        app.config['RESULT_CACHE_DIR'] = args.result_cache_dir
+
+    if args.base_dir:
+        app.config['BASE_DIR'] = args.base_dir
+
+    if args.bundle:
+        from structured_tables.bundle import load_bundle
+        app.config['DECLARE_BUNDLE'] = load_bundle(args.bundle)
+
+    for ref in args.declare:
+        declare_cache.get(ref)
+
+    # Don't leave idle connections for the forked workers to inherit
+    get_fetcher().close()
+
+    return app
+
+
+def gunicorn_options(args):
+    """Return the gunicorn settings for the command arguments"""
+
+    return {
+        'bind': '{}:{}'.format(args.host, args.port),
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': 'gthread',
+        'keepalive': args.keep_alive,
+        'timeout': args.timeout,
+        'graceful_timeout': args.timeout,
+        'preload_app': True,
+    }
+
+
+def share_metrics(args):
+    """Set the directory the workers share their metrics through, so /metrics reports all of them, rather
+    than only the worker that serves the request. Returns the directory, or None if there is one worker"""
+    import atexit
+    import shutil
+    import tempfile
+    from structured_tables.metrics import registry
+
+    if args.metrics_dir:
+        registry.set_shared_dir(args.metrics_dir)
+    elif args.workers > 1:
+        path = tempfile.mkdtemp(prefix='struct_tab_metrics_')
+        pid = os.getpid()
+
+        registry.set_shared_dir(path)
+
+        # Only the parent removes it; the workers exit with it still in use
+        atexit.register(lambda: os.getpid() == pid and shutil.rmtree(path, ignore_errors=True))
+
+    return registry.shared_dir
+
+
+def run_gunicorn(app, options):
+    from gunicorn.app.base import BaseApplication
+
+    class Application(BaseApplication):
+
+        def load_config(self):
+            for k, v in options.items():
+                self.cfg.set(k, v)
+
+        def load(self):
+            return app
+
+    Application().run()
+
+
+def run_werkzeug(app, args):
+    from werkzeug.serving import run_simple
+
+    logging.warning('gunicorn is not installed, so serving with one threaded process')
+
+    run_simple(args.host, args.port, app, threaded=True)
+
+
+def serve(sys_args):
+    import gc
+
+    args = make_parser().parse_args(sys_args)
+
+    app = preload(args)
+
+    try:
+        import gunicorn
+    except ImportError:
+        return run_werkzeug(app, args)
+
+    if hasattr(gc, 'freeze'):
+        # Move the preloaded objects out of the collector's generations, so that collections in the workers
+        # don't write to their pages and copy them
+        gc.freeze()
+
+    share_metrics(args)
+
+    return run_gunicorn(app, gunicorn_options(args))
@@ -0,0 +1,272 @@
+# Copyright (c) 2016 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Export the records of sections as columnar batches, straight from the stream of interpreted terms. Each
+record term in a section, like the Column terms in a Schema section, is a table, with a row for each
+record. The columns are:
+
+    section   The section name
+    parent    The value of the enclosing record, such as the Table of a Column, or None
+    <value>   The value of the record term, named by its TermValueName, or 'value'
+    <args>    A column for each argument, named by the section's parameter map. An argument with the
+              name of one of the other columns is prefixed with 'arg_', so a 'row' argument is 'arg_row'
+    row       The row number of the term in the source file
+
+The batches can be written to Parquet or Arrow IPC files, one per table, with the optional pyarrow
+package:
+
+    export(TermInterpreter(TermGenerator(CsvPathRowGenerator(path))), 'out', sections=['schema'])
+
+writes out/schema.table.parquet and out/schema.column.parquet.
+"""
+
+from collections import OrderedDict
+
+DEFAULT_BATCH_SIZE = 10000
+
+FORMATS = {
+    'parquet': '.parquet',
+    'arrow': '.arrow'
+}
+
+
+class ColumnBatch(object):
+    """A batch of rows of a table, as a dict of lists of values by column name"""
+
+    def __init__(self, section, term, columns):
+        self.section = section
+        self.term = term
+        self.columns = columns
+
+    @property
+    def name(self):
+        return '{}.{}'.format(self.section, self.term)
+
+    def rows(self):
+        """Return the rows of the batch, as tuples in the order of the columns"""
+        return list(zip(*self.columns.values()))
+
+    def __len__(self):
+        return len(self.columns['row'])
+
+    def __repr__(self):
+        return '<ColumnBatch {} {} rows>'.format(self.name, len(self))
+
+
+BUILTIN_COLUMNS = ('section', 'parent', 'row')
+
+
+class _TableBuilder(object):
+    """Collects the rows of one table. Columns are added as they are seen, and rows that don't have a
+    column get None for it"""
+
+    def __init__(self, section, term, value_name):
+        if value_name in BUILTIN_COLUMNS:
+            value_name = 'value'
+
+        self.section = section
+        self.term = term
+        self.columns = ['section', 'parent', value_name]
+        self._value_name = value_name
+        self._names = set(self.columns + ['row'])
+        self._arg_columns = {}  # Column names of the arguments, by term
+        self.rows = []
+
+    def start(self, t, parent):
+        row = {'section': self.section, 'parent': parent.value if parent is not None else None,
+               self._value_name: t.value, 'row': t.row}
+        self.rows.append(row)
+        return row
+
+    def add_column(self, term):
+        """Add a column for an argument, if it hasn't been added already, and return its name"""
+
+        try:
+            return self._arg_columns[term]
+        except KeyError:
+            pass
+
+        name = term
+
+        while name in self._names:  # Don't overwrite the value, row, or other built in columns
+            name = 'arg_' + name
+
+        self._names.add(name)
+        self._arg_columns[term] = name
+        self.columns.append(name)
+
+        return name
+
+    def flush(self):
+        columns = OrderedDict((c, [r.get(c) for r in self.rows]) for c in self.columns + ['row'])
+        self.rows = []
+        return ColumnBatch(self.section, self.term, columns)
+
+
+def section_batches(term_interp, batch_size=DEFAULT_BATCH_SIZE, sections=None):
+    """Yield ColumnBatches for the records of the sections of a document. A table's batches are yielded when
+    they reach batch_size rows, and at the end of its section. Columns are only added, so each batch of a
+    table has the columns of the batches before it.
+
+    :param term_interp: an iterator that generates interpreted terms, usually a TermInterpreter
+    :param batch_size: Maximum number of rows in a batch
+    :param sections: Optional names of the sections to export. Records at the top of the document, before
+    any Section term, are in the 'root' section.
+    """
+    from .parser import TermEventGenerator, START_RECORD, END_RECORD, CHILD, END_SECTION
+
+    sections = set(s.lower() for s in sections) if sections else None
+
+    builders = OrderedDict()  # By (section, record term)
+    open_records = []
+    row, builder = None, None  # The row of the last record started, for its children
+
+    for event, payload in TermEventGenerator(term_interp):
+
+        if event == START_RECORD:
+            t = payload
+            parent = open_records[-1] if open_records else None
+            open_records.append(t)
+
+            if sections is not None and t.section not in sections:
+                row, builder = None, None
+                continue
+
+            key = (t.section, t.record_term)
+
+            try:
+                builder = builders[key]
+            except KeyError:
+                value_name = t.term_value_name if t.term_value_name and t.term_value_name != '@value' else 'value'
+                builder = builders[key] = _TableBuilder(t.section, t.record_term, value_name)
+
+            if len(builder.rows) >= batch_size:
+                yield builder.flush()
+
+            row = builder.start(t, parent)
+
+        elif event == CHILD:
+            if row is not None:
+                row[builder.add_column(payload.record_term)] = payload.value
+
+        elif event == END_RECORD:
+            open_records.pop()
+
+        elif event == END_SECTION:
+            row, builder = None, None
+
+            for key in [k for k in builders if k[0] == payload]:
+                b = builders.pop(key)
+                if b.rows:
+                    yield b.flush()
+
+    for b in builders.values():
+        if b.rows:
+            yield b.flush()
+
+
+def _open_writer(pa, format, path, schema):
+    if format == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.ParquetWriter(path, schema)
+    else:
+        return pa.ipc.new_file(path, schema)
+
+
+def _read_tables(pa, format, path):
+    """Yield the row groups or record batches of a file, as tables"""
+
+    if format == 'parquet':
+        import pyarrow.parquet as pq
+        f = pq.ParquetFile(path)
+
+        for i in range(f.num_row_groups):
+            yield f.read_row_group(i)
+    else:
+        with pa.memory_map(path) as source:
+            reader = pa.ipc.open_file(source)
+
+            for i in range(reader.num_record_batches):
+                yield pa.Table.from_batches([reader.get_batch(i)])
+
+
+def _widen(pa, table, schema):
+    """Return the table with the columns of schema, with nulls for the columns it doesn't have"""
+
+    return pa.Table.from_arrays([table.column(f.name) if f.name in table.schema.names else pa.nulls(len(table), f.type)
+                                 for f in schema], schema=schema)
+
+
+def write_batches(batches, directory, format='parquet'):
+    """Write batches to a file for each table, in directory, and return a dict of the file paths by table
+    name. When a batch has columns that the earlier batches of its table don't, the rows already written
+    are copied to a new file with the wider schema, with nulls for the new columns. Requires pyarrow.
+
+    :param batches: Iterable of ColumnBatches
+    :param directory: Directory for the files, which is created if it doesn't exist
+    :param format: 'parquet' or 'arrow', for the Arrow IPC file format
+    """
+    import os
+    from os.path import join
+
+    if format not in FORMATS:
+        raise ValueError('Unknown format: {}. Expected one of: {}'.format(format, ', '.join(sorted(FORMATS))))
+
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise ImportError('Writing {} files requires pyarrow'.format(format))
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    def make_schema(columns):
+        return pa.schema([(c, pa.int64() if c == 'row' else pa.string()) for c in columns])
+
+    writers = OrderedDict()  # [writer, schema, path], by table name
+
+    try:
+        for batch in batches:
+
+            if batch.name not in writers:
+                path = join(directory, batch.name + FORMATS[format])
+                schema = make_schema(batch.columns)
+                writers[batch.name] = [_open_writer(pa, format, path, schema), schema, path]
+
+            entry = writers[batch.name]
+            writer, schema, path = entry
+
+            if any(c not in schema.names for c in batch.columns):
+                schema = make_schema([c for c in schema.names if c != 'row'] +
+                                     [c for c in batch.columns if c not in schema.names and c != 'row'] + ['row'])
+                tmp = path + '.tmp'
+
+                writer.close()
+                entry[0] = None
+                os.rename(path, tmp)
+
+                writer = entry[0] = _open_writer(pa, format, path, schema)
+                entry[1] = schema
+
+                for table in _read_tables(pa, format, tmp):
+                    writer.write_table(_widen(pa, table, schema))
+
+                os.remove(tmp)
+
+            arrays = [pa.array(batch.columns.get(f.name, [None] * len(batch)), type=f.type) for f in schema]
+
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+    finally:
+        for writer, schema, path in writers.values():
+            if writer is not None:
+                writer.close()
+
+    return {name: path for name, (writer, schema, path) in writers.items()}
+
+
+def export(term_interp, directory, format='parquet', batch_size=DEFAULT_BATCH_SIZE, sections=None):
+    """Write the records of the sections of a document to a file per table. See section_batches() and
+    write_batches() """
+
+    return write_batches(section_batches(term_interp, batch_size, sections), directory, format)
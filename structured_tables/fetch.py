@@ -0,0 +1,612 @@
+# Copyright (c) 2016 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Fetching remote documents. All of the row generators and caches fetch URLs through the fetcher
+returned by get_fetcher(), which applies a timeout to every request, and can fetch documents
+in background threads so the Declare and Include documents referenced by a file are downloaded
+concurrently, before the parser needs them.
+
+The fetcher keeps pooled keep-alive connections to each host, and can keep the responses in a
+DiskCache, which honors the ETag, Last-Modified and Cache-Control headers. Requests to hosts that are
+reached through a proxy, set in the http_proxy or https_proxy environment variables, are made with
+urllib instead, and aren't pooled.
+
+A process that is forked after fetching, like a pre-forking server's workers, doesn't use the connections
+or prefetch threads of its parent: the fetcher drops them the first time it is used in the child.
+
+"""
+
+import os
+from threading import Lock
+
+DEFAULT_TIMEOUT = 30  # Seconds
+DEFAULT_WORKERS = 8
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024  # Bytes
+MAX_IDLE_CONNECTIONS = 4  # Per host
+MAX_REDIRECTS = 5
+
+# Response headers that are kept in the disk cache and returned by Fetcher.head()
+CACHED_HEADERS = ('ETag', 'Last-Modified', 'Cache-Control', 'Content-Type')
+
+
+def _parse_cache_control(value):
+    """Return a dict of the directives in a Cache-Control header"""
+
+    d = {}
+
+    for part in (value or '').split(','):
+        if '=' in part:
+            k, v = part.split('=', 1)
+            d[k.strip().lower()] = v.strip().strip('"')
+        elif part.strip():
+            d[part.strip().lower()] = True
+
+    return d
+
+
+class DiskCache(object):
+    """A size-bounded cache of HTTP responses in a directory. Each response is stored as a body file and
+    a JSON metadata file, named by the hash of the url. When the total size of the bodies exceeds max_size,
+    the least recently used responses are removed. """
+
+    def __init__(self, directory, max_size=DEFAULT_CACHE_SIZE):
+        import os
+
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = Lock()
+        self._size = None  # Total size of the bodies; counted when first needed, then kept up to date
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, url, ext):
+        from hashlib import sha1
+        from os.path import join
+
+        return join(self.directory, sha1(url.encode('utf8')).hexdigest() + ext)
+
+    def get(self, url):
+        """Return the metadata dict for a cached url, or None. The metadata has the url, the cached
+        headers, the size of the body, and the time until which the response is fresh. """
+        import json
+        import os
+
+        path = self._path(url, '.json')
+
+        try:
+            with open(path) as f:
+                meta = json.load(f)
+            os.utime(path, None)  # Mark as recently used
+        except (IOError, OSError, ValueError):
+            return None
+
+        return meta if meta.get('url') == url else None
+
+    def read(self, url):
+        """Return the cached body of a url, or None"""
+
+        try:
+            with open(self._path(url, '.body'), 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def is_fresh(self, meta):
+        """Return True if a response can be used without revalidating it"""
+        import time
+
+        return meta is not None and meta.get('expires', 0) > time.time()
+
+    def _meta(self, url, headers, size):
+        import time
+
+        cc = _parse_cache_control(headers.get('Cache-Control'))
+
+        try:
+            max_age = 0 if 'no-cache' in cc else int(cc.get('max-age', 0))
+        except ValueError:
+            max_age = 0
+
+        return {
+            'url': url,
+            'headers': headers,
+            'size': size,
+            'expires': time.time() + max_age
+        }
+
+    def _write(self, path, data, mode):
+        """Write through a temporary file, so readers never see a partial file"""
+        import os
+        import tempfile
+
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+
+        with os.fdopen(fd, mode) as f:
+            f.write(data)
+
+        os.rename(tmp, path)
+
+    def put(self, url, headers, body):
+        """Store a response, unless its Cache-Control header forbids it.
+
+        :param url: The url of the response
+        :param headers: Dict of the response headers named in CACHED_HEADERS
+        :param body: Body of the response
+        """
+        import json
+
+        if 'no-store' in _parse_cache_control(headers.get('Cache-Control')):
+            self.remove(url)
+            return
+
+        old_size = self._body_size(url)
+
+        self._write(self._path(url, '.body'), body, 'wb')
+        self._write(self._path(url, '.json'), json.dumps(self._meta(url, headers, len(body))), 'w')
+
+        if self._add_size(len(body) - old_size):
+            self._evict()
+
+    def refresh(self, url, headers):
+        """Update the metadata for a response that has been revalidated with a 304 response"""
+        import json
+
+        meta = self.get(url)
+
+        if meta is None:
+            return
+
+        merged = dict(meta['headers'])
+        merged.update(headers)
+
+        self._write(self._path(url, '.json'), json.dumps(self._meta(url, merged, meta['size'])), 'w')
+
+    def remove(self, url):
+        import os
+
+        size = self._body_size(url)
+
+        for ext in ('.json', '.body'):
+            try:
+                os.remove(self._path(url, ext))
+            except OSError:
+                pass
+
+        if size:
+            self._add_size(-size)
+
+    def _body_size(self, url):
+        import os
+
+        try:
+            return os.path.getsize(self._path(url, '.body'))
+        except OSError:
+            return 0
+
+    def _add_size(self, n):
+        """Add n bytes to the total size of the bodies, and return True if it is over max_size. The directory
+        is only listed to count the size the first time, and when responses have to be evicted. """
+        import os
+
+        with self._lock:
+            if self._size is None:
+                self._size = 0
+
+                for fn in os.listdir(self.directory):
+                    if fn.endswith('.body'):
+                        try:
+                            self._size += os.path.getsize(os.path.join(self.directory, fn))
+                        except OSError:  # Removed by another process
+                            pass
+            else:
+                self._size += n
+
+            return self._size > self.max_size
+
+    def _evict(self):
+        """Remove the least recently used responses until the bodies fit in max_size. The total size is
+        recounted, so it is corrected if other processes share the directory. """
+        import os
+        from os.path import join
+
+        with self._lock:
+            entries = []
+
+            for fn in os.listdir(self.directory):
+                if fn.endswith('.json'):
+                    key = fn[:-5]
+                    try:
+                        entries.append((os.path.getmtime(join(self.directory, fn)), key,
+                                        os.path.getsize(join(self.directory, key + '.body'))))
+                    except OSError:
+                        pass
+
+            total = sum(e[2] for e in entries)
+
+            for mtime, key, size in sorted(entries):
+                if total <= self.max_size:
+                    break
+
+                for ext in ('.json', '.body'):
+                    try:
+                        os.remove(join(self.directory, key + ext))
+                    except OSError:
+                        pass
+
+                total -= size
+
+            self._size = total
+
+
+class Fetcher(object):
+    """Fetch the bodies of URLs, either immediately or in a pool of background threads. """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, workers=DEFAULT_WORKERS, cache=None):
+        """
+
+        :param timeout: Seconds to wait for a response, or for a prefetch to complete
+        :param workers: Number of threads for prefetching
+        :param cache: A DiskCache for responses, or the path to a directory for one.
+        :return:
+        """
+
+        self.timeout = timeout
+        self._workers = workers
+        self._pool = None  # ThreadPool, created with the first prefetch
+        self._pending = {}  # Prefetches that haven't been used yet
+        self._lock = Lock()
+
+        self._connections = {}  # Idle keep-alive connections, by scheme and host
+        self.connections_opened = 0
+        self._pid = os.getpid()  # The process the connections and threads belong to
+
+        from six import string_types
+
+        self.cache = DiskCache(cache) if isinstance(cache, string_types) else cache
+
+    def _check_pid(self):
+        """Drop the connections, threads and prefetches inherited from a parent process, without closing them,
+        which would affect the parent. Must hold the lock"""
+
+        pid = os.getpid()
+
+        if pid != self._pid:
+            self._pid = pid
+            self._connections = {}
+            self._pool = None
+            self._pending = {}
+
+    def _connection(self, scheme, netloc, timeout):
+        """Return an idle connection to a host, or a new one. The second value is true for reused connections"""
+        from six.moves import http_client
+
+        with self._lock:
+            self._check_pid()
+
+            idle = self._connections.get((scheme, netloc))
+
+            if idle:
+                conn = idle.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+
+                return conn, True
+
+            self.connections_opened += 1
+
+        if scheme == 'https':
+            return http_client.HTTPSConnection(netloc, timeout=timeout), False
+        else:
+            return http_client.HTTPConnection(netloc, timeout=timeout), False
+
+    def _release(self, scheme, netloc, conn):
+        with self._lock:
+            idle = self._connections.setdefault((scheme, netloc), [])
+
+            if len(idle) < MAX_IDLE_CONNECTIONS:
+                idle.append(conn)
+                return
+
+        conn.close()
+
+    def _request(self, method, url, headers, timeout, redirects=MAX_REDIRECTS):
+        """Make a request on a pooled connection, following redirects.
+
+        :return: A tuple of the response status, a dict of the response headers in CACHED_HEADERS, and the body.
+        """
+        import socket
+        from six.moves import http_client
+        from six.moves.urllib.parse import urlsplit, urljoin
+        from .parser import IncludeError
+        from .metrics import timed
+
+        parts = urlsplit(url)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+
+        if self._proxied(parts.scheme, parts.netloc):
+            return self._urllib_request(method, url, headers, timeout)
+
+        with timed('fetch'):
+            while True:
+                conn, reused = self._connection(parts.scheme, parts.netloc, timeout)
+
+                try:
+                    conn.request(method, path, headers=headers)
+                    resp = conn.getresponse()
+                    body = resp.read()
+                except socket.timeout as e:
+                    conn.close()
+                    raise IncludeError("Timed out after {}s fetching url: {}".format(timeout, url))
+                except (http_client.HTTPException, socket.error) as e:
+                    conn.close()
+
+                    if reused:
+                        continue  # The server probably closed the idle connection, so try a new one
+
+                    raise IncludeError("Failed to fetch url: {}: {}".format(url, e))
+
+                if resp.will_close:
+                    conn.close()
+                else:
+                    self._release(parts.scheme, parts.netloc, conn)
+
+                break
+
+        if resp.status in (301, 302, 303, 307, 308) and resp.getheader('Location'):
+            if not redirects:
+                raise IncludeError("Too many redirects fetching url: {}".format(url))
+
+            return self._request(method, urljoin(url, resp.getheader('Location')), headers, timeout, redirects - 1)
+
+        resp_headers = {}
+        for h in CACHED_HEADERS:
+            if resp.getheader(h) is not None:
+                resp_headers[h] = resp.getheader(h)
+
+        return resp.status, resp_headers, body
+
+    @staticmethod
+    def _proxied(scheme, netloc):
+        """Return True if requests to a host should go through a proxy set in the http_proxy or https_proxy
+        environment variables"""
+        from six.moves.urllib.request import getproxies, proxy_bypass
+
+        return scheme in getproxies() and not proxy_bypass(netloc)
+
+    def _urllib_request(self, method, url, headers, timeout):
+        """Make a request with urllib, which handles proxies, for hosts that are reached through one. The
+        connections are not pooled. Returns the same tuple as _request()"""
+        import socket
+        from six.moves.urllib.request import Request, urlopen
+        from six.moves.urllib.error import HTTPError, URLError
+        from .parser import IncludeError
+        from .metrics import timed
+
+        req = Request(url, headers=headers)
+        req.get_method = lambda: method
+
+        with timed('fetch'):
+            try:
+                try:
+                    resp = urlopen(req, timeout=timeout)
+                except HTTPError as e:
+                    resp = e  # A response with an error status, or a 304
+
+                try:
+                    body = resp.read()
+                finally:
+                    resp.close()
+
+            except socket.timeout:
+                raise IncludeError("Timed out after {}s fetching url: {}".format(timeout, url))
+            except (URLError, socket.error) as e:
+                if isinstance(getattr(e, 'reason', None), socket.timeout):
+                    raise IncludeError("Timed out after {}s fetching url: {}".format(timeout, url))
+
+                raise IncludeError("Failed to fetch url: {}: {}".format(url, e))
+
+        info = resp.info()
+
+        resp_headers = {}
+        for h in CACHED_HEADERS:
+            if info.get(h) is not None:
+                resp_headers[h] = info.get(h)
+
+        return resp.getcode(), resp_headers, body
+
+    def _get(self, url, timeout):
+        """Fetch the body of a url, using the disk cache if there is one"""
+        from .parser import IncludeError
+
+        meta = self.cache.get(url) if self.cache else None
+
+        if meta is not None and self.cache.is_fresh(meta):
+            body = self.cache.read(url)
+            if body is not None:
+                return body
+
+        headers = {}
+
+        if meta is not None:
+            if meta['headers'].get('ETag'):
+                headers['If-None-Match'] = meta['headers']['ETag']
+            if meta['headers'].get('Last-Modified'):
+                headers['If-Modified-Since'] = meta['headers']['Last-Modified']
+
+        status, resp_headers, body = self._request('GET', url, headers, timeout)
+
+        if status == 304 and meta is not None:
+            cached = self.cache.read(url)
+
+            if cached is not None:
+                self.cache.refresh(url, resp_headers)
+                return cached
+
+            # The body was evicted between the two reads, so fetch it again
+            status, resp_headers, body = self._request('GET', url, {}, timeout)
+
+        if status != 200:
+            raise IncludeError("Failed to fetch url: {}: HTTP status {}".format(url, status))
+
+        if self.cache:
+            self.cache.put(url, resp_headers, body)
+
+        return body
+
+    def fetch(self, url, timeout=None):
+        """Return the body of a url. If the url is being prefetched, wait for the prefetch to complete """
+        from multiprocessing import TimeoutError
+        from .parser import IncludeError
+
+        timeout = timeout or self.timeout
+
+        with self._lock:
+            self._check_pid()
+            pending = self._pending.pop(url, None)
+
+        if pending is None:
+            return self._get(url, timeout)
+
+        try:
+            return pending.get(timeout)
+        except TimeoutError:
+            raise IncludeError("Timed out after {}s fetching url: {}".format(timeout, url))
+
+    def open(self, url, timeout=None):
+        """Return a file-like object for the body of a url"""
+        from io import BytesIO, StringIO
+        import sys
+
+        body = self.fetch(url, timeout)
+
+        if sys.version_info[0] >= 3:
+            f = StringIO(body.decode('utf-8'), newline='')
+        else:
+            f = BytesIO(body)
+
+        f.name = url  # to be symmetric with files.
+
+        return f
+
+    def head(self, url, timeout=None):
+        """Return a dict of the headers of a url named in CACHED_HEADERS, or None if the request fails. Fresh
+        responses in the disk cache are returned without a request"""
+        from .parser import IncludeError
+
+        meta = self.cache.get(url) if self.cache else None
+
+        if meta is not None and self.cache.is_fresh(meta):
+            return meta['headers']
+
+        try:
+            status, headers, body = self._request('HEAD', url, {}, timeout or self.timeout)
+        except IncludeError:
+            return None
+
+        return headers if status == 200 else None
+
+    def prefetch(self, url):
+        """Start fetching a url in the background, if it isn't already being fetched. The next
+        call to fetch() or open() for the url uses the result, so a parse that prefetches urls should
+        discard() the ones it didn't use when it ends. """
+        from multiprocessing.pool import ThreadPool
+
+        with self._lock:
+            self._check_pid()
+
+            if url in self._pending:
+                return
+
+            if self._pool is None:
+                self._pool = ThreadPool(self._workers)
+
+            self._pending[url] = self._pool.apply_async(self._get, (url, self.timeout))
+
+    def discard(self, urls):
+        """Discard the prefetched results of urls that haven't been used, such as Declare documents that
+        were found in a cache, so a later fetch() doesn't get an old body"""
+
+        with self._lock:
+            for url in urls:
+                self._pending.pop(url, None)
+
+    def close_idle(self):
+        """Close the idle connections, such as before forking processes that would otherwise share them"""
+
+        with self._lock:
+            self._check_pid()
+
+            for idle in self._connections.values():
+                for conn in idle:
+                    conn.close()
+
+            self._connections = {}
+
+    def close(self):
+        """Stop the prefetch threads, discard prefetched results and close idle connections"""
+
+        with self._lock:
+            self._check_pid()
+
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool = None
+
+            self._pending = {}
+
+        self.close_idle()
+
+
+_fetcher = Fetcher()
+
+
+def get_fetcher():
+    """Return the fetcher used by the row generators and caches"""
+    return _fetcher
+
+
+def set_fetcher(fetcher):
+    """Replace the fetcher used by the row generators and caches. Returns the previous fetcher."""
+    global _fetcher
+
+    previous, _fetcher = _fetcher, fetcher
+
+    return previous
+
+
+def prefetch_refs(row_gen, fetcher=None):
+    """Scan the rows of a local file for Declare and Include terms that reference remote documents,
+    and start prefetching them. Only row generators for local files are scanned, because they can be
+    read again; other sources, like streams, may only be read once, and remote documents would be
+    fetched twice.
+
+    :param row_gen: A row generator, with a path property
+    :param fetcher: The fetcher to prefetch with. Defaults to the one returned by get_fetcher()
+    :return: The list of urls that are being prefetched, which should be passed to the fetcher's discard()
+    when the parse ends.
+    """
+    from .parser import CsvPathRowGenerator, BufferedCsvRowGenerator
+
+    fetcher = fetcher or get_fetcher()
+
+    if (not isinstance(row_gen, (CsvPathRowGenerator, BufferedCsvRowGenerator)) or
+            not row_gen.path or row_gen.path.startswith('http')):
+        return []
+
+    urls = []
+
+    for row in row_gen:
+        term = row[0].strip().lower() if row else None
+
+        if len(row) > 1 and term in ('declare', 'include'):
+            # Normalize the same way as TermInterpreter.handle_declare()
+            ref = row[1].strip().strip('/') if term == 'declare' else row[1].strip()
+
+            if ref.startswith('http'):
+                urls.append(ref)
+                fetcher.prefetch(ref)
+
+    return urls
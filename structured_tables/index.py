@@ -0,0 +1,384 @@
+# Copyright (c) 2016 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+A persistent index of the interpreted terms of many documents, in SQLite, so questions like "which
+documents have a Datafile with a grain of Tract" can be answered without parsing the documents again:
+
+    index = TermIndex('terms.db')
+    index.update(['metadata/'])
+    index.find('datafile', grain='Tract')
+
+Updates are incremental. A file is parsed again only if its modification time or size has changed, and
+its content hash is different from when it was indexed, or if one of the Declare or Include documents it
+used has changed, as the parse result cache decides.
+
+Each term is linked to its parent record, the way link_terms() links them, so the arguments of a record,
+like the grain of a Datafile, and nested records, like the Columns of a Table, can be queried with it.
+"""
+
+import os
+import sqlite3
+
+from six import text_type, binary_type
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    mtime REAL,
+    size INTEGER,
+    hash TEXT,
+    indexed REAL,
+    n_terms INTEGER,
+    error TEXT,
+    deps TEXT,
+    dep_versions TEXT
+);
+CREATE TABLE IF NOT EXISTS terms (
+    id INTEGER PRIMARY KEY,
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    parent_id INTEGER,
+    section TEXT,
+    parent_term TEXT,
+    record_term TEXT,
+    value TEXT,
+    row INTEGER,
+    col INTEGER
+);
+CREATE INDEX IF NOT EXISTS terms_record_value ON terms (record_term, value);
+CREATE INDEX IF NOT EXISTS terms_parent ON terms (parent_id, record_term);
+CREATE INDEX IF NOT EXISTS terms_file ON terms (file_id);
+"""
+
+FILE_EXTENSIONS = ('.csv',)
+
+# Columns added to the files table since it was created, for indexes made by earlier versions
+ADDED_COLUMNS = (('deps', 'TEXT'), ('dep_versions', 'TEXT'))
+
+
+def _text(v):
+    """Convert a value to text for SQLite, which rejects non-ASCII byte strings on Python 2"""
+
+    if v is None or isinstance(v, text_type):
+        return v
+
+    if isinstance(v, binary_type):
+        return v.decode('utf-8', 'replace')
+
+    return text_type(v)
+
+
+def _error_text(e):
+    """Return the message of an exception as text. On Python 2, the message may be unicode or bytes"""
+
+    try:
+        return text_type(e)
+    except UnicodeError:
+        return _text(binary_type(e))
+
+
+def file_hash(path):
+    from hashlib import sha1
+
+    h = sha1()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def dep_versions(refs, memo=None):
+    """Return a string of the versions of the Declare and Include documents at refs, like
+    ResultCache.versions(), remembering the version of each ref in the dict memo, if it is given"""
+    import json
+    from .cache import ref_version
+
+    if memo is None:
+        memo = {}
+
+    versions = []
+
+    for ref in refs:
+        if ref not in memo:
+            memo[ref] = ref_version(ref)
+
+        versions.append(memo[ref])
+
+    return json.dumps(versions)
+
+
+def find_files(paths, extensions=FILE_EXTENSIONS):
+    """Yield the absolute paths of the files, and of the files with the extensions in the directories,
+    in paths"""
+    from os.path import isdir, join, abspath
+
+    for path in paths:
+        if isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+
+                for fn in sorted(files):
+                    if fn.lower().endswith(extensions):
+                        yield abspath(join(root, fn))
+        else:
+            yield abspath(path)
+
+
+class TermIndex(object):
+    """An index of the interpreted terms of documents, in a SQLite database"""
+
+    def __init__(self, path, declare_cache=None):
+        """
+
+        :param path: Path of the SQLite database, which is created if it doesn't exist, or ':memory:'
+        :param declare_cache: A DeclareDocCache for the Declare documents of the indexed files. Defaults to
+        the process-wide structured_tables.cache.declare_cache
+        :return:
+        """
+
+        self.path = path
+        self._declare_cache = declare_cache
+
+        self._conn = sqlite3.connect(path)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA foreign_keys = ON')
+        self._conn.execute('PRAGMA journal_mode = WAL')
+        self._conn.execute('PRAGMA synchronous = NORMAL')
+        self._conn.executescript(SCHEMA)
+
+        columns = set(r['name'] for r in self._conn.execute('PRAGMA table_info(files)'))
+
+        with self._conn:
+            for name, type_ in ADDED_COLUMNS:
+                if name not in columns:
+                    self._conn.execute('ALTER TABLE files ADD COLUMN {} {}'.format(name, type_))
+
+    def close(self):
+        self._conn.close()
+
+    def _terms(self, path):
+        """Return the interpreted terms of a file, the errors, and the resolved refs of the Declare and Include
+        documents it used"""
+        from .cache import BatchDeclareCache
+        from .parser import CsvPathRowGenerator, TermGenerator, TermInterpreter
+
+        declare_cache = BatchDeclareCache(self._declare_cache)  # To record the Declare documents
+        term_gen = TermGenerator(CsvPathRowGenerator(path))
+        ti = TermInterpreter(term_gen, declare_cache=declare_cache)
+
+        terms = list(ti)
+
+        return terms, ti.errors, declare_cache.refs + [r for r in term_gen.includes if r not in declare_cache.refs]
+
+    def index_file(self, path, mtime=None, size=None, hash=None, versions=None):
+        """Parse a file and replace its terms in the index. Returns the number of terms. If the file can't be
+        parsed, it is indexed with no terms and the error, and the ParserError is raised
+
+        :param versions: Optional dict of the versions of Declare and Include documents by ref, for dep_versions()
+        """
+        import json
+        from time import time
+        from .parser import ParserError, NO_TERM, ELIDED_TERM
+
+        path = os.path.abspath(path)
+
+        if mtime is None:
+            st = os.stat(path)
+            mtime, size = st.st_mtime, st.st_size
+
+        hash = hash or file_hash(path)
+
+        failure = None
+
+        try:
+            terms, errors, refs = self._terms(path)
+            error = '; '.join(_error_text(e) for e in errors) or None
+        except ParserError as e:
+            terms, error, failure, refs = [], _error_text(e), e, []
+
+        refs = [_text(r) for r in refs]
+
+        with self._conn:
+            c = self._conn.cursor()
+
+            c.execute('DELETE FROM files WHERE path = ?', (_text(path),))
+            c.execute('INSERT INTO files (path, mtime, size, hash, indexed, n_terms, error, deps, dep_versions) '
+                      'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                      (_text(path), mtime, size, hash, time(), len(terms), error, json.dumps(refs),
+                       dep_versions(refs, versions)))
+
+            file_id = c.lastrowid
+
+            # Assign the ids here, rather than inserting the terms one at a time to get them, so the parents
+            # can be set with executemany. The transaction holds the write lock, so the ids can't be taken.
+            next_id = c.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM terms').fetchone()[0]
+
+            last_term_map = {}  # Ids of the last terms by record term, as in link_terms()
+            rows = []
+
+            for i, t in enumerate(terms, next_id):
+                parent_id = last_term_map.get(t.parent_term)
+
+                if t.parent_term == ELIDED_TERM:
+                    parent_id = last_term_map.get(ELIDED_TERM)
+
+                if not t.is_arg_child and t.parent_term != ELIDED_TERM:
+                    last_term_map[ELIDED_TERM] = i
+                    last_term_map[t.record_term] = i
+
+                rows.append((i, file_id, parent_id, _text(t.section),
+                             None if t.parent_term == NO_TERM else _text(t.parent_term), _text(t.record_term),
+                             _text(t.value), t.row, t.col))
+
+            c.executemany('INSERT INTO terms (id, file_id, parent_id, section, parent_term, record_term, value, '
+                          'row, col) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+        if failure is not None:
+            raise failure
+
+        return len(terms)
+
+    def update(self, paths, prune=False):
+        """Index the files, and the CSV files in the directories, in paths, if they are new or have changed.
+        Returns a dict of the number of files that were added, updated, unchanged, removed and failed.
+
+        :param paths: Paths of files and directories
+        :param prune: If true, remove files in the index that are in the directories but no longer exist
+        """
+        import json
+        import logging
+
+        counts = dict(added=0, updated=0, unchanged=0, removed=0, failed=0)
+
+        known = {r['path']: r for r in self._conn.execute('SELECT path, mtime, size, hash, deps, dep_versions '
+                                                          'FROM files')}
+
+        versions = {}  # Versions of the Declare and Include documents, which many files share
+
+        def deps_unchanged(r):
+            return dep_versions(json.loads(r['deps'] or '[]'), versions) == (r['dep_versions'] or '[]')
+
+        for path in find_files(paths):
+            key = _text(path)
+
+            try:
+                st = os.stat(path)
+            except OSError as e:
+                logging.warning(u'Failed to index {}: {}'.format(_text(path), _error_text(e)))
+                counts['failed'] += 1
+                continue
+
+            old = known.get(key)
+
+            if old is not None and not deps_unchanged(old):
+                old_hash = None  # Parse it again
+            elif old is not None and old['mtime'] == st.st_mtime and old['size'] == st.st_size:
+                counts['unchanged'] += 1
+                continue
+            else:
+                old_hash = old['hash'] if old is not None else None
+
+            h = file_hash(path)
+
+            if old_hash == h:
+                # Touched, but not changed
+                with self._conn:
+                    self._conn.execute('UPDATE files SET mtime = ?, size = ? WHERE path = ?',
+                                       (st.st_mtime, st.st_size, key))
+                counts['unchanged'] += 1
+                continue
+
+            try:
+                self.index_file(path, st.st_mtime, st.st_size, h, versions)
+            except Exception as e:  # Unreadable files, bad encodings, etc. shouldn't stop the update
+                logging.warning(u'Failed to index {}: {}'.format(_text(path), _error_text(e)))
+                counts['failed'] += 1
+                continue
+
+            counts['updated' if old is not None else 'added'] += 1
+
+        if prune:
+            dirs = [os.path.join(os.path.abspath(p), '') for p in paths if os.path.isdir(p)]
+
+            for path in known:
+                if any(path.startswith(d) for d in dirs) and not os.path.exists(path):
+                    self.remove(path)
+                    counts['removed'] += 1
+
+        return counts
+
+    def remove(self, path):
+        """Remove a file and its terms from the index"""
+
+        with self._conn:
+            self._conn.execute('DELETE FROM files WHERE path = ?', (_text(os.path.abspath(path)),))
+
+    def find(self, term, value=None, section=None, **args):
+        """Return the records of a term, as a list of dicts with the file, section, term, value and row. The
+        term is a record term, like 'datafile', or a parent and record term, like 'table.column'. Keyword
+        arguments match the arguments and child terms of the record, like grain='Tract' for a Datafile.
+
+        :param term: The record term, or the parent and record term, separated by '.'
+        :param value: Optional value of the record term
+        :param section: Optional section name
+        """
+
+        term = term.lower()
+
+        sql = ['SELECT f.path AS file, t.section, t.parent_term, t.record_term, t.value, t.row '
+               'FROM terms t JOIN files f ON f.id = t.file_id']
+        where = ['t.record_term = ?']
+        params = []
+
+        # The parameters of the joins come first in the query
+        for i, (k, v) in enumerate(sorted(args.items())):
+            sql.append('JOIN terms c{0} ON c{0}.parent_id = t.id AND c{0}.record_term = ? AND c{0}.value = ?'
+                       .format(i))
+            params.extend([_text(k.lower()), _text(v)])
+
+        if '.' in term:
+            parent_term, record_term = term.split('.', 1)
+            where.append('t.parent_term = ?')
+            params.extend([_text(record_term), _text(parent_term)])
+        else:
+            params.append(_text(term))
+
+        if value is not None:
+            where.append('t.value = ?')
+            params.append(_text(value))
+
+        if section is not None:
+            where.append('t.section = ?')
+            params.append(_text(section.lower()))
+
+        q = ' '.join(sql) + ' WHERE ' + ' AND '.join(where) + ' ORDER BY f.path, t.row, t.col'
+
+        return [self._record(r) for r in self._conn.execute(q, params)]
+
+    @staticmethod
+    def _record(r):
+        return {
+            'file': r['file'],
+            'section': r['section'],
+            'term': '.'.join(e for e in (r['parent_term'], r['record_term']) if e),
+            'value': r['value'],
+            'row': r['row']
+        }
+
+    def files(self):
+        """Return the indexed files, as a list of dicts with the path, mtime, size, hash, number of terms and
+        parse errors"""
+
+        return [dict(zip(r.keys(), r)) for r in
+                self._conn.execute('SELECT path, mtime, size, hash, n_terms, error FROM files ORDER BY path')]
+
+    def query(self, sql, params=()):
+        """Run a SQL query on the index, returning a list of dicts"""
+
+        return [dict(zip(r.keys(), r)) for r in self._conn.execute(sql, params)]
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
@@ -0,0 +1,213 @@
+# Copyright (c) 2016 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Request rate limits and admission control for the parse servers. Each client has a token bucket,
+with a rate and burst size set by the tier of its access key, and the AdmissionControl bounds the
+number of requests being handled and waiting, so excess requests are rejected early and cheaply.
+
+"""
+
+from threading import Lock, Condition
+
+UNREGISTERED = 'unregistered'
+REGISTERED = 'registered'
+AUTHORITATIVE = 'authoritative'
+
+# Requests per second, and burst size, for each tier
+DEFAULT_TIER_LIMITS = {
+    UNREGISTERED: (1, 10),
+    REGISTERED: (10, 50),
+    AUTHORITATIVE: (100, 200)
+}
+
+DEFAULT_MAX_BUCKETS = 100000  # Client buckets kept by a RateLimiter
+DEFAULT_MAX_IN_FLIGHT = 16
+DEFAULT_MAX_QUEUED = 32
+DEFAULT_QUEUE_TIMEOUT = 5  # Seconds
+
+# Atomically refill and take a token from the bucket in a Redis hash. Returns whether a token was taken,
+# and the number of tokens left, as a string, because Redis truncates Lua numbers to integers.
+REDIS_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(tokens)}
+"""
+
+
+class RateLimiter(object):
+    """Token bucket rate limits, with the buckets kept in this process. Buckets that have refilled are
+    removed, since a new bucket is full, and when there are more than max_buckets, the least recently used
+    are removed, so clients can't exhaust memory. """
+
+    def __init__(self, limits=None, clock=None, max_buckets=DEFAULT_MAX_BUCKETS):
+        """
+
+        :param limits: Dict of (requests per second, burst size), by tier. Defaults to DEFAULT_TIER_LIMITS
+        :param clock: Function that returns the time in seconds. Defaults to time.time
+        :param max_buckets: Number of client buckets to keep
+        :return:
+        """
+        import time
+        from collections import OrderedDict
+
+        self.limits = limits or DEFAULT_TIER_LIMITS
+        self._clock = clock or time.time
+        self.max_buckets = max_buckets
+        # (tokens, time of last update, time the bucket will be full), by client key, least recently updated first
+        self._buckets = OrderedDict()
+        self._lock = Lock()
+
+    def acquire(self, key, tier):
+        """Take a token from the client's bucket. Returns 0 if the request is allowed, or else the number
+        of seconds until it would be. """
+
+        rate, burst = self.limits[tier]
+        now = self._clock()
+
+        with self._lock:
+            tokens, ts, full = self._buckets.pop(key, (burst, now, now))
+            tokens = min(burst, tokens + max(0, now - ts) * rate)
+
+            allowed = tokens >= 1
+
+            if allowed:
+                tokens -= 1
+
+            self._buckets[key] = (tokens, now, now + (burst - tokens) / float(rate))
+
+            self._evict(now)
+
+        return 0 if allowed else (1 - tokens) / float(rate)
+
+    def _evict(self, now):
+        buckets = self._buckets
+
+        while buckets:
+            key = next(iter(buckets))
+
+            if buckets[key][2] <= now or len(buckets) > self.max_buckets:
+                del buckets[key]
+            else:
+                break
+
+
+class RedisRateLimiter(RateLimiter):
+    """Token bucket rate limits, with the buckets kept in Redis, so they apply across all of the servers"""
+
+    def __init__(self, client, limits=None, clock=None, prefix='structured_tables:limit:'):
+        """
+
+        :param client: A redis.StrictRedis client
+        :param prefix: Prefix for the Redis keys of the buckets
+        """
+
+        super(RedisRateLimiter, self).__init__(limits, clock)
+        self.client = client
+        self.prefix = prefix
+
+    def acquire(self, key, tier):
+        import logging
+
+        rate, burst = self.limits[tier]
+
+        try:
+            allowed, tokens = self.client.eval(REDIS_BUCKET_SCRIPT, 1, self.prefix + key, rate, burst,
+                                               self._clock())
+        except Exception as e:  # Don't turn away requests because Redis is down
+            logging.warning('Failed to check rate limit in Redis: {}'.format(e))
+            return 0
+
+        if int(allowed):
+            return 0
+
+        return (1 - float(tokens)) / rate
+
+
+class AdmissionControl(object):
+    """Bound the number of requests that are being handled, and that are waiting to be handled. When the
+    queue of waiting requests is full, or a request waits too long, it is rejected. """
+
+    def __init__(self, max_in_flight=DEFAULT_MAX_IN_FLIGHT, max_queued=DEFAULT_MAX_QUEUED,
+                 timeout=DEFAULT_QUEUE_TIMEOUT):
+        """
+
+        :param max_in_flight: Number of requests that can be handled at once
+        :param max_queued: Number of requests that can wait to be handled
+        :param timeout: Seconds a request can wait
+        :return:
+        """
+
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.timeout = timeout
+
+        self.in_flight = 0
+        self.queued = 0
+        self.rejected = 0
+
+        self._cond = Condition(Lock())
+
+    def acquire(self):
+        """Admit a request, waiting if necessary. Returns False if the request is rejected"""
+        import time
+
+        with self._cond:
+            if self.in_flight < self.max_in_flight:
+                self.in_flight += 1
+                return True
+
+            if self.queued >= self.max_queued:
+                self.rejected += 1
+                return False
+
+            self.queued += 1
+            deadline = time.time() + self.timeout
+
+            try:
+                while self.in_flight >= self.max_in_flight:
+                    remaining = deadline - time.time()
+
+                    if remaining <= 0:
+                        self.rejected += 1
+                        return False
+
+                    self._cond.wait(remaining)
+
+                self.in_flight += 1
+                return True
+            finally:
+                self.queued -= 1
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+
+def key_tier(access_key, keys):
+    """Return the tier for an access key
+
+    :param access_key: The key sent by the client, or None
+    :param keys: Dict of the configured keys, with the keys 'registered_key' and 'authoritative_key'
+    """
+
+    if access_key:
+        if access_key == keys.get('authoritative_key'):
+            return AUTHORITATIVE
+        elif access_key == keys.get('registered_key'):
+            return REGISTERED
+
+    return UNREGISTERED
@@ -0,0 +1,520 @@
+# Copyright (c) 2016 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Operational metrics for the parse servers, in the Prometheus text format. The metrics are updated in
+per-thread shards, so updates don't take a lock, and the shards are summed when the metrics are collected.
+MetricsMiddleware wraps a WSGI application to record request latency, sizes, in-flight requests and
+responses, and to serve the metrics at /metrics:
+
+    app.wsgi_app = MetricsMiddleware(app.wsgi_app)
+
+The parse service records the time spent parsing and serializing, and the number of terms parsed, and
+the fetcher records the time spent fetching remote documents, so latency can be attributed to each.
+
+The metrics are kept in the memory of each process. When the server runs in several worker processes, set
+a shared directory on the registry before the workers start, and each process writes its values to a
+file there, at most once every SHARED_INTERVAL seconds after a request and when it exits, so /metrics,
+which could be served by any worker, reports the totals of all of them:
+
+    registry.set_shared_dir('/tmp/struct_tab_metrics')
+
+Counters and histograms of workers that have exited are still included, so they don't go backwards when a
+worker is restarted. Gauges are only included for live workers.
+"""
+
+import os
+import threading
+from bisect import bisect_left
+from timeit import default_timer as timer
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = tuple(256 * 4 ** i for i in range(10))  # 256 bytes to 64MB
+SHARED_INTERVAL = 1.0  # Seconds between writes of a process's metrics to the shared directory
+
+COUNT_BUCKETS = (10, 30, 100, 300, 1000, 3000, 10000, 30000, 100000, 300000, 1000000)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + ([extra] if extra else [])
+
+    if not pairs:
+        return ''
+
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+                          for k, v in pairs) + '}'
+
+
+def _format_value(v):
+    if v == float('inf'):
+        return '+Inf'
+
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Metric(object):
+    """Base class for metrics with values kept in per-thread shards. Each shard is a dict of values by
+    tuple of label values, written only by its own thread. Shards of threads that have exited are merged
+    into a retired shard, so a server that starts a thread per request doesn't accumulate them. """
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        """
+
+        :param name: Metric name
+        :param help: Description of the metric
+        :param labels: Names of the labels
+        :return:
+        """
+
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []  # (thread, shard) pairs
+        self._retired = {}
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+
+            with self._lock:
+                self._retire()
+                self._shards.append((threading.current_thread(), shard))
+
+            return shard
+
+    def _retire(self):
+        """Merge the shards of threads that have exited into the retired shard. Must hold the lock"""
+
+        live = []
+
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                self._merge(self._retired, shard)
+
+        self._shards = live
+
+    def _merge(self, into, shard):
+        for k, v in shard.copy().items():  # dict.copy() is atomic, so the shard can't change under us
+            into[k] = into.get(k, 0) + v
+
+    def values(self):
+        """Return a dict of the values, summed over the shards, by tuple of label values"""
+
+        with self._lock:
+            self._retire()
+            total = {}
+            self._merge(total, self._retired)
+
+            for thread, shard in self._shards:
+                self._merge(total, shard)
+
+        return total
+
+    def samples(self, values=None):
+        """Yield (suffix, label values, extra label, value) for each sample, of values, or of the values
+        of this process"""
+
+        for k, v in sorted((self.values() if values is None else values).items()):
+            yield '', k, None, v
+
+    def expose(self, values=None):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.type)]
+
+        for suffix, label_values, extra, v in self.samples(values):
+            lines.append('{}{}{} {}'.format(self.name, suffix, _format_labels(self.labels, label_values, extra),
+                                            _format_value(v)))
+
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+
+class Gauge(Counter):
+    """A value that can go up and down, like the number of requests in flight"""
+
+    type = 'gauge'
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+
+class Histogram(Metric):
+    """Counts of observations in buckets, with their sum and count. Each shard value is a list of the
+    count in each bucket, not cumulative, followed by the sum and count """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        shard = self._shard()
+
+        try:
+            counts = shard[labels]
+        except KeyError:
+            counts = shard[labels] = [0] * (len(self.buckets) + 3)
+
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def _merge(self, into, shard):
+        for k, v in shard.copy().items():
+            v = list(v)
+
+            if k in into:
+                into[k] = [a + b for a, b in zip(into[k], v)]
+            else:
+                into[k] = v
+
+    def samples(self, values=None):
+
+        for k, counts in sorted((self.values() if values is None else values).items()):
+            n = 0
+
+            for bound, c in zip(self.buckets + (float('inf'),), counts):
+                n += c
+                yield '_bucket', k, ('le', _format_value(bound)), n
+
+            yield '_sum', k, None, counts[-2]
+            yield '_count', k, None, counts[-1]
+
+
+class CallbackMetric(Metric):
+    """A metric whose value is read from a function when the metrics are collected, for values that are
+    already counted elsewhere, such as cache hits. The function returns a number, or a dict of numbers by
+    tuple of label values."""
+
+    def __init__(self, name, help, f, type='gauge', labels=()):
+        super(CallbackMetric, self).__init__(name, help, labels)
+        self.f = f
+        self.type = type
+
+    def values(self):
+        v = self.f()
+
+        return v if isinstance(v, dict) else {(): v}
+
+
+def _pid_alive(pid):
+    if os.name != 'posix':  # os.kill() would end the process
+        return True
+
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        import errno
+        return e.errno == errno.EPERM
+
+    return True
+
+
+class Registry(object):
+    """A collection of metrics, by name"""
+
+    def __init__(self, shared_dir=None, interval=SHARED_INTERVAL):
+        """
+
+        :param shared_dir: Optional directory to share the metrics of several processes in. See set_shared_dir()
+        :param interval: Seconds between writes to the shared directory
+        :return:
+        """
+
+        self._metrics = {}
+        self.shared_dir = None
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._pending = None  # Pid of the process with a write scheduled, which a forked child won't be
+
+        if shared_dir:
+            self.set_shared_dir(shared_dir)
+
+    def set_shared_dir(self, path):
+        """Share the metrics of the processes that use this registry through files in a directory, which is
+        created if it doesn't exist. Files left by an earlier server are removed, so call this once, in the
+        parent process, before the workers are started."""
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        for fn in os.listdir(path):
+            if fn.endswith('.json'):
+                os.remove(os.path.join(path, fn))
+
+        if self.shared_dir is None:
+            import atexit
+            atexit.register(self._flush_at_exit)
+
+        self.shared_dir = path
+
+    def register(self, metric):
+        """Add a metric, replacing any metric with the same name. Returns the metric"""
+
+        self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name):
+        return self._metrics[name]
+
+    def write_shared(self):
+        """Write the values of this process to the shared directory, if there is one"""
+        import json
+
+        if self.shared_dir is None:
+            return
+
+        pid = os.getpid()
+
+        d = {name: [[list(k), v] for k, v in m.values().items()] for name, m in self._metrics.items()}
+
+        # Write to a file of each thread, then rename it, so readers never see a partly written file
+        path = os.path.join(self.shared_dir, '{}.json'.format(pid))
+        tmp = '{}.{}.tmp'.format(path, threading.current_thread().ident)
+
+        with open(tmp, 'w') as f:
+            json.dump(d, f)
+
+        os.rename(tmp, path)
+
+    def flush(self):
+        """Write the values of this process to the shared directory, logging, rather than raising, errors"""
+
+        self._pending = None
+
+        try:
+            self.write_shared()
+        except (IOError, OSError) as e:
+            import logging
+            logging.warning('Failed to write shared metrics: {}'.format(e))
+
+    def _flush_at_exit(self):
+        if self.shared_dir is not None and os.path.isdir(self.shared_dir):  # The parent may have removed it
+            self.flush()
+
+    def changed(self):
+        """Schedule a write of the values to the shared directory, if there is one and a write isn't already
+        scheduled. Called after each request, so it only compares the pid when a write is scheduled"""
+
+        if self.shared_dir is None:
+            return
+
+        pid = os.getpid()
+
+        if self._pending == pid:
+            return
+
+        with self._lock:
+            if self._pending != pid:
+                self._pending = pid
+                t = threading.Timer(self.interval, self.flush)
+                t.daemon = True
+                t.start()
+
+    def _shared_values(self):
+        """Return the values of all of the processes in the shared directory, as a dict of values by metric name"""
+        import json
+
+        totals = {}
+
+        for fn in os.listdir(self.shared_dir):
+            if not fn.endswith('.json'):
+                continue
+
+            try:
+                with open(os.path.join(self.shared_dir, fn)) as f:
+                    d = json.load(f)
+            except (IOError, OSError, ValueError):  # Removed, or from an older version
+                continue
+
+            alive = _pid_alive(int(fn.split('.')[0]))
+
+            for name, values in d.items():
+                m = self._metrics.get(name)
+
+                if m is None or (m.type == 'gauge' and not alive):
+                    continue
+
+                m._merge(totals.setdefault(name, {}), {tuple(k): v for k, v in values})
+
+        return totals
+
+    def expose(self):
+        """Return all of the metrics in the Prometheus text format. With a shared directory, the values are
+        the totals of all of the processes"""
+
+        if self.shared_dir is None:
+            return ''.join(m.expose() + '\n' for name, m in sorted(self._metrics.items()))
+
+        self.write_shared()
+        totals = self._shared_values()
+
+        return ''.join(m.expose(totals.get(name, {})) + '\n' for name, m in sorted(self._metrics.items()))
+
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.register(Histogram(
+    'structured_tables_request_seconds', 'Time to handle a request, including writing the response',
+    ('endpoint',)))
+
+REQUEST_BYTES = registry.register(Histogram(
+    'structured_tables_request_bytes', 'Size of request bodies', ('endpoint',), SIZE_BUCKETS))
+
+RESPONSE_BYTES = registry.register(Histogram(
+    'structured_tables_response_bytes', 'Size of response bodies', ('endpoint',), SIZE_BUCKETS))
+
+RESPONSES = registry.register(Counter(
+    'structured_tables_responses_total', 'Responses, by endpoint and status code', ('endpoint', 'code')))
+
+IN_FLIGHT = registry.register(Gauge(
+    'structured_tables_requests_in_flight', 'Requests being handled'))
+
+ERRORS = registry.register(Counter(
+    'structured_tables_errors_total', 'Errors, by exception class, including errors reported in parse results',
+    ('class',)))
+
+STAGE_SECONDS = registry.register(Histogram(
+    'structured_tables_stage_seconds', 'Time spent in each stage of handling a parse request: parse, '
+                                       'serialize or fetch', ('stage',)))
+
+TERMS = registry.register(Histogram(
+    'structured_tables_terms_parsed', 'Terms parsed per document', buckets=COUNT_BUCKETS))
+
+
+def _cache_counts(name, attr):
+    """Return a function for a CallbackMetric that reads the hits or misses of the caches"""
+
+    def f():
+        from . import cache, service
+
+        caches = {'declare': cache.declare_cache, 'fragment': cache.fragment_cache,
+                  'result': service._result_cache}
+
+        return {(k,): getattr(c, attr) for k, c in caches.items() if c is not None}
+
+    return CallbackMetric(name, 'Cache {}, by cache'.format(attr), f, 'counter', ('cache',))
+
+
+registry.register(_cache_counts('structured_tables_cache_hits_total', 'hits'))
+registry.register(_cache_counts('structured_tables_cache_misses_total', 'misses'))
+
+
+def record_errors(errors):
+    """Count a list of exceptions, such as the errors of a TermInterpreter, by class"""
+
+    for e in errors:
+        ERRORS.inc(labels=(e.__class__.__name__,))
+
+
+class timed(object):
+    """Context manager that records the time of the block in STAGE_SECONDS, for a stage"""
+
+    def __init__(self, stage):
+        self.labels = (stage,)
+
+    def __enter__(self):
+        self.start = timer()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        STAGE_SECONDS.observe(timer() - self.start, self.labels)
+
+
+class _ResponseBody(object):
+    """Wraps a WSGI response iterable to count the bytes written and record the request when it is closed"""
+
+    def __init__(self, body, finish):
+        self._body = body
+        self._finish = finish
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self._body:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self._body, 'close'):
+                self._body.close()
+        finally:
+            self._finish(self.size)
+
+
+class MetricsMiddleware(object):
+    """WSGI middleware that records request metrics, and serves the metrics for GET requests to path"""
+
+    def __init__(self, app, path='/metrics', endpoints=('/v1/parse', '/v1/parse/batch'), registry=registry):
+        """
+
+        :param app: The WSGI application
+        :param path: Path to serve the metrics at
+        :param endpoints: Paths to record separately. Requests to other paths are recorded as 'other', to
+        bound the number of label values.
+        :return:
+        """
+
+        self.app = app
+        self.path = path
+        self.endpoints = frozenset(endpoints)
+        self.registry = registry
+
+    def __call__(self, environ, start_response):
+
+        path = environ.get('PATH_INFO', '')
+
+        if path == self.path and environ.get('REQUEST_METHOD') in ('GET', 'HEAD'):
+            body = self.registry.expose().encode('utf8')
+            start_response('200 OK', [('Content-Type', CONTENT_TYPE), ('Content-Length', str(len(body)))])
+            return [body]
+
+        labels = (path if path in self.endpoints else 'other',)
+        start = timer()
+        status = ['500']
+
+        if environ.get('CONTENT_LENGTH'):
+            try:
+                REQUEST_BYTES.observe(int(environ['CONTENT_LENGTH']), labels)
+            except ValueError:
+                pass
+
+        def _start_response(s, headers, exc_info=None):
+            status[0] = s.split(' ', 1)[0]
+            return start_response(s, headers, exc_info)
+
+        def finish(size):
+            IN_FLIGHT.dec()
+            REQUEST_SECONDS.observe(timer() - start, labels)
+            RESPONSE_BYTES.observe(size, labels)
+            RESPONSES.inc(labels=labels + (status[0],))
+            self.registry.changed()
+
+        IN_FLIGHT.inc()
+
+        try:
+            body = self.app(environ, _start_response)
+        except Exception as e:
+            ERRORS.inc(labels=(e.__class__.__name__,))
+            finish(0)
+            raise
+
+        return _ResponseBody(body, finish)
@@ -10,6 +10,9 @@ objects.
 NO_TERM = '<no_term>'  # No parent term -- no '.' --  in term cell
 ELIDED_TERM = '<elided_term>'  # A '.' in term cell, but no term before it.
 
+_missing = object()  # Marker for missing dict keys
+_no_args = ()  # Shared by all terms that have no args or children
+
 
 class ParserError(Exception):
 
@@ -33,9 +36,15 @@ class Term(object):
         child_property_type What datatype to use in dict conversion
         valid Did term pass validation tests? Usually based on DeclaredTerm values.
 
+        Terms use __slots__, and share an empty tuple for args and children until they
+        have some, because documents can produce millions of them.
+
     """
 
-    def __init__(self, term, value, term_args=[]):
+    __slots__ = ('parent_term', 'record_term', 'value', 'args', 'section', 'file_name', 'row', 'col',
+                 'term_value_name', 'child_property_type', 'valid', 'is_arg_child', '_children')
+
+    def __init__(self, term, value, term_args=()):
         """
 
         :param term: Simple or compoint term name
@@ -48,7 +57,7 @@ class Term(object):
         self.parent_term, self.record_term = Term.split_term_lower(term)
 
         self.value = value.strip() if value else None
-        self.args = [x.strip() for x in term_args]
+        self.args = [x.strip() for x in term_args] if term_args else _no_args
 
         self.section = None  # Name of section the term is in.
 
@@ -66,7 +75,36 @@ class Term(object):
 
         self.is_arg_child = None  # If true, term was
 
-        self.children = []  # WHen terms are linked, hold term's children.
+        self._children = None  # When terms are linked, hold term's children. Allocated by add_child()
+
+    @property
+    def children(self):
+        return self._children if self._children is not None else _no_args
+
+    @children.setter
+    def children(self, v):
+        self._children = v
+
+    def clone(self):
+        """Return a shallow copy of the term, with its own list of the children. Much faster than copy.copy()"""
+
+        t = self.__class__.__new__(self.__class__)
+
+        t.parent_term = self.parent_term
+        t.record_term = self.record_term
+        t.value = self.value
+        t.args = self.args
+        t.section = self.section
+        t.file_name = self.file_name
+        t.row = self.row
+        t.col = self.col
+        t.term_value_name = self.term_value_name
+        t.child_property_type = self.child_property_type
+        t.valid = self.valid
+        t.is_arg_child = self.is_arg_child
+        t._children = list(self._children) if self._children else None
+
+        return t
 
     @classmethod
     def split_term(cls, term):
@@ -107,12 +145,28 @@ class Term(object):
         else:
             return ''
 
+    def as_dict(self):
+        """Return a dict of the term's name, value and location, for serializing terms one at a time"""
+
+        return {
+            'term': '.'.join((self.parent_term, self.record_term)),
+            'value': self.value,
+            'args': list(self.args),
+            'section': self.section,
+            'file': self.file_name,
+            'row': self.row,
+            'col': self.col
+        }
+
     def add_child(self, child):
-        self.children.append(child)
+        if self._children is None:
+            self._children = [child]
+        else:
+            self._children.append(child)
 
     def __repr__(self):
         return "<Term: {}{}.{} {} {} >".format(self.file_ref(), self.parent_term,
-                                               self.record_term, self.value, self.args)
+                                               self.record_term, self.value, list(self.args))
 
     def __str__(self):
         if self.parent_term == NO_TERM:
@@ -142,13 +196,9 @@ class CsvPathRowGenerator(object):
     def open(self):
 
         if self._path.startswith('http'):
-            import urllib2
-            try:
-                f = urllib2.urlopen(self._path)
-            except urllib2.URLError:
-                raise IncludeError("Failed to find file by url: {}".format(self._path))
+            from .fetch import get_fetcher
 
-            f.name = self._path  # to be symmetric with files.
+            f = get_fetcher().open(self._path)
         else:
             from os.path import join
 
@@ -176,6 +226,61 @@ class CsvPathRowGenerator(object):
         self.close()
 
 
+class BufferedCsvRowGenerator(object):
+    """A faster row generator for local files. The file is read with a large buffer, and iterating
+    returns the csv reader itself, so there is no Python generator between the reader and the
+    TermGenerator. Blank and comment rows are left for TermGenerator to skip.
+
+    The file is closed when the rows are exhausted. If iteration stops early, it is closed by close(), or
+    when the reader is garbage collected.
+    """
+
+    def __init__(self, path, buffer_size=1024 * 1024):
+        """
+
+        :param path: Path to a local CSV file
+        :param buffer_size: Size of the read buffer
+        :return:
+        """
+
+        self._path = path
+        self._buffer_size = buffer_size
+        self._f = None
+
+    @property
+    def path(self):
+        return self._path
+
+    def open(self):
+        import sys
+
+        self.close()
+
+        try:
+            if sys.version_info[0] < 3:
+                self._f = open(self._path, 'rb', self._buffer_size)
+            else:
+                self._f = open(self._path, 'r', self._buffer_size, newline='')
+        except IOError:
+            raise IncludeError("Failed to find file: {}".format(self._path))
+
+    def close(self):
+
+        if self._f:
+            self._f.close()
+            self._f = None
+
+    def __iter__(self):
+        import csv
+
+        from itertools import chain
+
+        self.open()
+
+        # Calls close() after the last line. Both iterators are in C, so no Python code runs for each row
+        return csv.reader(chain(self._f, iter(self._f.close, None)))
+
+
 class CsvDataRowGenerator(object):
     """Generate rows from CSV data, as a string
     """
@@ -206,6 +311,47 @@ class CsvDataRowGenerator(object):
             yield row
 
 
+class CsvStreamRowGenerator(object):
+    """Generate rows from a file-like object or iterator of lines of CSV data, such as the input stream
+    of a web request, reading it incrementally rather than all at once. The stream can only be read once.
+    """
+
+    def __init__(self, stream, path=None, encoding='utf-8'):
+        """
+
+        :param stream: A file-like object, or an iterator of lines. On Python 3, the lines may be bytes,
+        which are decoded with encoding
+        :param path: Name to use for the file_name of the terms
+        :param encoding: Encoding of the stream, for Python 3
+        :return:
+        """
+
+        self._stream = stream
+        self._path = path or '<stream>'
+        self._encoding = encoding
+
+    @property
+    def path(self):
+        return self._path
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        import csv
+        import sys
+
+        lines = self._stream
+
+        if sys.version_info[0] >= 3:
+            lines = (l.decode(self._encoding) if isinstance(l, bytes) else l for l in lines)
+
+        return csv.reader(lines)
+
+
 class RowGenerator(object):
     """An object that generates rows. The current implementation mostly just a wrapper around
     csv.reader, but it add a path property so term interperters know where the terms are coming from
@@ -232,14 +378,54 @@ class RowGenerator(object):
             yield row
 
 
+def resolve_local_ref(ref, path, base_dir=None):
+    """Return the path of a local document referenced by a Declare or Include term. Refs are relative to the
+    directory of the referencing document, including ones that start with '/'.
+
+    :param ref: Value of the Declare or Include term
+    :param path: Path of the referencing document
+    :param base_dir: If set, the document must be in this directory, or an IncludeError is raised, and refs
+    in documents that aren't in it, such as ones posted to a server, are relative to it. If False, no local
+    documents may be referenced.
+    """
+    from os.path import dirname, join, abspath, realpath
+
+    if base_dir is False:
+        raise IncludeError("Can't load '{}': local documents can't be referenced".format(ref))
+
+    if base_dir is None:
+        return join(dirname(path), ref.strip('/'))
+
+    base = join(realpath(abspath(base_dir)), '')
+
+    d = dirname(realpath(abspath(path)))
+
+    if not join(d, '').startswith(base):
+        d = base
+
+    fn = realpath(join(d, ref.strip('/')))
+
+    if not fn.startswith(base):
+        raise IncludeError("Can't load '{}': it is outside of the base directory".format(ref))
+
+    return fn
+
+
 class TermGenerator(object):
     """Generate terms from a row generator. It will produce a term for each row, and child
-    terms for any arguments to the row. """
+    terms for any arguments to the row. The terms of Include documents are generated after
+    the Include term. """
 
-    def __init__(self, row_gen):
+    def __init__(self, row_gen, prefetch=False, stats=None, base_dir=None):
         """
 
         :param row_gen: an interator that generates rows
+        :param prefetch: If true, scan the rows before generating terms, and start fetching
+        remote Declare and Include documents in the background, so they are fetched concurrently. Only
+        local files are scanned.
+        :param stats: Optional structured_tables.stats.ParserStats, to count and time the rows and terms
+        :param base_dir: Directory that local Include documents must be in, or False to allow none. See
+        resolve_local_ref()
         :return:
         """
 
@@ -249,68 +435,165 @@ class TermGenerator(object):
 
         self._path = self._row_gen.path
 
+        self._prefetch = prefetch
+
+        self.stats = stats
+
+        self.base_dir = base_dir
+
+        self.errors = []  # Include terms whose documents couldn't be loaded
+
+        self.includes = []  # Resolved refs of the Include documents, including ones that couldn't be loaded
+
     def __iter__(self):
         """An interator that generates term objects"""
 
-        for line_n, row in enumerate(self._row_gen, 1):
+        if self.stats is not None:
+            return self.stats.iterate(self._iter_terms(), 'TermGenerator', 'terms_emitted')
 
-            if not row[0].strip() or row[0].strip().startswith('#'):
-                continue
+        return self._iter_terms()
 
-            t = Term(row[0].lower(),
-                     row[1] if len(row)>1 else '',
-                     row[2:] if len(row)>2 else [])
-            t.row = line_n
-            t.col = 1
-            t.file_name = self._path
+    def _iter_terms(self):
+        from .cache import resolve_ref
 
-            rt_l = t.record_term.lower()
+        urls = []
 
-            if rt_l == 'include':
+        # Prefetched documents belong to this parse. Ones that weren't used, because they were found in a
+        # cache, are discarded when it ends
+        if self._prefetch:
+            from .fetch import get_fetcher, prefetch_refs
+            fetcher = get_fetcher()
+            urls = prefetch_refs(self._row_gen, fetcher)
 
+        try:
+            for t in self._expand_includes(self.generate_terms(), (resolve_ref(self._path),)):
                 yield t
+        finally:
+            if urls:
+                fetcher.discard(urls)
+
+    def generate_terms(self):
+        """Generate the terms for the rows of this generator, without the terms of included documents"""
+
+        stats = self.stats
+
+        if stats is not None:
+            rows = stats.iterate(self._row_gen, type(self._row_gen).__name__, 'rows_read')
+        else:
+            rows = self._row_gen
+
+        for line_n, row in enumerate(rows, 1):
 
-                for t in self.include_term_generator(t.value):
-                    yield t
+            if not row:
+                if stats is not None:
+                    stats.count('blank_rows_skipped')
+                continue
 
-                continue  # Already yielded the include term
+            term = row[0].strip()
+
+            if not term or term.startswith('#'):
+                if stats is not None:
+                    stats.count('comments_skipped' if term else 'blank_rows_skipped')
+                continue
+
+            t = Term(term,
+                     row[1] if len(row)>1 else '',
+                     row[2:] if len(row)>2 else _no_args)
+            t.row = line_n
+            t.col = 1
+            t.file_name = self._path
 
             yield t
 
+            rt_l = t.record_term.lower()
+
             # Yield any child terms, from the term row arguments
-            if rt_l != 'section':
+            if rt_l != 'section' and rt_l != 'include':
                 for col, value in enumerate(t.args, 0):
                     if value.strip():
-                        t2 = Term(t.record_term.lower() + '.' + str(col), value, [])
+                        t2 = Term(t.record_term.lower() + '.' + str(col), value)
                         t2.is_arg_child = True
                         t2.row = line_n
                         t2.col = col + 2  # The 0th argument starts in col 2
                         t2.file_name = self._path
+
+                        if stats is not None:
+                            stats.count('arg_children_created')
+
                         yield t2
 
+    def _expand_includes(self, terms, includes, clone=False):
+        """Yield terms, followed by the terms of the document named by each Include term.
+
+        :param terms: Iterable of terms
+        :param includes: Tuple of the resolved refs of the documents being included, outermost first
+        :param clone: If True, yield copies of the terms, which are shared in the fragment cache
+        """
+
+        for t in terms:
+
+            yield t.clone() if clone else t
+
+            if t.record_term.lower() == 'include':
+                try:
+                    terms2 = self.include_term_generator(t.value, t.file_name, includes)
+                except ParserError as e:
+                    e.term = t
+                    self.errors.append(e)
+                    continue
+
+                for t2 in terms2:
+                    yield t2
+
+    def include_term_generator(self, include_ref, path=None, includes=None):
+        """Return a generator of the terms of an included document, including the terms of the documents
+        that it includes. The terms of each document are parsed once per process and cached in
+        structured_tables.cache.fragment_cache
 
-    def include_term_generator(self, include_ref):
-        from os.path import dirname, join
+        :param include_ref: Value of the Include term; a URL, or a path relative to the including document
+        :param path: Path of the including document. Defaults to the path of the row generator.
+        :param includes: Resolved refs of the documents already being included, for detecting cycles.
+        """
+        from .cache import fragment_cache, resolve_ref
 
-        if not self._path:
-            raise ParserError("Can't include because don't know current path"
-                              .format(self._root_directory))
+        path = path or self._path
 
-        if include_ref.startwith('http'):
-            path = include_ref
+        if not path:
+            raise ParserError("Can't include '{}' because don't know current path".format(include_ref))
+
+        if include_ref.startswith('http'):
+            ref = include_ref
         else:
-            path = join(dirname(self._path), include_ref.strip('/'))
+            ref = resolve_local_ref(include_ref, path, self.base_dir)
+
+        ref = resolve_ref(ref)
 
-        return TermGenerator(RowGenerator(path))
+        if ref not in self.includes:
+            self.includes.append(ref)
+
+        if includes is None:
+            includes = (resolve_ref(path),)
+
+        if ref in includes:
+            raise IncludeError("Include cycle: {}".format(' -> '.join(includes + (ref,))))
+
+        return self._expand_includes(fragment_cache.get(ref), includes + (ref,), clone=True)
 
 
 class TermInterpreter(object):
     """Takes a stream of terms and sets the parameter map, valid term names, etc """
 
-    def __init__(self, term_gen, remove_special=True):
+    def __init__(self, term_gen, remove_special=True, declare_cache=None, bundle=None, stats=None, base_dir=None):
         """
         :param term_gen: an an iterator that generates terms
         :param remove_special: If true ( default ) remove the special terms from the stream
+        :param declare_cache: A DeclareDocCache for Declare documents. Defaults to the process-wide
+        structured_tables.cache.declare_cache
+        :param bundle: A declaration bundle, or the path to one, to load before parsing.
+        :param stats: Optional structured_tables.stats.ParserStats, to count and time the interpretation. It is
+        also given to term_gen, if that is a TermGenerator without one.
+        :param base_dir: Directory that local Declare and Include documents must be in, or False to allow none.
+        See resolve_local_ref(). It is also given to term_gen, if that is a TermGenerator without one.
         :return:
         """
 
@@ -320,15 +603,35 @@ class TermInterpreter(object):
 
         self._term_gen = term_gen
 
+        self.stats = stats
+
+        if stats is not None and isinstance(term_gen, TermGenerator) and term_gen.stats is None:
+            term_gen.stats = stats
+
+        self._base_dir = base_dir
+
+        if base_dir is not None and isinstance(term_gen, TermGenerator) and term_gen.base_dir is None:
+            term_gen.base_dir = base_dir
+
+        self._declare_cache = declare_cache
+
         self._param_map = []  # Current parameter map, the args of the last Section term
+        self._section = 'root'  # Lowercased name of the current section, from the last Section term
 
         # _sections and _terms are loaded from Declare documents, in
         # handle_declare and import_declare_doc. The Declare doc information
         # can also be loaded before parsing, so the Declare term can be eliminated.
         self._sections = {}  # Declared sections and their arguments
         self._terms = {}  # Pre-defined terms, plus TermValueName and ChildPropertyType
+        self._synonyms = {}  # Index of the 'synonym' values in _terms, maintained by _set_term()
+        self._resolved = {}  # Compiled (parent_term, record_term) lookups, filled by _resolve()
+        self._bundled = set()  # Resolved refs of the Declare documents that were satisfied by a bundle
 
-        self.errors = []
+        # Shared with a TermGenerator, so Include errors are reported with the Declare errors
+        self.errors = term_gen.errors if isinstance(term_gen, TermGenerator) else []
+
+        if bundle is not None:
+            self.import_declare_bundle(bundle)
 
     @property
     def sections(self):
@@ -336,7 +639,7 @@ class TermInterpreter(object):
 
     @property
     def synonyms(self):
-        return {k: v['synonym'] for k, v in self._terms.items() if 'synonym' in v}
+        return self._synonyms
 
     @property
     def terms(self):
@@ -350,9 +653,13 @@ class TermInterpreter(object):
         }
 
     def as_dict(self):
-        """Iterate, link terms and convert to a dict"""
+        """Iterate and convert to a dict, in a single pass"""
+
+        if self.stats is not None:
+            with self.stats.timing('build_dict'):
+                return build_dict(self)
 
-        return convert_to_dict(link_terms(self))
+        return build_dict(self)
 
     def errors_as_dict(self):
 
@@ -376,20 +683,33 @@ class TermInterpreter(object):
         return '.'.join((t1, t2))
 
     def __iter__(self):
-        import copy
+
+        if self.stats is not None:
+            return self.stats.iterate(self._iter_terms(), 'TermInterpreter')
+
+        return self._iter_terms()
+
+    def _iter_terms(self):
 
         last_parent_term = 'root'
 
+        resolved = self._resolved  # Cleared, not replaced, when declarations change
+
+        stats = self.stats
+
         # Remapping the default record value to another property name
         for t in self._term_gen:
 
-            nt = copy.copy(t)
+            nt = t.clone()
 
             # Substitute synonyms
             try:
-                syn_term = self.synonyms[self.join(t.parent_term, t.record_term)]
+                syn_term = self._synonyms[self.join(t.parent_term, t.record_term)]
 
                 nt.parent_term, nt.record_term = Term.split_term_lower(syn_term);
+
+                if stats is not None:
+                    stats.count('synonyms_substituted')
             except KeyError:
                 pass
 
@@ -408,41 +728,82 @@ class TermInterpreter(object):
 
             # Handle other special terms
             if hasattr(self, 'handle_' + t.record_term.lower()):
-                getattr(self, 'handle_' + t.record_term.lower())(t)
+                if stats is not None:
+                    with stats.handler('handle_' + t.record_term.lower()):
+                        getattr(self, 'handle_' + t.record_term.lower())(t)
+                else:
+                    getattr(self, 'handle_' + t.record_term.lower())(t)
                 if self._remove_special:
                     continue
 
-            nt.child_property_type = self._terms.get(self.join(nt.parent_term, nt.record_term), {}) \
-                .get('childpropertytype', 'any')
-
-            nt.term_value_name = self._terms.get(self.join(nt.parent_term, nt.record_term), {}) \
-                .get('termvaluename', '@value')
+            try:
+                nt.child_property_type, nt.term_value_name, nt.valid = resolved[(nt.parent_term, nt.record_term)]
+            except KeyError:
+                nt.child_property_type, nt.term_value_name, nt.valid = self._resolve(nt.parent_term, nt.record_term)
 
-            nt.valid = self.join(nt.parent_term.lower(), nt.record_term.lower()) in self._terms
+            nt.section = self._section
 
             yield nt
 
     def handle_section(self, t):
         self._param_map = [p.lower() if p else i for i, p in enumerate(t.args)]
+        self._section = t.value.lower() if t.value else 'root'
 
     def handle_declare(self, t):
         """Load the information in the file referenced by a Delare term, but don't
         insert the terms in the file into the stream"""
-        from os.path import dirname, join
-
-        if t.value.startswith('http'):
-            fn = t.value.strip('/')
-        else:
-            fn = join(dirname(t.file_name), t.value.strip('/'))
+        from .cache import resolve_ref
 
-        ti = DeclareTermInterpreter(TermGenerator(CsvPathRowGenerator(fn)))
+        if self._declare_cache is None:
+            from .cache import declare_cache
+            self._declare_cache = declare_cache
 
         try:
-            self.import_declare_doc(ti.as_dict())
+            if t.value.startswith('http'):
+                fn = t.value.strip('/')
+            else:
+                fn = resolve_local_ref(t.value, t.file_name, self._base_dir)
+
+            if resolve_ref(fn) in self._bundled:
+                return
+
+            self.merge_declare_dict(self._declare_cache.get(fn))
         except IncludeError as e:
             e.term = t
             self.errors.append(e)
 
+    def import_declare_bundle(self, bundle):
+        """Load the declarations from a bundle created with structured_tables.bundle.compile_bundle(). Declare
+        terms that reference one of the bundle's source documents are satisfied by the bundle and won't be loaded.
+
+        :param bundle: A bundle dict, or the path to a bundle file
+        """
+        from .cache import resolve_ref
+
+        if not isinstance(bundle, dict):
+            from .bundle import load_bundle
+            bundle = load_bundle(bundle)
+
+        self.merge_declare_dict(bundle)
+
+        for ref in bundle['sources']:
+            self._bundled.add(resolve_ref(ref))
+
+    def merge_declare_dict(self, d):
+        """Merge the sections and terms of a declare dict, in the form returned by the declare_dict property,
+        into this interpreter. The dict is copied, so it can be shared between interpreters. """
+
+        for k, v in d['sections'].items():
+            if k in self._sections:
+                s = self._sections[k]
+                s['args'] = list(v['args']) or s['args']
+                s['terms'].extend(e for e in v['terms'] if e not in s['terms'])
+            else:
+                self._sections[k] = {'args': list(v['args']), 'terms': list(v['terms'])}
+
+        for k, v in d['terms'].items():
+            self._set_term(k, dict(v))
+
 
     def import_declare_doc(self, d):
         """Import a declare cod that has been parsed and converted to a dict"""
@@ -458,7 +819,7 @@ class TermInterpreter(object):
         if 'declareterm' in d:
             for e in d['declareterm']:
                 terms = self.join(*Term.split_term_lower(e['term_name']))
-                self._terms[terms] = e
+                self._set_term(terms, e)
 
                 if 'section' in e and e['section']:
 
@@ -479,6 +840,32 @@ class TermInterpreter(object):
                     if 'valueset' in v and e.get('name',None) == v['valueset']:
                         v['valueset'] = e['value']
 
+    def _set_term(self, term, d):
+        """Set a declared term, keeping the synonym index in step with the terms dict"""
+
+        self._terms[term] = d
+
+        if 'synonym' in d:
+            self._synonyms[term] = d['synonym']
+        else:
+            self._synonyms.pop(term, None)
+
+        self._resolved.clear()
+
+    def _resolve(self, parent_term, record_term):
+        """Compile the declared attributes of a term into a (child_property_type, term_value_name, valid)
+        tuple, and memoize it so later terms with the same parent and record term need only one lookup"""
+
+        d = self._terms.get(self.join(parent_term, record_term), {})
+
+        r = (d.get('childpropertytype', 'any'),
+             d.get('termvaluename', '@value'),
+             self.join(parent_term.lower(), record_term.lower()) in self._terms)
+
+        self._resolved[(parent_term, record_term)] = r
+
+        return r
+
 
 class DeclareTermInterpreter(TermInterpreter):
     """
@@ -487,26 +874,127 @@ class DeclareTermInterpreter(TermInterpreter):
     Metatab files. These require declarations are pre-declared in this class.
     """
 
-    def __init__(self, term_gen, remove_special=False):
-        super(DeclareTermInterpreter, self).__init__(term_gen, remove_special)
+    def __init__(self, term_gen, remove_special=False, **kwargs):
+        super(DeclareTermInterpreter, self).__init__(term_gen, remove_special, **kwargs)
 
         # Configure the parser to output a more useful structure
-        self._terms.update({
+        for k, v in {
             NO_TERM + '.section': {'termvaluename': 'name'},
             NO_TERM + '.synonym': {'termvaluename': 'term_name', 'childpropertytype': 'sequence'},
             NO_TERM + '.declareterm': {'termvaluename': 'term_name', 'childpropertytype': 'sequence'},
             NO_TERM + '.declaresection': {'termvaluename': 'section_name', 'childpropertytype': 'sequence'},
             NO_TERM + '.declarevalueset': {'termvaluename': 'name', 'childpropertytype': 'sequence'},
             'declarevalueset.value': {'termvaluename': 'value', 'childpropertytype': 'sequence'},
-        })
+        }.items():
+            self._set_term(k, v)
+
+
+START_SECTION = 'start_section'
+END_SECTION = 'end_section'
+START_RECORD = 'start_record'
+END_RECORD = 'end_record'
+CHILD = 'child'
+
+
+class TermEventGenerator(object):
+    """Generate SAX style parse events from a stream of interpreted terms, so documents can be
+    processed as they are read, without linking the terms or building dicts. Each event
+    is a tuple of the event name and a payload:
+
+        (START_SECTION, section_name) Before the first term of a section
+        (START_RECORD, term) For each term that is not an arg child
+        (CHILD, term) For each arg child, after the START_RECORD of its record
+        (END_RECORD, term) After the record's children and nested records
+        (END_SECTION, section_name) After the last term of a section
+
+    Records nest when a term's parent is the record term of an open record, such as Column
+    records in a Table. A term whose parent is not open, because another record has come
+    between them, is reported at the top level. Empty sections produce no events.
+    """
+
+    def __init__(self, term_interp):
+        """
+
+        :param term_interp: an iterator that generates interpreted terms, usually a TermInterpreter
+        :return:
+        """
+
+        self._term_interp = term_interp
+
+    def __iter__(self):
+
+        section = None
+        open_records = []  # Stack of records that can still get children
+
+        for t in self._term_interp:
+
+            if t.section != section:
+                while open_records:
+                    yield (END_RECORD, open_records.pop())
+
+                if section is not None:
+                    yield (END_SECTION, section)
+
+                section = t.section
+                yield (START_SECTION, section)
+
+            if t.is_arg_child:
+                yield (CHILD, t)
+                continue
+
+            while open_records and open_records[-1].record_term != t.parent_term:
+                yield (END_RECORD, open_records.pop())
+
+            open_records.append(t)
+            yield (START_RECORD, t)
+
+        while open_records:
+            yield (END_RECORD, open_records.pop())
+
+        if section is not None:
+            yield (END_SECTION, section)
+
+    def dispatch(self, handler):
+        """Call a method on the handler for each event. The methods have the same names as the
+        events, and are called with the event payload. Handlers can extend TermEventHandler
+        to only implement the methods for the events they use. """
+
+        for event, payload in self:
+            getattr(handler, event)(payload)
+
+        return handler
+
+
+class TermEventHandler(object):
+    """Base class for handlers for TermEventGenerator.dispatch(). All of the methods do nothing. """
+
+    def start_section(self, section_name):
+        pass
+
+    def end_section(self, section_name):
+        pass
+
+    def start_record(self, term):
+        pass
 
+    def end_record(self, term):
+        pass
+
+    def child(self, term):
+        pass
 
-def link_terms(term_generator):
+
+def link_terms(term_generator, stats=None):
     """Return a heirarchy of records from a stream of terms
 
     :param term_generator:
+    :param stats: Optional structured_tables.stats.ParserStats, to time the linking
     """
 
+    if stats is not None:
+        with stats.timing('link_terms'):
+            return link_terms(term_generator)
+
     root = Term('Root', None)
     last_term_map = {NO_TERM: root}
 
@@ -530,44 +1018,210 @@ def link_terms(term_generator):
     return root
 
 
-def convert_to_dict(term):
+def _child_counts(children):
+    """Count the children with the default 'any' property type for each record term. The count is -1
+    for record terms that also have children of other types. """
+
+    counts = {}
+
+    for c in children:
+        k = c.record_term
+
+        if c.child_property_type == 'scalar' or c.child_property_type == 'sequence':
+            counts[k] = -1
+        else:
+            n = counts.get(k, 0)
+            if n >= 0:
+                counts[k] = n + 1
+
+    return counts
+
+
+def _set_child(d, c, v, counts):
+    """Set the value of a converted child term in its parent's dict"""
+
+    k = c.record_term
+
+    if c.child_property_type == 'scalar':
+        d[k] = v
+
+    elif c.child_property_type == 'sequence':
+        existing = d.get(k)
+
+        if isinstance(existing, list):
+            existing.append(v)
+        else:
+            d[k] = [v]
+
+    else:
+        n = counts[k]
+
+        if n == 1:
+            d[k] = v  # The only child with this record term
+
+        elif n > 1:
+            if k in d:
+                d[k].append(v)
+            else:
+                d[k] = [v]  # First of several children, so start a list
+
+        else:
+            # Mixed with other property types, so it depends on what has already been set
+            existing = d.get(k, _missing)
+
+            if existing is _missing:
+                d[k] = v
+            elif isinstance(existing, list):
+                existing.append(v)
+            else:
+                d[k] = [existing, v]
+
+
+def convert_to_dict(term, stats=None):
     """Converts a record heirarchy to nested dicts.
 
     :param term: Root term at which to start conversion
+    :param stats: Optional structured_tables.stats.ParserStats, to time the conversion
 
     """
 
-    if term.children:
+    if stats is not None:
+        with stats.timing('convert_to_dict'):
+            return convert_to_dict(term)
 
-        d = {}
+    if not term.children:
+        return term.value
 
-        for c in term.children:
+    # Each stack entry is a term that has children, the dict for the term, an iterator over
+    # the children that haven't been converted yet, and the child counts for the term.
+    stack = [(term, {}, iter(term.children), _child_counts(term.children))]
 
-            if c.child_property_type == 'scalar':
-                d[c.record_term] = convert_to_dict(c)
+    while True:
+        t, d, children, counts = stack[-1]
 
-            elif c.child_property_type == 'sequence':
-                try:
-                    d[c.record_term].append(convert_to_dict(c))
-                except (KeyError, AttributeError):
-                    # The c.term property doesn't exist, so add a list
-                    d[c.record_term] = [convert_to_dict(c)]
+        for c in children:
+            if c.children:
+                stack.append((c, {}, iter(c.children), _child_counts(c.children)))
+                break
 
+            if c.child_property_type == 'any' and counts[c.record_term] == 1:
+                d[c.record_term] = c.value  # The common case, a child with a unique record term
             else:
-                try:
-                    d[c.record_term].append(convert_to_dict(c))
-                except KeyError:
-                    # The c.term property doesn't exist, so add a scalar
-                    d[c.record_term] = convert_to_dict(c)
-                except AttributeError as e:
-                    # d[c.term] exists, but is a scalar, so convert it to a list
+                _set_child(d, c, c.value, counts)
 
-                    d[c.record_term] = [d[c.record_term]] + [convert_to_dict(c)]
+        else:
+            # All of the children are converted
+            stack.pop()
 
-        if term.value:
-            d[term.term_value_name] = term.value
+            if t.value:
+                d[t.term_value_name] = t.value
 
-        return d
+            if not stack:
+                return d
 
-    else:
-        return term.value
+            _set_child(stack[-1][1], t, d, stack[-1][3])
+
+
+class _DictNode(object):
+    """Records where the value of a term lives in the output of build_dict(), so the value can be
+    replaced with a dict when the term gets its first child. """
+
+    __slots__ = ('container', 'key', 'value', 'term_value_name', 'dict')
+
+    def __init__(self, value, term_value_name):
+        self.container = None  # Dict or list that holds the term's value. None if the value was discarded
+        self.key = None  # Key or index of the value in the container
+        self.value = value
+        self.term_value_name = term_value_name
+        self.dict = None  # Dict for the term's children, created with the first child
+
+
+def build_dict(term_generator):
+    """Convert a stream of terms directly to nested dicts, producing the same result as
+    convert_to_dict(link_terms(term_generator)), but without building a tree of terms. Parents
+    are resolved with the same last term map as link_terms()
+
+    :param term_generator: an iterator that generates terms
+
+    """
+
+    root = _DictNode(None, '@value')
+    root.dict = {}
+    last_term_map = {NO_TERM: root}
+
+    for term in term_generator:
+
+        try:
+            parent = last_term_map[term.parent_term]
+        except KeyError as e:
+
+            raise ParserError("Failed to find parent term in last term map: {} {} \nTerm: \n{}"
+                              .format(e.__class__.__name__, e, term))
+
+        d = parent.dict
+
+        if d is None:
+            # First child, so the parent's value changes from a scalar to a dict
+            d = parent.dict = {}
+
+            if parent.value:
+                d[parent.term_value_name] = parent.value
+
+            if parent.container is not None:
+                parent.container[parent.key] = d
+
+        node = _DictNode(term.value, term.term_value_name)
+        k = term.record_term
+
+        if parent.value and k == parent.term_value_name:
+            pass  # The parent's value would overwrite this child, so it is discarded.
+
+        else:
+            # The only earlier term with this record term that can still get children is the one in the
+            # last term map, so it is the only one that has to be updated when its value moves or is replaced.
+            prior = last_term_map.get(k)
+            existing = d.get(k, _missing)
+            pt = term.child_property_type
+
+            if pt == 'scalar':
+                if prior is not None and ((prior.container is d and prior.key == k) or
+                                          (isinstance(existing, list) and prior.container is existing)):
+                    prior.container = None
+
+                node.container, node.key = d, k
+                d[k] = term.value
+
+            elif isinstance(existing, list):
+                node.container, node.key = existing, len(existing)
+                existing.append(term.value)
+
+            elif existing is _missing:
+                if pt == 'sequence':
+                    node.container, node.key = [term.value], 0
+                    d[k] = node.container
+                else:
+                    node.container, node.key = d, k
+                    d[k] = term.value
+
+            elif pt == 'sequence':
+                # The list replaces the earlier scalar value
+                if prior is not None and prior.container is d and prior.key == k:
+                    prior.container = None
+
+                node.container, node.key = [term.value], 0
+                d[k] = node.container
+
+            else:
+                # A repeated 'any' term, so the earlier value becomes the first item of a list
+                l = d[k] = [existing, term.value]
+
+                if prior is not None and prior.container is d and prior.key == k:
+                    prior.container, prior.key = l, 0
+
+                node.container, node.key = l, 1
+
+        if not term.is_arg_child and term.parent_term != ELIDED_TERM:
+            last_term_map[ELIDED_TERM] = node
+            last_term_map[term.record_term] = node
+
+    return root.dict or None
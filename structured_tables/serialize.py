@@ -0,0 +1,193 @@
+# Copyright (c) 2016 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+JSON serialization for parse results. The fastest installed encoder is used, from orjson, ujson,
+simplejson and the standard library json module, in that order. Set the STRUCTURED_TABLES_JSON_ENCODER
+environment variable, or call set_encoder(), to choose one.
+
+Output is compact, without spaces after separators, unless an indent is given. The encoders produce
+equivalent JSON, but not always the same text: orjson doesn't escape non-ASCII characters, and only
+indents by two spaces.
+
+iterencode() streams a result in chunks, by encoding each item of the top levels of the result
+separately, so the encoder's C implementation is used for the rest.
+"""
+
+import os
+from six import string_types
+
+DEFAULT_STREAM_DEPTH = 2
+
+
+class Encoder(object):
+    """Base class for encoders. Subclasses implement dumps(), and raise ImportError from __init__ if their
+    module isn't installed """
+
+    name = None
+
+    def dumps(self, obj, indent=None):
+        """Return the JSON text for obj"""
+        raise NotImplementedError
+
+    def _key(self, k):
+
+        if isinstance(k, string_types):
+            return self.dumps(k)
+
+        return '"{}"'.format(self.dumps(k).strip('"'))  # Numbers, booleans and None, as the json module does
+
+    def iterencode(self, obj, depth=DEFAULT_STREAM_DEPTH):
+        """Yield the JSON text for obj in chunks. The items of dicts and lists at the top depth levels are
+        encoded separately. """
+
+        if depth and isinstance(obj, dict) and obj:
+            sep = '{'
+
+            for k, v in obj.items():
+                yield sep + self._key(k) + ':'
+                sep = ','
+
+                for chunk in self.iterencode(v, depth - 1):
+                    yield chunk
+
+            yield '}'
+
+        elif depth and isinstance(obj, (list, tuple)) and obj:
+            sep = '['
+
+            for v in obj:
+                yield sep
+                sep = ','
+
+                for chunk in self.iterencode(v, depth - 1):
+                    yield chunk
+
+            yield ']'
+
+        else:
+            yield self.dumps(obj)
+
+
+class JsonEncoder(Encoder):
+    name = 'json'
+
+    module = 'json'
+
+    def __init__(self):
+        import importlib
+
+        self._json = importlib.import_module(self.module)
+        # Reused, because dumps() creates an encoder for each call when it has arguments
+        self._encoder = self._json.JSONEncoder(separators=(',', ':'))
+
+    def dumps(self, obj, indent=None):
+
+        if indent:
+            return self._json.dumps(obj, indent=indent, separators=(',', ': '))
+
+        return self._encoder.encode(obj)
+
+
+class SimplejsonEncoder(JsonEncoder):
+    name = 'simplejson'
+
+    module = 'simplejson'
+
+
+class UjsonEncoder(Encoder):
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+
+        self._ujson = ujson
+
+    def dumps(self, obj, indent=None):
+        return self._ujson.dumps(obj, indent=indent or 0, escape_forward_slashes=False)
+
+
+class OrjsonEncoder(Encoder):
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+
+        self._orjson = orjson
+
+    def dumps(self, obj, indent=None):
+        option = self._orjson.OPT_NON_STR_KEYS
+
+        if indent:
+            option |= self._orjson.OPT_INDENT_2
+
+        return self._orjson.dumps(obj, option=option).decode('utf8')
+
+
+# In order of preference
+ENCODERS = [OrjsonEncoder, UjsonEncoder, SimplejsonEncoder, JsonEncoder]
+
+_encoder = None
+
+
+def make_encoder(name=None):
+    """Return the named encoder, or the first one that is installed"""
+
+    for cls in ENCODERS:
+        if name and cls.name != name:
+            continue
+
+        try:
+            return cls()
+        except ImportError:
+            if name:
+                raise
+
+    raise ValueError('Unknown JSON encoder: {}'.format(name))
+
+
+def available_encoders():
+    """Return the names of the encoders that are installed"""
+
+    names = []
+
+    for cls in ENCODERS:
+        try:
+            cls()
+            names.append(cls.name)
+        except ImportError:
+            pass
+
+    return names
+
+
+def get_encoder():
+    """Return the process-wide encoder, chosen by the STRUCTURED_TABLES_JSON_ENCODER environment variable, or
+    the first one installed """
+    global _encoder
+
+    if _encoder is None:
+        _encoder = make_encoder(os.getenv('STRUCTURED_TABLES_JSON_ENCODER'))
+
+    return _encoder
+
+
+def set_encoder(name=None):
+    """Set the process-wide encoder. With no name, use the first one installed. Returns the encoder"""
+    global _encoder
+
+    _encoder = make_encoder(name)
+
+    return _encoder
+
+
+def dumps(obj, indent=None):
+    """Return the JSON text for obj, with the process-wide encoder"""
+
+    return get_encoder().dumps(obj, indent)
+
+
+def iterencode(obj, depth=DEFAULT_STREAM_DEPTH):
+    """Yield the JSON text for obj in chunks, with the process-wide encoder"""
+
+    return get_encoder().iterencode(obj, depth)
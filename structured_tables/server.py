@@ -6,13 +6,56 @@ Send a CSV file:
 
 Also accepts a JSON list of rows.
 
+Large CSV files can be streamed, so the upload is parsed as it is read and the JSON response is
+written as it is encoded:
+
+    curl -H "Content-Type: text/csv" --data-binary '@../test/data/example1-web.csv' http://127.0.0.1:5000/v1/parse?stream=1
+
+With an Accept header of application/x-ndjson, the response is the interpreted terms, as a JSON object
+per line, followed by a line with an object that has the errors.
+
+Many documents can be parsed in one request by posting them to /v1/parse/batch, either as a JSON
+array of objects with an 'id' and either 'csv' data or a list of 'rows', or as a multipart form with
+a file for each document, named by its id:
+
+    curl -F a=@example1.csv -F b=@example2.csv http://127.0.0.1:5000/v1/parse/batch
+
+The response has a result and errors for each document, keyed by id. Declare documents are parsed once
+per batch.
+
+Results of /v1/parse that aren't streamed are cached, keyed by the request body and content type, until
+one of the Declare documents used by the parse changes. Responses have an ETag, and requests with a
+matching If-None-Match header get a 304 response. The cache is configured with the RESULT_CACHE_SIZE,
+RESULT_CACHE_DIR and RESULT_CACHE_DISK_SIZE config values.
+
+Declarations that are used for every request can be set as a bundle in the DECLARE_BUNDLE config value.
+Documents can only Declare or Include local files that are in the directory set in the BASE_DIR config
+value; without it, they can only reference URLs.
+For production, run the API with "struct_tab serve", rather than by running this module.
+
+Responses are compact JSON, written with the fastest installed encoder. See structured_tables.serialize.
+
+Metrics for the requests, parsing and caches are served in the Prometheus text format at /metrics. They
+are kept by each process, so with several worker processes, set a shared directory on
+structured_tables.metrics.registry, as "struct_tab serve" does, for /metrics to report all of them.
+
 """
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from structured_tables import TermGenerator, TermInterpreter
-from structured_tables import RowGenerator, CsvDataRowGenerator
+from structured_tables import RowGenerator, CsvDataRowGenerator, CsvStreamRowGenerator
+from structured_tables.cache import BatchDeclareCache
+from structured_tables import service
+from structured_tables.service import CONTENT_TYPES, BadDocument, parse_cached, parse_document, interpret
+from structured_tables.metrics import MetricsMiddleware, record_errors, timed
 
 app = Flask(__name__)
 
+app.wsgi_app = MetricsMiddleware(app.wsgi_app)
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+RESPONSE_CHUNK_SIZE = 64 * 1024
+
 
 class ClientError(Exception):
     status_code = 400
@@ -52,28 +95,202 @@ class ClientError(Exception):
 
 @app.errorhandler(ClientError)
 def handle_invalid_usage(error):
+    record_errors([error])
     response = jsonify(error.to_dict())
     response.status_code = error.status_code
     return response
 
+def base_dir():
+    """Return the directory of the local documents that requests may reference, or False if they may not"""
+
+    return app.config.get('BASE_DIR') or False
+
+
+def interpreter(rg, declare_cache=None):
+    """Return a TermInterpreter for the rows of a request, with the app's declaration bundle"""
+
+    return TermInterpreter(TermGenerator(rg), declare_cache=declare_cache, bundle=app.config.get('DECLARE_BUNDLE'),
+                           base_dir=base_dir())
+
+
+def buffered(chunks, size=RESPONSE_CHUNK_SIZE):
+    """Join small chunks of a response into larger ones, so the server doesn't write each JSON token separately"""
+
+    buf = []
+    n = 0
+
+    for chunk in chunks:
+        buf.append(chunk)
+        n += len(chunk)
+
+        if n >= size:
+            yield ''.join(buf)
+            buf = []
+            n = 0
+
+    if buf:
+        yield ''.join(buf)
+
+
+def iter_json(d, errors):
+    """Generate the JSON for a parse result in chunks"""
+    from structured_tables.serialize import iterencode
+
+    yield '{"result":'
+
+    for chunk in iterencode(d):
+        yield chunk
+
+    yield ',"errors":'
+
+    for chunk in iterencode(errors):
+        yield chunk
+
+    yield '}'
+
+
+def iter_ndjson(term_interp):
+    """Generate interpreted terms as lines of JSON, followed by a line for the errors"""
+    from structured_tables.serialize import dumps
+
+    for t in term_interp:
+        yield dumps(t.as_dict()) + '\n'
+
+    yield dumps({'errors': term_interp.errors_as_dict()}) + '\n'
+
+
+def check_request_size():
+    """Reject a request body that is larger than MAX_CONTENT_LENGTH, or, with a limit, a chunked body with no
+    length. Flask only enforces the limit when the body is read with request.data, not from request.stream"""
+    from werkzeug.exceptions import RequestEntityTooLarge, LengthRequired
+
+    limit = app.config.get('MAX_CONTENT_LENGTH')
+
+    if limit is None:
+        return
+
+    if request.content_length is None:
+        if 'chunked' in request.headers.get('Transfer-Encoding', '').lower():
+            raise LengthRequired()
+    elif request.content_length > limit:
+        raise RequestEntityTooLarge()
+
+
 @app.route('/v1/parse', methods=['POST'])
 def parse():
 
+    check_request_size()
+
     content_type = request.headers.get('content-type')
 
-    if content_type == 'application/json':
-        rg = RowGenerator(request.json)
-    elif content_type == 'text/csv':
-        rg = CsvDataRowGenerator(request.data)
-    else:
+    stream = request.args.get('stream', '').lower() in ('1', 'true', 'yes')
+    ndjson = request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+    if content_type not in CONTENT_TYPES:
         raise ClientError(415, 'Bad mime type: {}'.format(content_type))
 
-    term_gen = list(TermGenerator(rg))
-    term_interp = TermInterpreter(term_gen)
+    if stream or ndjson:
+        if content_type == 'application/json':
+            rg = RowGenerator(request.json)
+        else:
+            rg = CsvStreamRowGenerator(request.stream)
+
+        term_interp = interpreter(rg)
+
+        if ndjson:
+            # The terms are interpreted as they are written, so the request must still be readable
+            return Response(stream_with_context(buffered(iter_ndjson(term_interp))), mimetype=NDJSON_MIMETYPE)
+
+        d, errors = interpret(term_interp)
+
+        return Response(buffered(iter_json(d, errors)), mimetype='application/json')
+
+    try:
+        etag, data = parse_cached(request.data, content_type, get_result_cache(), app.config.get('DECLARE_BUNDLE'),
+                                  base_dir())
+    except BadDocument as e:
+        raise ClientError(400, str(e))
+
+    response = Response(data, mimetype='application/json')
+
+    return with_etag(response, etag) if etag is not None else response
+
+
+def with_etag(response, etag):
+    """Set the ETag of a response, and return a 304 response instead if it matches the request's If-None-Match
+    header. Response.make_conditional() only does this for GET and HEAD requests. """
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+
+    response.set_etag(etag)
+
+    return response
+
+
+def get_result_cache():
+    """Return the process-wide ResultCache, creating it from the app config on first use"""
+
+    return service.get_result_cache(app.config.get('RESULT_CACHE_SIZE'), app.config.get('RESULT_CACHE_DIR'),
+                                    app.config.get('RESULT_CACHE_DISK_SIZE'))
+
+
+def batch_documents():
+    """Return a list of (id, row generator) pairs for the documents in a batch request"""
+    from six import ensure_str
+
+    if request.mimetype == 'multipart/form-data':
+        return [(id_, CsvStreamRowGenerator(f.stream, path=f.filename or id_))
+                for id_, f in request.files.items(multi=True)]
+
+    elif request.mimetype == 'application/json':
+        docs = request.get_json()
+
+        if not isinstance(docs, list):
+            raise ClientError(400, 'Expected a JSON array of documents')
+
+        pairs = []
+
+        for i, doc in enumerate(docs):
+            if not isinstance(doc, dict):
+                raise ClientError(400, 'Document {} is not an object'.format(i))
+
+            id_ = str(doc.get('id', i))
+
+            if 'csv' in doc:
+                pairs.append((id_, CsvDataRowGenerator(ensure_str(doc['csv']), path=id_)))
+            elif 'rows' in doc:
+                pairs.append((id_, RowGenerator(doc['rows'], path=id_)))
+            else:
+                raise ClientError(400, "Document '{}' has neither 'csv' nor 'rows'".format(id_))
+
+        return pairs
+
+    else:
+        raise ClientError(415, 'Bad mime type: {}'.format(request.mimetype))
+
+
+@app.route('/v1/parse/batch', methods=['POST'])
+def parse_batch():
+    from structured_tables.serialize import dumps
+
+    check_request_size()
+
+    docs = batch_documents()
+
+    ids = [id_ for id_, rg in docs]
+
+    if len(set(ids)) != len(ids):
+        raise ClientError(400, 'Document ids are not unique')
+
+    declare_cache = BatchDeclareCache()
+
+    bundle = app.config.get('DECLARE_BUNDLE')
 
-    d = term_interp.as_dict()
+    results = {id_: parse_document(rg, declare_cache, bundle, base_dir()) for id_, rg in docs}
 
-    return jsonify(dict(result=d, errors=term_interp.errors_as_dict()))
+    with timed('serialize'):
+        return Response(dumps(dict(results=results, errors=[])), mimetype='application/json')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,151 @@
+# Copyright (c) 2016 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+The parts of the parse API that don't depend on a web framework, shared by the Flask server in
+structured_tables.server and the bottle app in structured_tables.app.
+
+Documents posted to the API can't reference local Declare and Include documents, unless the server is
+given a base directory, in which case they may reference the documents in it.
+
+"""
+
+CONTENT_TYPES = ('application/json', 'text/csv')
+
+_result_cache = None
+
+
+class BadDocument(ValueError):
+    """A request body that can't be read as its content type"""
+
+
+def get_result_cache(max_size=None, directory=None, disk_size=None):
+    """Return the process-wide ResultCache for the parse API, creating it on first use. The arguments are only
+    used when it is created. It uses the shared cache set by structured_tables.cache.configure_shared_cache()"""
+    global _result_cache
+    from . import cache
+
+    if _result_cache is None:
+        _result_cache = cache.ResultCache(max_size or cache.DEFAULT_RESULT_CACHE_SIZE, directory, disk_size,
+                                          shared=cache.shared_cache)
+
+    return _result_cache
+
+
+def row_generator(data, content_type):
+    """Return a row generator for a request body: either CSV, or a JSON list of rows. Raises BadDocument if
+    the body isn't valid JSON"""
+    import json
+    from .parser import RowGenerator, CsvDataRowGenerator
+
+    if content_type == 'application/json':
+        try:
+            rows = json.loads(data)
+        except ValueError as e:
+            raise BadDocument('Invalid JSON: {}'.format(e))
+
+        if not isinstance(rows, list):
+            raise BadDocument('Expected a JSON array of rows')
+
+        return RowGenerator(rows)
+    elif content_type == 'text/csv':
+        return CsvDataRowGenerator(data)
+    else:
+        raise ValueError('Bad mime type: {}'.format(content_type))
+
+
+def interpret(term_interp):
+    """Return the result dict and the errors of a TermInterpreter, recording the time to parse, the number of
+    terms and the errors in the metrics"""
+    from .parser import build_dict
+    from .metrics import timed, TERMS, record_errors
+
+    n = [0]
+
+    def counted(terms):
+        for t in terms:
+            n[0] += 1
+            yield t
+
+    with timed('parse'):
+        d = build_dict(counted(term_interp))
+
+    TERMS.observe(n[0])
+    record_errors(term_interp.errors)
+
+    return d, term_interp.errors_as_dict()
+
+
+def parse_document(rg, declare_cache=None, bundle=None, base_dir=False):
+    """Parse the rows from a row generator, returning a dict with the result and errors. Errors that stop
+    the parse, including unexpected ones like a malformed CSV stream, are returned in the errors, with a
+    result of None, so one document can't fail a batch
+
+    :param base_dir: Directory of the local Declare and Include documents that may be referenced, or False
+    for none
+    """
+    from .parser import TermGenerator, TermInterpreter, ParserError
+    from .metrics import record_errors
+
+    try:
+        term_interp = TermInterpreter(TermGenerator(rg), declare_cache=declare_cache, bundle=bundle,
+                                      base_dir=base_dir)
+        d, errors = interpret(term_interp)
+        return dict(result=d, errors=errors)
+    except ParserError as e:
+        record_errors([e])
+        return dict(result=None, errors=[dict(file=rg.path, row=None, col=None, term=None, error=str(e))])
+    except Exception as e:
+        record_errors([e])
+        return dict(result=None, errors=[dict(file=rg.path, row=None, col=None, term=None,
+                                              error='{}: {}'.format(type(e).__name__, e))])
+
+
+def parse_cached(data, content_type, result_cache=None, bundle=None, base_dir=False):
+    """Parse a request body, returning the ETag and JSON text of the response. The response is taken from the
+    result cache if the same body has been parsed before, and the Declare and Include documents it used haven't
+    changed.
+    The ETag is None if the result could not be cached.
+
+    :param data: The request body
+    :param content_type: text/csv or application/json
+    :param result_cache: A ResultCache. Defaults to the one from get_result_cache()
+    :param bundle: Optional declaration bundle to use for the parse
+    :param base_dir: Directory of the local Declare and Include documents that may be referenced, or False
+    for none
+    """
+    from .bundle import bundle_hash
+    from .cache import BatchDeclareCache
+    from .parser import TermGenerator, TermInterpreter
+    from .metrics import timed
+    from .serialize import dumps
+
+    if content_type not in CONTENT_TYPES:
+        raise ValueError('Bad mime type: {}'.format(content_type))
+
+    if result_cache is None:
+        result_cache = get_result_cache()
+
+    # Replicas with different bundles or base directories may share a cache
+    key = result_cache.key(data, content_type + (';' + bundle_hash(bundle) if bundle else '') +
+                           (';' + base_dir if base_dir else ''))
+
+    cached = result_cache.get(key)
+
+    if cached is not None:
+        return cached
+
+    declare_cache = BatchDeclareCache()  # To record the Declare documents used by the parse
+
+    term_gen = TermGenerator(row_generator(data, content_type))
+
+    term_interp = TermInterpreter(term_gen, declare_cache=declare_cache, bundle=bundle, base_dir=base_dir)
+
+    d, errors = interpret(term_interp)
+
+    with timed('serialize'):
+        body = dumps(dict(result=d, errors=errors))
+
+    refs = declare_cache.refs + [ref for ref in term_gen.includes if ref not in declare_cache.refs]
+
+    return result_cache.put(key, refs, body), body
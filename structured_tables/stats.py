@@ -0,0 +1,140 @@
+# Copyright (c) 2016 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Opt-in instrumentation for the parser pipeline. Pass a ParserStats to a TermGenerator or TermInterpreter,
+and each stage counts what it does and times itself. Because the stages are generators that run
+interleaved, each stage is charged only for its own time: the time spent in the stages it pulls items from
+is subtracted.
+
+    stats = ParserStats()
+    ti = TermInterpreter(TermGenerator(CsvPathRowGenerator(path)), stats=stats)
+    d = ti.as_dict()
+    print(ti.stats.format())
+
+"""
+
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from timeit import default_timer as wall_clock
+
+try:
+    cpu_clock = time.process_time
+except AttributeError:  # Python 2, where time.clock() is processor time on Unix
+    cpu_clock = time.clock
+
+COUNTERS = ('rows_read', 'blank_rows_skipped', 'comments_skipped', 'terms_emitted', 'arg_children_created',
+            'synonyms_substituted', 'handlers_invoked')
+
+
+class ParserStats(object):
+    """Counters, and cumulative wall and CPU time, for each stage of the parser pipeline. Not thread safe;
+    use one for each parse."""
+
+    def __init__(self):
+
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.handlers = defaultdict(int)  # Invocations of each special term handler, by handler name
+        self.items = defaultdict(int)  # Items produced by each stage
+        self.wall = defaultdict(float)  # Seconds of wall time in each stage, excluding nested stages
+        self.cpu = defaultdict(float)  # Seconds of CPU time in each stage, excluding nested stages
+        self.stages = []  # Stage names, in the order they first ran
+
+        self._nested = []  # [wall, cpu] time of the nested stages, for each stage that is running
+
+    def _start(self):
+        self._nested.append([0.0, 0.0])
+        return wall_clock(), cpu_clock()
+
+    def _stop(self, stage, w0, c0):
+        w = wall_clock() - w0
+        c = cpu_clock() - c0
+
+        nested_w, nested_c = self._nested.pop()
+
+        if stage not in self.wall:
+            self.stages.append(stage)
+
+        self.wall[stage] += w - nested_w
+        self.cpu[stage] += c - nested_c
+
+        if self._nested:
+            self._nested[-1][0] += w
+            self._nested[-1][1] += c
+
+    def iterate(self, iterable, stage, counter=None):
+        """Yield the items of iterable, charging the time taken to produce them to stage
+
+        :param counter: Optional name of a counter to increment for each item
+        """
+
+        it = iter(iterable)
+
+        while True:
+            w0, c0 = self._start()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                self._stop(stage, w0, c0)
+
+            self.items[stage] += 1
+
+            if counter:
+                self.counters[counter] += 1
+
+            yield item
+
+    @contextmanager
+    def timing(self, stage):
+        """Charge the time spent in the with block to stage"""
+
+        w0, c0 = self._start()
+        try:
+            yield
+        finally:
+            self._stop(stage, w0, c0)
+
+    def count(self, counter, n=1):
+        self.counters[counter] += n
+
+    def handler(self, name):
+        """Record an invocation of a special term handler, and return a context for timing it"""
+
+        self.counters['handlers_invoked'] += 1
+        self.handlers[name] += 1
+
+        return self.timing('TermInterpreter.' + name)
+
+    def as_dict(self):
+
+        return {
+            'counters': dict(self.counters),
+            'handlers': dict(self.handlers),
+            'stages': {s: {'items': self.items.get(s, 0), 'wall': self.wall[s], 'cpu': self.cpu[s]}
+                       for s in self.stages}
+        }
+
+    def format(self):
+        """Return a report of the stages and counters, as a string"""
+
+        lines = ['{:32s} {:>10s} {:>10s} {:>10s}'.format('Stage', 'Items', 'Wall', 'CPU')]
+
+        for s in self.stages:
+            lines.append('{:32s} {:>10s} {:10.4f} {:10.4f}'.format(
+                s, str(self.items[s]) if s in self.items else '-', self.wall[s], self.cpu[s]))
+
+        lines.append('{:32s} {:>10s} {:10.4f} {:10.4f}'.format(
+            'Total', '', sum(self.wall.values()), sum(self.cpu.values())))
+
+        lines.append('')
+
+        for k in COUNTERS:
+            lines.append('{:32s} {:10d}'.format(k, self.counters[k]))
+
+        for k, v in sorted(self.handlers.items()):
+            lines.append('  {:30s} {:10d}'.format(k, v))
+
+        return '\n'.join(lines)
@@ -64,7 +64,7 @@ class MyTestCase(unittest.TestCase):
     def test_terms(self):
         from os.path import dirname, join
         from structured_tables import TermGenerator, TermInterpreter
-        from structured_tables import CsvPathRowGenerator, CsvDataRowGenerator, RowGenerator
+        from structured_tables import CsvPathRowGenerator, CsvDataRowGenerator, RowGenerator, BufferedCsvRowGenerator
         import csv
         import json
 
@@ -77,6 +77,7 @@ class MyTestCase(unittest.TestCase):
             row_data = [row for row in csv.reader(f)]
 
         for rg_args in ( (CsvPathRowGenerator,fn),
+                    (BufferedCsvRowGenerator,fn),
                     (CsvDataRowGenerator,str_data, fn),
                     (RowGenerator,row_data, fn) ):
 
@@ -134,6 +135,146 @@ class MyTestCase(unittest.TestCase):
 
         print(json.dumps(term_interp.declare_dict, indent=4))
 
+    def test_resolution(self):
+        from structured_tables import RowGenerator, TermGenerator, TermInterpreter
+
+        rows = [['Table', 'foo'], ['Table.Column', 'bar']]
+
+        ti = TermInterpreter(TermGenerator(RowGenerator(rows)))
+
+        terms = list(ti)
+        self.assertEqual(['any', 'any'], [t.child_property_type for t in terms])
+        self.assertEqual([False, False], [t.valid for t in terms])
+
+        # Declaring terms after an iteration must invalidate the compiled lookups
+        ti.import_declare_doc({'declareterm': [
+            {'term_name': 'Table', 'termvaluename': 'name'},
+            {'term_name': 'Table.Column', 'termvaluename': 'name', 'childpropertytype': 'sequence'}]})
+
+        terms = list(ti)
+        self.assertEqual(['any', 'sequence'], [t.child_property_type for t in terms])
+        self.assertEqual(['name', 'name'], [t.term_value_name for t in terms])
+        self.assertEqual([True, True], [t.valid for t in terms])
+
+        self.assertEqual({'table': {'name': 'foo', 'column': ['bar']}}, ti.as_dict())
+
+    def test_build_dict(self):
+        from os.path import dirname, join
+        from structured_tables import TermGenerator, TermInterpreter, CsvPathRowGenerator
+        from structured_tables import link_terms, convert_to_dict, build_dict
+
+        for name in ('example1.csv', 'example2.csv', 'nested.csv', 'childpropertytype.csv', 'metadata.csv'):
+            fn = join(dirname(__file__), 'data', name)
+
+            terms = list(TermInterpreter(TermGenerator(CsvPathRowGenerator(fn))))
+
+            self.assertEqual(convert_to_dict(link_terms(terms)), build_dict(terms))
+
+        self.assertIsNone(build_dict([]))
+
+    def test_deep_nesting(self):
+        from structured_tables import Term, link_terms, convert_to_dict, build_dict
+
+        depth = 5000  # Well past the recursion limit
+
+        terms = [Term('t0', 'v0')] + [Term('t{}.t{}'.format(i - 1, i), 'v{}'.format(i)) for i in range(1, depth)]
+
+        # Compare level by level; comparing the whole dicts would hit the recursion limit
+        for d in (convert_to_dict(link_terms(terms)), build_dict(terms)):
+            for i in range(depth - 1):
+                self.assertEqual('v{}'.format(i), d['t{}'.format(i)]['@value'])
+                d = d['t{}'.format(i)]
+
+            self.assertEqual({'t{}'.format(depth - 1): 'v{}'.format(depth - 1), '@value': 'v{}'.format(depth - 2)}, d)
+
+    def test_events(self):
+        from os.path import dirname, join
+        from structured_tables import TermGenerator, TermInterpreter, CsvPathRowGenerator
+        from structured_tables import TermEventGenerator, TermEventHandler
+
+        fn = join(dirname(__file__), 'data', 'example1.csv')
+
+        class ColumnHandler(TermEventHandler):
+            """Collect the Column records of the Schema section as flat dicts"""
+
+            def __init__(self):
+                self.sections = []
+                self.columns = []
+                self.record = None
+
+            def start_section(self, section_name):
+                self.sections.append(section_name)
+
+            def start_record(self, term):
+                self.record = {'name': term.value, 'parent': term.parent_term} if term.record_term == 'column' else None
+
+            def child(self, term):
+                if self.record is not None:
+                    self.record[term.record_term] = term.value
+
+            def end_record(self, term):
+                if self.record is not None:
+                    self.columns.append(self.record)
+                    self.record = None
+
+        h = TermEventGenerator(TermInterpreter(TermGenerator(CsvPathRowGenerator(fn)))).dispatch(ColumnHandler())
+
+        self.assertEqual(['root', 'resources', 'contacts', 'notes', 'schema'], h.sections)
+        self.assertEqual(27, len(h.columns))
+        self.assertEqual({'name': 'reportyear', 'parent': 'table', 'datatype': 'int', 'valuetype': 'year range',
+                          'description': 'Year or years that indicator was reported'}, h.columns[0])
+
+        events = list(TermEventGenerator(TermInterpreter(TermGenerator(CsvPathRowGenerator(fn)))))
+
+        # Events are balanced, and Columns nest inside their Table
+        depth = 0
+        for event, payload in events:
+            if event == 'start_record':
+                if payload.record_term == 'column':
+                    self.assertEqual(1, depth)
+                depth += 1
+            elif event == 'end_record':
+                depth -= 1
+            self.assertGreaterEqual(depth, 0)
+
+        self.assertEqual(0, depth)
+
+    def test_parse_files(self):
+        import tempfile
+        from os.path import dirname, join
+        from structured_tables import TermGenerator, TermInterpreter, CsvPathRowGenerator
+        from structured_tables.batch import parse_files, iparse_files
+
+        names = ['example1.csv', 'example2.csv', 'nested.csv', 'missing.csv', 'errors.csv']
+        fns = [join(dirname(__file__), 'data', name) for name in names]
+
+        results = parse_files(fns, declare=[join(dirname(__file__), 'data', 'metadata.csv')], processes=2)
+
+        self.assertEqual(fns, [r['path'] for r in results])
+
+        ti = TermInterpreter(TermGenerator(CsvPathRowGenerator(fns[0])))
+        self.assertEqual(ti.as_dict(), results[0]['result'])
+        self.assertEqual([], results[0]['errors'])
+
+        self.assertIsNone(results[3]['result'])
+        self.assertIn('Failed to find file', results[3]['errors'][0]['error'])
+
+        self.assertEqual(1, len(results[4]['errors']))
+
+        unordered = list(iparse_files(fns, processes=2, ordered=False))
+        self.assertEqual(list(range(len(fns))), sorted(r['index'] for r in unordered))
+
+        # A file that can't be read as CSV is reported in its own errors, and doesn't stop the batch
+        with tempfile.NamedTemporaryFile(suffix='.csv') as f:
+            f.write(b'Title,\x00\xff\n')
+            f.flush()
+
+            results = parse_files([f.name, fns[0]], processes=1)
+
+        self.assertIsNone(results[0]['result'])
+        self.assertEqual(1, len(results[0]['errors']))
+        self.assertEqual(ti.as_dict(), results[1]['result'])
+
     def test_interpretation(self):
         from os.path import dirname, join
         from structured_tables import TermGenerator, TermInterpreter, link_terms, convert_to_dict
@@ -248,6 +389,84 @@ class MyTestCase(unittest.TestCase):
             self.assertEquals(flt['note.1'], 'Include File 2')
             self.assertEquals(flt['note.2'], 'Include File 3')
 
+    def test_include_fragments(self):
+        import os
+        import tempfile
+        import shutil
+        from os.path import join
+        from structured_tables import TermGenerator, TermInterpreter, CsvPathRowGenerator, IncludeError
+        from structured_tables.cache import fragment_cache
+
+        d = tempfile.mkdtemp()
+
+        def write(name, *rows):
+            with open(join(d, name), 'w') as f:
+                f.write('\n'.join(rows) + '\n')
+
+        try:
+            os.mkdir(join(d, 'sub'))
+            write('doc.csv', 'Note,Doc', 'Include,common.csv', 'Include,sub/other.csv', 'Include,common.csv')
+            write('common.csv', 'Note,Common', 'Keyword,shared')
+            write('sub/other.csv', 'Note,Other', 'Include,../common.csv')
+
+            fragment_cache.clear()
+
+            terms = list(TermGenerator(CsvPathRowGenerator(join(d, 'doc.csv'))))
+
+            self.assertEqual(['Doc', 'common.csv', 'Common', 'shared', 'sub/other.csv', 'Other', '../common.csv',
+                              'Common', 'shared', 'common.csv', 'Common', 'shared'],
+                             [t.value for t in terms])
+            self.assertTrue(terms[2].file_name.endswith('common.csv'))
+            self.assertEqual(1, terms[2].row)
+
+            # Each fragment is parsed once, and the generated terms are copies of the cached ones
+            self.assertEqual(2, fragment_cache.misses)
+            self.assertEqual(3, len(set(id(t) for t in (terms[2], terms[7], terms[10]))))
+
+            ti = TermInterpreter(TermGenerator(CsvPathRowGenerator(join(d, 'doc.csv'))))
+            self.assertEqual(['Doc', 'Common', 'Other', 'Common', 'Common'], ti.as_dict()['note'])
+            self.assertEqual(2, fragment_cache.misses)
+
+            # Cycles are reported as errors on the Include terms, instead of recursing forever
+            write('common.csv', 'Note,Common', 'Include,sub/other.csv')
+
+            tg = TermGenerator(CsvPathRowGenerator(join(d, 'doc.csv')))
+            terms = list(tg)
+
+            self.assertEqual(3, len(tg.errors))
+            self.assertIsInstance(tg.errors[0], IncludeError)
+            self.assertIn('cycle', str(tg.errors[0]))
+            self.assertEqual('../common.csv', tg.errors[0].term.value)
+
+            write('doc.csv', 'Note,Doc', 'Include,doc.csv', 'Include,missing.csv')
+
+            ti = TermInterpreter(TermGenerator(CsvPathRowGenerator(join(d, 'doc.csv'))))
+
+            self.assertEqual('Doc', ti.as_dict()['note'])
+
+            errors = ti.errors_as_dict()
+
+            self.assertEqual([2, 3], [e['row'] for e in errors])
+            self.assertIn('cycle', errors[0]['error'])
+            self.assertIn('Failed to find file', errors[1]['error'])
+
+            # With a base directory, documents outside of it can't be included
+            write('doc.csv', 'Note,Doc', 'Include,common.csv', 'Include,../outside.csv', 'Include,/etc/passwd')
+            write('common.csv', 'Note,Common')
+
+            tg = TermGenerator(CsvPathRowGenerator(join(d, 'doc.csv')), base_dir=d)
+
+            self.assertEqual(['Doc', 'common.csv', 'Common', '../outside.csv', '/etc/passwd'], [t.value for t in tg])
+            self.assertEqual(['../outside.csv', '/etc/passwd'], [e.term.value for e in tg.errors])
+            self.assertIn('outside of the base directory', str(tg.errors[0]))
+
+            tg = TermGenerator(CsvPathRowGenerator(join(d, 'doc.csv')), base_dir=False)
+            list(tg)
+            self.assertEqual(3, len(tg.errors))
+        finally:
+            fragment_cache.clear()
+            shutil.rmtree(d)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,352 @@
+import unittest
+
+from structured_tables.benchmark import best_time, BENCHMARK
+
+
+def synthetic_rows(n_rows, n_terms=10):
+    """Generate the rows of a large metadata document, using terms that are declared
+    by synthetic_declare_doc()"""
+
+    rows = [['Section', 'Resources', 'table', 'grain', 'title']]
+
+    for i in range(n_rows):
+        rows.append(['Term{}'.format(i % n_terms), 'value {}'.format(i), 'table{}'.format(i), 'Tract', ''])
+
+    return rows
+
+
+def synthetic_declare_doc(n_terms):
+    """A declare document, in the form produced by DeclareTermInterpreter.as_dict(), with
+    n_terms declared terms, every other one of which has a synonym"""
+
+    terms = []
+
+    for i in range(n_terms):
+        e = {'term_name': 'Term{}'.format(i), 'section': 'resources'}
+
+        if i % 2:
+            e['synonym'] = 'Term{}.Alt'.format(i - 1)
+
+        terms.append(e)
+
+    return {'declareterm': terms}
+
+
+def synthetic_schema_rows(n_tables, n_columns):
+    """Generate the rows of a Schema section with many repeated Table and Column terms"""
+
+    rows = [['Section', 'Schema', 'datatype', 'valuetype', 'description']]
+
+    for i in range(n_tables):
+        rows.append(['Table', 'table{}'.format(i), '', '', 'Table {}'.format(i)])
+
+        for j in range(n_columns):
+            rows.append(['Table.Column', 'column{}'.format(j), 'int', 'count', 'Column {}'.format(j)])
+
+    return rows
+
+
+def recursive_convert_to_dict(term):
+    """The original, recursive version of convert_to_dict, which decides between a scalar and a
+    list by catching exceptions. Used as a reference for the benchmarks. """
+
+    if term.children:
+
+        d = {}
+
+        for c in term.children:
+
+            if c.child_property_type == 'scalar':
+                d[c.record_term] = recursive_convert_to_dict(c)
+
+            elif c.child_property_type == 'sequence':
+                try:
+                    d[c.record_term].append(recursive_convert_to_dict(c))
+                except (KeyError, AttributeError):
+                    d[c.record_term] = [recursive_convert_to_dict(c)]
+
+            else:
+                try:
+                    d[c.record_term].append(recursive_convert_to_dict(c))
+                except KeyError:
+                    d[c.record_term] = recursive_convert_to_dict(c)
+                except AttributeError as e:
+                    d[c.record_term] = [d[c.record_term]] + [recursive_convert_to_dict(c)]
+
+        if term.value:
+            d[term.term_value_name] = term.value
+
+        return d
+
+    else:
+        return term.value
+
+
+class DictTerm(object):
+    """The original layout of Term, with the attributes in a per-instance __dict__ and a children list
+    for every term. Used as a reference for the memory benchmark. """
+
+    def __init__(self, term, value, term_args=[]):
+        from structured_tables import Term
+
+        self.parent_term, self.record_term = Term.split_term_lower(term)
+        self.value = value.strip() if value else None
+        self.args = [x.strip() for x in term_args]
+        self.section = None
+        self.file_name = None
+        self.row = None
+        self.col = None
+        self.term_value_name = '@value'
+        self.child_property_type = 'any'
+        self.valid = None
+        self.is_arg_child = None
+        self.children = []
+
+
+def term_bytes(t):
+    """Bytes used by a term object and its containers, excluding the strings, which are the same
+    for all layouts. """
+    import sys
+
+    size = sys.getsizeof(t) + sys.getsizeof(t.args) + sys.getsizeof(t.children)
+
+    if hasattr(t, '__dict__'):
+        size += sys.getsizeof(t.__dict__)
+
+    return size
+
+
+def time_interpretation(rows, declare_doc, repeat=3):
+    """Return the best time to interpret a set of rows"""
+    from structured_tables import RowGenerator, TermGenerator, TermInterpreter
+
+    def setup():
+        ti = TermInterpreter(TermGenerator(RowGenerator(rows)))
+        ti.import_declare_doc(declare_doc)
+        return ti
+
+    return best_time(lambda ti: sum(1 for t in ti), repeat, setup)
+
+
+class BenchmarkTestCase(unittest.TestCase):
+
+    @unittest.skipUnless(BENCHMARK, 'Set STRUCT_TAB_BENCH to run timing comparisons')
+    def test_synonym_scaling(self):
+        """Interpretation time should grow with the number of rows, not with the number of
+        rows times the number of declared terms"""
+
+        n_rows = 5000
+
+        base = time_interpretation(synthetic_rows(n_rows), synthetic_declare_doc(10))
+
+        for n_terms in (100, 1000):
+            t = time_interpretation(synthetic_rows(n_rows), synthetic_declare_doc(n_terms))
+            print('{} declared terms, {} rows: {:0.4f}s ({:0.2f}x)'.format(n_terms, n_rows, t, t / base))
+            self.assertLess(t / base, 3)
+
+        t1 = time_interpretation(synthetic_rows(n_rows), synthetic_declare_doc(1000))
+        t2 = time_interpretation(synthetic_rows(n_rows * 4), synthetic_declare_doc(1000))
+        print('4x rows: {:0.2f}x time'.format(t2 / t1))
+        self.assertLess(t2 / t1, 8)
+
+    def test_synonym_index(self):
+        from structured_tables import RowGenerator, TermGenerator, TermInterpreter
+
+        ti = TermInterpreter(TermGenerator(RowGenerator(synthetic_rows(10))))
+        ti.import_declare_doc(synthetic_declare_doc(4))
+
+        self.assertEqual({'<no_term>.term1': 'Term0.Alt', '<no_term>.term3': 'Term2.Alt'}, ti.synonyms)
+
+        # Redeclaring a term without a synonym removes it from the index
+        ti.import_declare_doc({'declareterm': [{'term_name': 'Term1'}]})
+        self.assertEqual({'<no_term>.term3': 'Term2.Alt'}, ti.synonyms)
+
+        terms = list(ti)
+        self.assertEqual(('term2', 'alt'), (terms[9].parent_term, terms[9].record_term))
+
+
+    def test_convert_to_dict(self):
+        """The iterative convert_to_dict gives the same result as the recursive version"""
+        from structured_tables import RowGenerator, TermGenerator, TermInterpreter, link_terms, convert_to_dict
+
+        for n_tables, n_columns in ((1, 2000), (20, 100)):
+            root = link_terms(TermInterpreter(TermGenerator(RowGenerator(synthetic_schema_rows(n_tables, n_columns)))))
+
+            self.assertEqual(recursive_convert_to_dict(root), convert_to_dict(root))
+
+    @unittest.skipUnless(BENCHMARK, 'Set STRUCT_TAB_BENCH to run timing comparisons')
+    def test_convert_to_dict_time(self):
+        """Compare the iterative convert_to_dict with the recursive version on wide sections of repeated terms"""
+        from structured_tables import RowGenerator, TermGenerator, TermInterpreter, link_terms, convert_to_dict
+
+        for n_tables, n_columns in ((1, 20000), (200, 100)):
+            root = link_terms(TermInterpreter(TermGenerator(RowGenerator(synthetic_schema_rows(n_tables, n_columns)))))
+
+            t_old = best_time(lambda: recursive_convert_to_dict(root))
+            t_new = best_time(lambda: convert_to_dict(root))
+
+            print('{} tables x {} columns: recursive {:0.4f}s, iterative {:0.4f}s ({:0.2f}x)'
+                  .format(n_tables, n_columns, t_old, t_new, t_new / t_old))
+
+            self.assertLess(t_new / t_old, 1.5)
+
+    def test_term_layout(self):
+        """Terms have slots rather than a __dict__, and only allocate children when they get the first one"""
+        from structured_tables import Term, RowGenerator, TermGenerator, TermInterpreter
+
+        terms = list(TermInterpreter(TermGenerator(RowGenerator(synthetic_rows(10)))))
+
+        self.assertTrue(hasattr(Term, '__slots__'))
+        self.assertFalse(hasattr(terms[0], '__dict__'))
+
+        self.assertEqual((), terms[1].children)
+        terms[0].add_child(terms[1])
+        self.assertEqual([terms[1]], terms[0].children)
+
+        # Clones don't share the children list
+        clone = terms[0].clone()
+        self.assertEqual((), clone.clone().children[0].children)
+
+        clone.add_child(terms[2])
+        self.assertEqual([terms[1]], terms[0].children)
+        self.assertEqual([terms[1], terms[2]], clone.children)
+
+    @unittest.skipUnless(BENCHMARK, 'Set STRUCT_TAB_BENCH to run memory comparisons')
+    def test_term_memory(self):
+        """Compare the memory used by terms with the original, dict based layout. Set STRUCT_TAB_BENCH_TERMS
+        to change the number of terms, which defaults to 100,000. """
+        import os
+        from timeit import default_timer as timer
+        from structured_tables import RowGenerator, TermGenerator, TermInterpreter
+
+        n_terms = int(os.getenv('STRUCT_TAB_BENCH_TERMS', 100000))
+
+        # Each row produces the term and two arg children.
+        rows = synthetic_rows(n_terms // 3)
+
+        t0 = timer()
+        terms = list(TermInterpreter(TermGenerator(RowGenerator(rows))))
+        t_interp = timer() - t0
+
+        slotted = sum(term_bytes(t) for t in terms) / float(len(terms))
+        original = sum(term_bytes(DictTerm(t.record_term, t.value, t.args)) for t in terms) / float(len(terms))
+
+        print('{} terms in {:0.3f}s. Bytes per term: original {:0.0f}, slotted {:0.0f} ({:0.2f}x)'
+              .format(len(terms), t_interp, original, slotted, slotted / original))
+
+        # Python 3 already shares the keys of instance dicts, so the saving is smaller than on Python 2
+        self.assertLess(slotted / original, 0.75)
+
+
+    def write_large_csv(self, fn, n_rows):
+        """Write a document with many blank and comment rows"""
+        import csv
+
+        with open(fn, 'w') as f:
+            w = csv.writer(f)
+
+            for i, row in enumerate(synthetic_rows(n_rows)):
+                if i % 3 == 0:
+                    w.writerow(['#', 'A comment about the next rows', '', '', ''])
+                    w.writerow(['', '', '', '', ''])
+
+                w.writerow(row)
+
+    def test_row_generators(self):
+        """The buffered row generator produces the same terms as the default one, and closes the file"""
+        import os
+        import shutil
+        import tempfile
+        from os.path import join
+        from structured_tables import TermGenerator, CsvPathRowGenerator, BufferedCsvRowGenerator
+
+        d = tempfile.mkdtemp()
+
+        def open_files():
+            return len(os.listdir('/proc/self/fd')) if os.path.isdir('/proc/self/fd') else None
+
+        try:
+            fn = join(d, 'large.csv')
+            self.write_large_csv(fn, 300)
+
+            def terms(rg):
+                return [(t.row, t.col, t.record_term, t.value) for t in TermGenerator(rg)]
+
+            n_files = open_files()
+
+            self.assertEqual(terms(CsvPathRowGenerator(fn)), terms(BufferedCsvRowGenerator(fn)))
+
+            rg = BufferedCsvRowGenerator(fn)
+            rows = list(rg)
+
+            self.assertEqual(300 + 1 + 2 * 101, len(rows))
+            self.assertEqual(n_files, open_files())  # Closed when the rows are exhausted, although rg is alive
+            self.assertEqual(rows, list(rg))
+        finally:
+            shutil.rmtree(d)
+
+    @unittest.skipUnless(BENCHMARK, 'Set STRUCT_TAB_BENCH to run timing comparisons')
+    def test_row_generators_time(self):
+        """Compare reading a large file, with many blank and comment rows, through the default
+        and buffered row generators"""
+        import shutil
+        import tempfile
+        from os.path import join
+        from structured_tables import TermGenerator, CsvPathRowGenerator, BufferedCsvRowGenerator
+
+        d = tempfile.mkdtemp()
+
+        try:
+            fn = join(d, 'large.csv')
+            self.write_large_csv(fn, 100000)
+
+            def terms(rg):
+                return [(t.row, t.col, t.record_term, t.value) for t in TermGenerator(rg)]
+
+            for label, f in (('Rows', lambda rg: sum(1 for row in rg)), ('Terms', terms)):
+                t_csv = best_time(lambda: f(CsvPathRowGenerator(fn)))
+                t_buf = best_time(lambda: f(BufferedCsvRowGenerator(fn)))
+
+                print('{} from file: csv {:0.4f}s, buffered {:0.4f}s ({:0.2f}x)'
+                      .format(label, t_csv, t_buf, t_buf / t_csv))
+
+                if label == 'Rows':
+                    self.assertLess(t_buf / t_csv, 1.05)
+        finally:
+            shutil.rmtree(d)
+
+    def test_pipeline_stages(self):
+        """Run the benchmark suites on small documents, and check the comparison with a baseline"""
+        import copy
+        from structured_tables.benchmark import run_suites, find_regressions, format_results, have_tracemalloc, STAGES
+
+        results = run_suites(['rows', 'synonyms'], repeat=1, scale=0.1)
+
+        text = format_results(results)
+        print(text)
+
+        self.assertIn('Process max RSS', text)
+
+        if not have_tracemalloc():
+            self.assertIsNone(results['rows']['stages']['TermGenerator']['peak_bytes'])
+            self.assertIn('needs tracemalloc', text)
+
+        self.assertEqual(['rows', 'synonyms'], sorted(results.keys()))
+        self.assertEqual(set(STAGES), set(results['rows']['stages'].keys()))
+        self.assertEqual(5000, results['rows']['config']['n_rows'])
+        self.assertEqual(5000 + 4, results['rows']['stages']['CsvPathRowGenerator']['items'])
+
+        self.assertEqual([], find_regressions(results, results))
+
+        baseline = copy.deepcopy(results)
+        baseline['rows']['stages']['TermGenerator']['seconds'] /= 2
+        baseline['synonyms']['config']['n_rows'] += 1  # Different documents are not compared
+
+        regressions = find_regressions(results, baseline, tolerance=0.5)
+
+        self.assertEqual(1, len(regressions))
+        self.assertTrue(regressions[0].startswith('rows TermGenerator seconds'))
+
+
+if __name__ == '__main__':
+    unittest.main()
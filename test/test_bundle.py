@@ -0,0 +1,66 @@
+import unittest
+
+
+class BundleTestCase(unittest.TestCase):
+
+    def test_bundle(self):
+        import tempfile
+        import shutil
+        from os.path import dirname, join
+        from structured_tables import TermGenerator, TermInterpreter, CsvPathRowGenerator
+        from structured_tables.bundle import compile_bundle, write_bundle, load_bundle, bundle_hash
+        from structured_tables.cache import DeclareDocCache, resolve_ref
+
+        decl_fn = join(dirname(__file__), 'data', 'metadata.csv')
+        fn = join(dirname(__file__), 'data', 'example1.csv')
+
+        bundle = compile_bundle([decl_fn])
+
+        self.assertEqual([resolve_ref(decl_fn)], bundle['sources'])
+        self.assertNotIn('valuesets', bundle)
+        self.assertEqual('Table.Column', bundle['synonyms']['<no_term>.column'])
+        self.assertIn('schema', bundle['sections'])
+
+        d = tempfile.mkdtemp()
+
+        try:
+            for name in ('bundle.json', 'bundle.json.gz'):
+                write_bundle(bundle, join(d, name))
+                self.assertEqual(bundle['terms'], load_bundle(join(d, name))['terms'])
+                self.assertEqual(bundle_hash(bundle), bundle_hash(load_bundle(join(d, name))))
+
+            ti = TermInterpreter(TermGenerator(CsvPathRowGenerator(fn)))
+            expected = ti.as_dict()
+
+            cache = DeclareDocCache()
+            ti = TermInterpreter(TermGenerator(CsvPathRowGenerator(fn)), declare_cache=cache,
+                                 bundle=join(d, 'bundle.json.gz'))
+
+            self.assertEqual(expected, ti.as_dict())
+            self.assertEqual(0, cache.misses)  # The Declare term was satisfied by the bundle
+
+            # A different file with the same name as a bundle source is still loaded
+            shutil.copy(decl_fn, join(d, 'metadata.csv'))
+            shutil.copy(fn, join(d, 'example1.csv'))
+
+            ti = TermInterpreter(TermGenerator(CsvPathRowGenerator(join(d, 'example1.csv'))), declare_cache=cache,
+                                 bundle=bundle)
+
+            self.assertEqual(expected, ti.as_dict())
+            self.assertEqual(1, cache.misses)
+
+            # A bundle rebuilt from a changed document has a different hash
+            with open(decl_fn) as f:
+                data = f.read().replace('"Column.Valuetype"', '"Column.Units"')
+
+            with open(join(d, 'metadata.csv'), 'w') as f:
+                f.write(data)
+
+            self.assertNotEqual(bundle_hash(compile_bundle([join(d, 'metadata.csv')])),
+                                bundle_hash(compile_bundle([decl_fn])))
+        finally:
+            shutil.rmtree(d)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+import unittest
+
+
+class FakeRedis(object):
+    """Stands in for a redis.StrictRedis client"""
+
+    def __init__(self):
+        self.data = {}
+        self.down = False
+
+    def get(self, key):
+        if self.down:
+            raise IOError('Connection refused')
+
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        if self.down:
+            raise IOError('Connection refused')
+
+        self.data[key] = value.encode('utf8')
+
+
+class CacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        import shutil
+        from os.path import dirname, join
+
+        self.dir = tempfile.mkdtemp()
+
+        for fn in ('metadata.csv', 'example1.csv'):
+            shutil.copy(join(dirname(__file__), 'data', fn), self.dir)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir)
+
+    def test_lru(self):
+        from structured_tables.cache import LRUCache
+
+        c = LRUCache(2)
+        c.put('a', 1)
+        c.put('b', 2)
+        self.assertEqual(1, c.get('a'))
+        c.put('c', 3)  # Evicts 'b', the least recently used
+
+        self.assertEqual(['a', 'c'], c.keys())
+        self.assertIsNone(c.get('b'))
+
+        c.max_size = 1
+        self.assertEqual(['c'], c.keys())
+
+    def test_declare_cache(self):
+        import os
+        from os.path import join
+        from structured_tables import TermGenerator, TermInterpreter, CsvPathRowGenerator
+        from structured_tables.cache import DeclareDocCache
+
+        fn = join(self.dir, 'example1.csv')
+        cache = DeclareDocCache(max_size=2)
+
+        def parse():
+            ti = TermInterpreter(TermGenerator(CsvPathRowGenerator(fn)), declare_cache=cache)
+            return ti, ti.as_dict()
+
+        ti1, d1 = parse()
+        ti2, d2 = parse()
+
+        self.assertEqual(1, cache.misses)
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(d1, d2)
+        self.assertEqual(ti1.declare_dict, ti2.declare_dict)
+        self.assertEqual('table.column', ti2.synonyms['<no_term>.column'].lower())
+
+        # Modifying an interpreter's declarations does not alter the cached copy
+        ti2.terms['<no_term>.title']['termvaluename'] = 'foo'
+        self.assertNotIn('termvaluename', cache.get(join(self.dir, 'metadata.csv'))['terms']['<no_term>.title'])
+
+        # Changing the file invalidates the entry
+        md = join(self.dir, 'metadata.csv')
+        st = os.stat(md)
+        os.utime(md, (st.st_atime, st.st_mtime + 10))
+
+        parse()
+        self.assertEqual(2, cache.misses)
+
+    def test_declare_cache_errors(self):
+        from os.path import dirname, join
+        from structured_tables import TermGenerator, TermInterpreter, CsvPathRowGenerator
+        from structured_tables.cache import DeclareDocCache
+
+        cache = DeclareDocCache()
+
+        fn = join(dirname(__file__), 'data', 'errors.csv')
+        ti = TermInterpreter(TermGenerator(CsvPathRowGenerator(fn)), declare_cache=cache)
+        ti.as_dict()
+
+        self.assertEqual(1, len(ti.errors))
+        self.assertEqual(0, len(cache))
+
+    def test_result_cache(self):
+        import os
+        from os.path import join
+        from structured_tables.cache import ResultCache
+
+        md = join(self.dir, 'metadata.csv')
+        cache_dir = join(self.dir, 'results')
+
+        c = ResultCache(max_size=2, directory=cache_dir)
+        key = c.key(b'Declare,metadata.csv', 'text/csv')
+
+        self.assertNotEqual(key, c.key(b'Declare,metadata.csv', 'application/json'))
+        self.assertIsNone(c.get(key))
+
+        etag = c.put(key, [md], u'{"result": {}}')
+        self.assertEqual((etag, u'{"result": {}}'), c.get(key))
+
+        # A new cache, like one in another process, finds the entry in the disk tier
+        c = ResultCache(max_size=2, directory=cache_dir)
+        self.assertEqual((etag, u'{"result": {}}'), c.get(key))
+        self.assertEqual(1, len(c))
+
+        st = os.stat(md)
+        os.utime(md, (st.st_atime, st.st_mtime + 10))
+
+        self.assertIsNone(c.get(key))
+        self.assertEqual(1, c.hits)
+        self.assertEqual(1, c.misses)
+
+    def test_shared_cache(self):
+        from os.path import join
+        from structured_tables.cache import DeclareDocCache, ResultCache, RedisCache
+
+        md = join(self.dir, 'metadata.csv')
+        redis = FakeRedis()
+
+        # Two replicas, with their own local caches in front of the same Redis
+        c1 = DeclareDocCache(shared=RedisCache(redis))
+        c2 = DeclareDocCache(shared=RedisCache(redis))
+
+        d = c1.get(md)
+        self.assertEqual(1, c1.misses)
+        self.assertEqual(['structured_tables:declare:' + md], list(redis.data.keys()))
+
+        self.assertEqual(d, c2.get(md))
+        self.assertEqual((1, 0), (c2.hits, c2.misses))
+        self.assertIn(md, c2)  # Now in the local cache
+
+        r1 = ResultCache(shared=RedisCache(redis))
+        r2 = ResultCache(shared=RedisCache(redis))
+
+        key = r1.key(b'Title,Foo', 'text/csv')
+        etag = r1.put(key, [md], u'{"result": {}}')
+
+        self.assertEqual((etag, u'{"result": {}}'), r2.get(key))
+
+        # Redis failures are misses
+        redis.down = True
+        c3 = DeclareDocCache(shared=RedisCache(redis))
+        self.assertEqual(d, c3.get(md))
+        self.assertEqual(1, c3.misses)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import unittest
+
+
+class ColumnarTestCase(unittest.TestCase):
+
+    def interpreter(self, fn='example1.csv'):
+        from os.path import join, dirname
+        from structured_tables import CsvPathRowGenerator, TermGenerator, TermInterpreter
+
+        return TermInterpreter(TermGenerator(CsvPathRowGenerator(join(dirname(__file__), 'data', fn))))
+
+    def test_section_batches(self):
+        from structured_tables.columnar import section_batches
+
+        batches = list(section_batches(self.interpreter(), sections=['Schema']))
+
+        self.assertEqual(['schema.table', 'schema.column'], [b.name for b in batches])
+
+        columns = batches[1]
+
+        self.assertEqual(['section', 'parent', 'name', 'datatype', 'valuetype', 'description', 'row'],
+                         list(columns.columns))
+        self.assertEqual(27, len(columns))
+        self.assertEqual(('schema', 'registered_voters', 'reportyear', 'int', 'year range',
+                          'Year or years that indicator was reported', 30), columns.rows()[0])
+
+        # Columns without a description
+        self.assertEqual([None, None, None], columns.columns['description'][-3:])
+
+        # Batches are split, and later batches have the same columns
+        batches = list(section_batches(self.interpreter(), batch_size=10, sections=['schema']))
+
+        # The Table batch is yielded at the end of the section
+        self.assertEqual([('schema.column', 10), ('schema.column', 10), ('schema.table', 1), ('schema.column', 7)],
+                         [(b.name, len(b)) for b in batches])
+        self.assertEqual(list(columns.columns), list(batches[-1].columns))
+        self.assertEqual(columns.rows(), sum((b.rows() for b in batches if b.term == 'column'), []))
+
+        names = [b.name for b in section_batches(self.interpreter())]
+
+        self.assertIn('root.title', names)
+        self.assertIn('contacts.creator', names)
+        self.assertEqual(len(names), len(set(names)))
+
+    @unittest.skipIf(not __import__('pkgutil').find_loader('pyarrow'), 'pyarrow is not installed')
+    def test_write(self):
+        import shutil
+        import tempfile
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        from structured_tables.columnar import export
+
+        d = tempfile.mkdtemp()
+
+        try:
+            paths = export(self.interpreter(), d, batch_size=10, sections=['schema'])
+
+            table = pq.read_table(paths['schema.column'])
+
+            self.assertEqual(27, table.num_rows)
+            self.assertEqual('reportyear', table.column('name').to_pylist()[0])
+            self.assertEqual(pa.int64(), table.schema.field('row').type)
+
+            paths = export(self.interpreter(), d, 'arrow', sections=['schema'])
+
+            with pa.memory_map(paths['schema.column']) as f:
+                self.assertEqual(27, pa.ipc.open_file(f).read_all().num_rows)
+        finally:
+            shutil.rmtree(d)
+
+    def collisions(self):
+        """An interpreter for a document with arguments named like the built in columns, and a column that
+        only appears in the second batch of its table, with a batch size of 2"""
+        from structured_tables.parser import RowGenerator, TermGenerator, TermInterpreter
+
+        return TermInterpreter(TermGenerator(RowGenerator([
+            ['Section', 'Schema', 'DataType', 'Row', 'Parent', 'Description'],
+            ['Table', 't'],
+            ['Table.Column', 'a', 'integer'],
+            ['Table.Column', 'b', 'integer'],
+            ['Table.Column', 'c', 'text', '7', 'p', 'd'],
+        ])))
+
+    def test_argument_names(self):
+        from structured_tables.columnar import section_batches
+
+        batches = [b for b in section_batches(self.collisions(), batch_size=2) if b.term == 'column']
+
+        self.assertEqual(['section', 'parent', 'value', 'datatype', 'arg_row', 'arg_parent', 'description', 'row'],
+                         list(batches[-1].columns))
+        self.assertEqual([('schema', 't', 'c', 'text', '7', 'p', 'd', 5)], batches[-1].rows())
+
+    @unittest.skipIf(not __import__('pkgutil').find_loader('pyarrow'), 'pyarrow is not installed')
+    def test_write_widened(self):
+        import os
+        import shutil
+        import tempfile
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        from structured_tables.columnar import export
+
+        d = tempfile.mkdtemp()
+
+        expected = {
+            'value': ['a', 'b', 'c'],
+            'parent': ['t', 't', 't'],
+            'arg_row': [None, None, '7'],
+            'description': [None, None, 'd'],
+            'row': [3, 4, 5]
+        }
+
+        try:
+            paths = export(self.collisions(), d, batch_size=2)
+
+            table = pq.read_table(paths['schema.column'])
+
+            for k, v in expected.items():
+                self.assertEqual(v, table.column(k).to_pylist())
+
+            paths = export(self.collisions(), d, 'arrow', batch_size=2)
+
+            with pa.memory_map(paths['schema.column']) as f:
+                table = pa.ipc.open_file(f).read_all()
+
+            for k, v in expected.items():
+                self.assertEqual(v, table.column(k).to_pylist())
+
+            self.assertEqual(sorted(['schema.table.arrow', 'schema.column.arrow', 'schema.table.parquet',
+                                     'schema.column.parquet']), sorted(os.listdir(d)))
+        finally:
+            shutil.rmtree(d)
+
+    def test_unknown_format(self):
+        from structured_tables.columnar import export
+
+        with self.assertRaises(ValueError):
+            export(self.interpreter(), '/tmp', 'csv')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,355 @@
+import os
+import unittest
+
+from structured_tables.benchmark import BENCHMARK
+from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from six.moves.socketserver import ThreadingMixIn
+
+
+class DataHandler(BaseHTTPRequestHandler):
+    """Serve the files in test/data, after a delay, with an ETag header"""
+
+    delay = 0
+    cache_control = None
+    requests = []  # (method, path, client port, status)
+
+    def _send_headers(self):
+        from os.path import dirname, join, basename
+
+        fn = join(dirname(__file__), 'data', basename(self.path.split('?')[0]))
+
+        try:
+            with open(fn, 'rb') as f:
+                body = f.read()
+        except IOError:
+            self.send_error(404)
+            return None
+
+        etag = '"{}"'.format(hash(body))
+        status = 304 if self.headers.get('If-None-Match') == etag else 200
+
+        DataHandler.requests.append((self.command, self.path, self.client_address[1], status))
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('Content-Length', str(len(body)) if status == 200 else '0')
+        self.send_header('ETag', etag)
+        if self.cache_control:
+            self.send_header('Cache-Control', self.cache_control)
+        self.end_headers()
+
+        return body if status == 200 else None
+
+    def do_HEAD(self):
+        self._send_headers()
+
+    def do_GET(self):
+        import time
+
+        time.sleep(self.delay)
+
+        body = self._send_headers()
+
+        if body is not None:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadedServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FetchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import threading
+        import tempfile
+
+        self.server = ThreadedServer(('127.0.0.1', 0), DataHandler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+
+        DataHandler.delay = 0
+        DataHandler.cache_control = None
+        DataHandler.protocol_version = 'HTTP/1.0'
+        DataHandler.requests = []
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def write_doc(self, n_declares):
+        """Write a document that declares several remote copies of metadata.csv"""
+        from os.path import join
+
+        fn = join(self.dir, 'doc.csv')
+
+        with open(fn, 'w') as f:
+            for i in range(n_declares):
+                f.write('Declare,{}/metadata.csv?n={}\n'.format(self.url, i))
+
+            f.write('Title,A Title\n')
+            f.write('Section,Schema,datatype\n')
+            f.write('Table,bar\n')
+            f.write('Column,foo,int\n')
+
+        return fn
+
+    def parse(self, fn, prefetch, declare_cache=None):
+        from structured_tables import TermGenerator, TermInterpreter, CsvPathRowGenerator
+        from structured_tables.cache import DeclareDocCache
+
+        ti = TermInterpreter(TermGenerator(CsvPathRowGenerator(fn), prefetch=prefetch),
+                             declare_cache=declare_cache if declare_cache is not None else DeclareDocCache())
+
+        return ti, ti.as_dict()
+
+    def time_parses(self):
+        """Parse a document with four slow Declare documents without and with prefetching, and return the
+        times and results"""
+        from timeit import default_timer as timer
+
+        DataHandler.delay = 0.3
+
+        fn = self.write_doc(4)
+
+        t0 = timer()
+        ti, d1 = self.parse(fn, False)
+        t_sequential = timer() - t0
+
+        self.assertEqual([], ti.errors)
+
+        t0 = timer()
+        ti, d2 = self.parse(fn, True)
+        t_prefetch = timer() - t0
+
+        print('Sequential {:0.3f}s, prefetched {:0.3f}s'.format(t_sequential, t_prefetch))
+
+        return t_sequential, t_prefetch, d1, d2
+
+    def test_prefetch(self):
+        t_sequential, t_prefetch, d1, d2 = self.time_parses()
+
+        self.assertEqual({'table': {'name': 'bar', 'column': [{'name': 'foo', 'datatype': 'int'}]}, 'title': 'A Title'},
+                         d1)
+        self.assertEqual(d1, d2)
+
+    @unittest.skipUnless(BENCHMARK, 'Set STRUCT_TAB_BENCH to run timing comparisons')
+    def test_prefetch_time(self):
+        t_sequential, t_prefetch, d1, d2 = self.time_parses()
+
+        self.assertLess(t_prefetch, t_sequential * 0.6)
+
+    def gets(self, path, expected):
+        """Return the number of GET requests for a path, waiting up to a second for it to reach expected, for
+        requests made by the prefetch threads"""
+        import time
+
+        for i in range(20):
+            n = len([r for r in DataHandler.requests if r[0] == 'GET' and r[1] == path])
+
+            if n == expected:
+                break
+
+            time.sleep(.05)
+
+        return n
+
+    def test_prefetch_scope(self):
+        from io import StringIO
+        from structured_tables import TermGenerator, CsvStreamRowGenerator
+        from structured_tables.cache import DeclareDocCache
+        from structured_tables.fetch import get_fetcher
+
+        fn = self.write_doc(2)
+        cache = DeclareDocCache()
+        paths = ['/metadata.csv?n={}'.format(i) for i in range(2)]
+
+        ti, d1 = self.parse(fn, True, cache)
+
+        # The prefetched bodies are used, rather than fetched again
+        self.assertEqual([1, 1], [self.gets(p, 1) for p in paths])
+
+        # The documents are revalidated with HEAD requests, so the prefetched bodies aren't used,
+        # and are discarded at the end of the parse
+        ti, d2 = self.parse(fn, True, cache)
+
+        self.assertEqual(d1, d2)
+        self.assertEqual(2, cache.hits)
+        self.assertEqual([2, 2], [self.gets(p, 2) for p in paths])
+
+        # So a later fetch gets the document again, rather than an old prefetched body
+        for p in paths:
+            get_fetcher().fetch(self.url + p)
+
+        self.assertEqual([3, 3], [self.gets(p, 3) for p in paths])
+
+        # Streams are read once, so they aren't scanned
+        with open(fn) as f:
+            data = f.read()
+
+        tg = TermGenerator(CsvStreamRowGenerator(StringIO(u'' + data)), prefetch=True)
+        self.assertEqual(7, len(list(tg)))
+
+    def test_timeout(self):
+        from structured_tables.fetch import Fetcher, set_fetcher
+
+        DataHandler.delay = 1
+
+        fn = self.write_doc(1)
+
+        previous = set_fetcher(Fetcher(timeout=0.2))
+
+        try:
+            for prefetch in (False, True):
+                ti, d = self.parse(fn, prefetch)
+
+                self.assertEqual(1, len(ti.errors))
+                self.assertEqual(1, ti.errors[0].term.row)
+        finally:
+            set_fetcher(previous).close()
+
+    def test_keep_alive(self):
+        from structured_tables.fetch import Fetcher
+
+        DataHandler.protocol_version = 'HTTP/1.1'
+
+        f = Fetcher()
+
+        try:
+            bodies = [f.fetch('{}/metadata.csv?n={}'.format(self.url, i)) for i in range(5)]
+            self.assertIsNotNone(f.head(self.url + '/metadata.csv'))
+            self.assertEqual(1, f.connections_opened)
+
+            f.close_idle()
+            self.assertEqual(bodies[0], f.fetch(self.url + '/metadata.csv'))
+            self.assertEqual(2, f.connections_opened)
+        finally:
+            f.close()
+
+        self.assertEqual(1, len(set(bodies)))
+        self.assertEqual(1, len(set(r[2] for r in DataHandler.requests[:-1])))  # All on one client port
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'Needs os.fork')
+    def test_fork(self):
+        import os
+        from structured_tables.fetch import Fetcher
+
+        DataHandler.protocol_version = 'HTTP/1.1'
+
+        f = Fetcher()
+
+        try:
+            body = f.fetch(self.url + '/metadata.csv')
+
+            pid = os.fork()
+
+            if pid == 0:
+                # The child opens its own connection, rather than using the parent's idle one
+                ok = f.fetch(self.url + '/metadata.csv?n=1') == body and f.connections_opened == 2
+                os._exit(0 if ok else 1)
+
+            self.assertEqual(0, os.waitpid(pid, 0)[1])
+
+            # The parent's connection still works
+            self.assertEqual(body, f.fetch(self.url + '/metadata.csv?n=2'))
+            self.assertEqual(1, f.connections_opened)
+        finally:
+            f.close()
+
+        ports = [r[2] for r in DataHandler.requests]
+
+        self.assertEqual(3, len(ports))
+        self.assertEqual(ports[0], ports[2])
+        self.assertNotEqual(ports[0], ports[1])
+
+    def test_proxy(self):
+        import os
+        from structured_tables.fetch import Fetcher
+
+        env = {k: os.environ.pop(k) for k in list(os.environ) if k.lower() in ('http_proxy', 'no_proxy')}
+
+        # The test server serves absolute urls, so it can act as the proxy for a host that doesn't exist
+        os.environ['http_proxy'] = self.url
+
+        f = Fetcher()
+
+        try:
+            with open(os.path.join(os.path.dirname(__file__), 'data', 'metadata.csv'), 'rb') as df:
+                self.assertEqual(df.read(), f.fetch('http://example.invalid/metadata.csv'))
+
+            self.assertTrue(f.head('http://example.invalid/metadata.csv')['ETag'])
+            self.assertEqual(0, f.connections_opened)
+            self.assertEqual('http://example.invalid/metadata.csv', DataHandler.requests[0][1])
+        finally:
+            f.close()
+            del os.environ['http_proxy']
+            os.environ.update(env)
+
+    def test_disk_cache(self):
+        from os.path import join
+        from structured_tables.fetch import Fetcher
+
+        url = self.url + '/metadata.csv'
+
+        DataHandler.cache_control = 'max-age=3600'
+
+        f = Fetcher(cache=join(self.dir, 'cache'))
+        body = f.fetch(url)
+
+        # Fresh responses, and their headers, come from the cache, even in a new fetcher
+        f = Fetcher(cache=join(self.dir, 'cache'))
+        self.assertEqual(body, f.fetch(url))
+        self.assertTrue(f.head(url)['ETag'])
+        self.assertEqual(1, len(DataHandler.requests))
+
+        # Stale responses are revalidated with the ETag
+        DataHandler.cache_control = 'no-cache'
+        f.cache.put(url, {'ETag': f.head(url)['ETag'], 'Cache-Control': 'no-cache'}, body)
+
+        self.assertEqual(body, f.fetch(url))
+        self.assertEqual(304, DataHandler.requests[-1][3])
+
+        # Responses with no-store aren't cached
+        DataHandler.cache_control = 'no-store'
+        f.fetch(url + '?n=1')
+        self.assertIsNone(f.cache.get(url + '?n=1'))
+
+    def test_disk_cache_eviction(self):
+        import os
+        import time
+        from os.path import join
+        from structured_tables.fetch import DiskCache
+
+        c = DiskCache(join(self.dir, 'cache'), max_size=1000)
+
+        for i in range(4):
+            c.put('http://example.com/{}'.format(i), {}, b'x' * 100)
+            path = c._path('http://example.com/{}'.format(i), '.json')
+            os.utime(path, (time.time() - 100 + i, time.time() - 100 + i))
+
+        c.get('http://example.com/0')  # Make the first entry the most recently used
+        c.max_size = 250
+        c.put('http://example.com/4', {}, b'x' * 100)
+
+        self.assertEqual(['http://example.com/0', 'http://example.com/4'],
+                         [u for u in ('http://example.com/{}'.format(i) for i in range(5)) if c.get(u)])
+
+        # The total size is kept up to date without listing the directory
+        self.assertEqual(200, c._size)
+        c.put('http://example.com/4', {}, b'x' * 50)
+        c.remove('http://example.com/0')
+        self.assertEqual(50, c._size)
+
+
+if __name__ == '__main__':
+    unittest.main()
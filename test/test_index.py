@@ -0,0 +1,140 @@
+import unittest
+
+
+class IndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        import shutil
+        from os.path import dirname, join
+
+        self.dir = tempfile.mkdtemp()
+
+        for fn in ('metadata.csv', 'example1.csv', 'nested.csv'):
+            shutil.copy(join(dirname(__file__), 'data', fn), self.dir)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir)
+
+    def test_index(self):
+        import os
+        from os.path import join
+        from structured_tables.index import TermIndex
+
+        db = join(self.dir, 'index.db')
+        index = TermIndex(db)
+
+        self.assertEqual(dict(added=3, updated=0, unchanged=0, removed=0, failed=0), index.update([self.dir]))
+        self.assertEqual(3, len(index))
+
+        fn = join(self.dir, 'example1.csv')
+
+        r = index.find('datafile', grain='Tract')
+        self.assertEqual([{'file': fn, 'section': 'resources', 'term': 'datafile',
+                           'value': 'http://example.com/example2.csv', 'row': 14}], r)
+
+        self.assertEqual(2, len(index.find('datafile', section='Resources')))
+        self.assertEqual([], index.find('datafile', section='schema'))
+        self.assertEqual(1, len(index.find('datafile', grain='Tract', table='registered_voters')))
+        self.assertEqual([], index.find('datafile', grain='Tract', table='other'))
+
+        # Nested records are linked to their parents
+        self.assertEqual(27, len(index.find('table.column')))
+        self.assertEqual(1, len(index.find('column', 'percent', datatype='float')))
+        parents = index.query('SELECT p.value FROM terms t JOIN terms p ON p.id = t.parent_id '
+                              'WHERE t.record_term = ? AND t.value = ?', ('column', 'gvid'))
+        self.assertEqual(['registered_voters'], [r['value'] for r in parents])
+
+        index.close()
+
+        # Reopen, touch a file without changing it, and change another
+        index = TermIndex(db)
+        self.assertEqual(3, len(index))
+
+        st = os.stat(fn)
+        os.utime(fn, (st.st_atime, st.st_mtime + 10))
+
+        with open(join(self.dir, 'nested.csv'), 'a') as f:
+            f.write('Note,Added\n')
+
+        self.assertEqual(dict(added=0, updated=1, unchanged=2, removed=0, failed=0), index.update([self.dir]))
+        self.assertEqual(['Added'], [r['value'] for r in index.find('note', 'Added')])
+        self.assertEqual(dict(added=0, updated=0, unchanged=3, removed=0, failed=0), index.update([self.dir]))
+
+        os.remove(fn)
+
+        self.assertEqual(dict(added=0, updated=0, unchanged=2, removed=1, failed=0),
+                         index.update([self.dir], prune=True))
+        self.assertEqual([], index.find('datafile'))
+        self.assertEqual(0, index.query('SELECT COUNT(*) AS n FROM terms t JOIN files f ON f.id = t.file_id '
+                                        'WHERE f.path = ?', (fn,))[0]['n'])
+
+        files = index.files()
+        self.assertEqual(2, len(files))
+        self.assertTrue(all(f['hash'] and f['n_terms'] for f in files))
+
+    def test_dependencies(self):
+        import os
+        from os.path import join
+        from structured_tables.index import TermIndex
+
+        doc, fragment = join(self.dir, 'doc.csv'), join(self.dir, 'fragment.csv')
+
+        with open(doc, 'w') as f:
+            f.write('Declare,metadata.csv\nTitle,Doc\nInclude,fragment.csv\n')
+
+        def write_fragment(note):
+            with open(fragment, 'w') as f:
+                f.write('Note,{}\n'.format(note))
+
+        write_fragment('One')
+
+        index = TermIndex(':memory:')
+
+        self.assertEqual(dict(added=1, updated=0, unchanged=0, removed=0, failed=0), index.update([doc]))
+        self.assertEqual(['One'], [r['value'] for r in index.find('note')])
+        self.assertEqual(dict(added=0, updated=0, unchanged=1, removed=0, failed=0), index.update([doc]))
+
+        # Changing the included fragment updates the document that includes it, although it hasn't changed
+        write_fragment('Two')
+        st = os.stat(fragment)
+        os.utime(fragment, (st.st_atime, st.st_mtime + 10))
+
+        self.assertEqual(dict(added=0, updated=1, unchanged=0, removed=0, failed=0), index.update([doc]))
+        self.assertEqual(['Two'], [r['value'] for r in index.find('note')])
+        self.assertEqual(dict(added=0, updated=0, unchanged=1, removed=0, failed=0), index.update([doc]))
+
+        # As does changing the Declare document
+        with open(join(self.dir, 'metadata.csv'), 'a') as f:
+            f.write('\n')
+
+        self.assertEqual(dict(added=0, updated=1, unchanged=0, removed=0, failed=0), index.update([doc]))
+
+    def test_failed(self):
+        from os.path import join
+        from structured_tables.index import TermIndex
+        from structured_tables.parser import ParserError
+
+        class FailingIndex(TermIndex):
+            def _terms(self, path):
+                if path.endswith('nested.csv'):
+                    raise ParserError(u'Bad document: caf\xe9')
+
+                return super(FailingIndex, self)._terms(path)
+
+        index = FailingIndex(':memory:')
+
+        self.assertEqual(dict(added=2, updated=0, unchanged=0, removed=0, failed=1), index.update([self.dir]))
+
+        files = {f['path']: f for f in index.files()}
+
+        self.assertEqual(u'Bad document: caf\xe9', files[join(self.dir, 'nested.csv')]['error'])
+        self.assertEqual(0, files[join(self.dir, 'nested.csv')]['n_terms'])
+
+        with self.assertRaises(ParserError):
+            index.index_file(join(self.dir, 'nested.csv'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import unittest
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.t = 1000.0
+
+    def __call__(self):
+        return self.t
+
+
+class LimitsTestCase(unittest.TestCase):
+
+    def test_rate_limiter(self):
+        from structured_tables.limits import RateLimiter
+
+        clock = Clock()
+        rl = RateLimiter({'a': (2, 3), 'b': (100, 100)}, clock=clock)
+
+        self.assertEqual([0, 0, 0], [rl.acquire('x', 'a') for i in range(3)])
+        self.assertAlmostEqual(0.5, rl.acquire('x', 'a'))
+        self.assertEqual(0, rl.acquire('y', 'a'))  # Each client has its own bucket
+        self.assertEqual(0, rl.acquire('z', 'b'))
+
+        clock.t += 0.5
+        self.assertEqual(0, rl.acquire('x', 'a'))
+        self.assertAlmostEqual(0.5, rl.acquire('x', 'a'))
+
+        clock.t += 100
+        self.assertEqual([0, 0, 0], [rl.acquire('x', 'a') for i in range(3)])  # Refilled only to the burst size
+        self.assertNotEqual(0, rl.acquire('x', 'a'))
+
+        # The buckets of y and z were full, so they were removed
+        self.assertEqual(['x'], list(rl._buckets))
+
+        rl.max_buckets = 2
+
+        for key in ('y', 'z', 'w'):
+            rl.acquire(key, 'a')
+
+        self.assertEqual(['z', 'w'], list(rl._buckets))
+
+    def test_redis_rate_limiter(self):
+        from structured_tables.limits import RedisRateLimiter, RateLimiter
+
+        class FakeRedis(object):
+            """Runs the bucket script with the in-process limiter"""
+
+            def __init__(self, clock):
+                self.limiter = RateLimiter({'a': (2, 3)}, clock=clock)
+                self.calls = []
+
+            def eval(self, script, n_keys, key, rate, burst, now):
+                self.calls.append(key)
+                wait = self.limiter.acquire(key, 'a')
+                return [0 if wait else 1, str(1 - wait * rate)]
+
+        clock = Clock()
+        redis = FakeRedis(clock)
+        rl = RedisRateLimiter(redis, {'a': (2, 3)}, clock=clock)
+
+        self.assertEqual([0, 0, 0], [rl.acquire('x', 'a') for i in range(3)])
+        self.assertAlmostEqual(0.5, rl.acquire('x', 'a'))
+        self.assertEqual('structured_tables:limit:x', redis.calls[0])
+
+        redis.eval = None  # Failures allow the request
+        self.assertEqual(0, rl.acquire('x', 'a'))
+
+    def test_admission_control(self):
+        import threading
+        from structured_tables.limits import AdmissionControl
+
+        ac = AdmissionControl(max_in_flight=2, max_queued=1, timeout=5)
+
+        self.assertTrue(ac.acquire())
+        self.assertTrue(ac.acquire())
+
+        results = []
+        t = threading.Thread(target=lambda: results.append(ac.acquire()))
+        t.start()
+
+        while not ac.queued:
+            pass
+
+        self.assertFalse(ac.acquire())  # The queue is full
+        self.assertEqual(1, ac.rejected)
+
+        ac.release()
+        t.join()
+
+        self.assertEqual([True], results)
+        self.assertEqual(2, ac.in_flight)
+
+        ac.timeout = 0.05
+        ac.max_queued = 2
+        self.assertFalse(ac.acquire())  # Timed out waiting
+
+    def test_plugin(self):
+        import json
+        from io import BytesIO
+        from wsgiref.util import setup_testing_defaults
+        from bottle import Bottle
+        from structured_tables.app import RateLimitPlugin
+        from structured_tables.limits import RateLimiter, AdmissionControl
+
+        app = Bottle()
+        app.route('/', callback=lambda: 'ok')
+        app.install(RateLimitPlugin(RateLimiter({'unregistered': (0.1, 2), 'registered': (0.1, 3),
+                                                 'authoritative': (0.1, 100)}),
+                                    AdmissionControl(), {'registered_key': 'reg', 'authoritative_key': 'auth'}))
+
+        def get(**environ):
+            environ.update({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/', 'wsgi.input': BytesIO()})
+            setup_testing_defaults(environ)
+
+            status = []
+            body = b''.join(app(environ, lambda s, h, e=None: status.append((s, dict(h)))))
+
+            return status[0][0][:3], status[0][1], body
+
+        self.assertEqual(['200', '200', '429'], [get()[0] for i in range(3)])
+
+        status, headers, body = get()
+        self.assertEqual('10', headers['Retry-After'])
+        self.assertEqual('TooManyRequests', json.loads(body.decode('utf8'))['exception']['class'])
+
+        self.assertEqual(['200', '200', '200', '429'], [get(HTTP_X_ACCESS_KEY='reg')[0] for i in range(4)])
+        self.assertEqual('200', get(QUERY_STRING='access_key=auth')[0])
+        self.assertEqual('200', get(REMOTE_ADDR='10.0.0.1')[0])  # Another unregistered client
+
+        # Clients can't get a new bucket by sending X-Forwarded-For
+        self.assertEqual('429', get(HTTP_X_FORWARDED_FOR='10.9.9.9')[0])
+
+        # Behind a trusted proxy, the address it adds is the client's
+        app.plugins[-1].trusted_proxies = 1
+        self.assertEqual(['200', '200', '429'],
+                         [get(REMOTE_ADDR='10.0.0.2', HTTP_X_FORWARDED_FOR='1.1.1.1, 10.0.0.3')[0] for i in range(3)])
+        self.assertEqual('200', get(REMOTE_ADDR='10.0.0.2', HTTP_X_FORWARDED_FOR='10.0.0.4')[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
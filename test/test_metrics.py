@@ -0,0 +1,193 @@
+import unittest
+
+
+def sample(text, line_start):
+    """Return the value of the first sample line of exposed metrics that starts with line_start"""
+
+    for line in text.splitlines():
+        if line.startswith(line_start + ' '):
+            return float(line.rsplit(' ', 1)[1])
+
+    return None
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def test_metrics(self):
+        import threading
+        from structured_tables.metrics import Counter, Gauge, Histogram, CallbackMetric, Registry
+
+        r = Registry()
+        c = r.register(Counter('test_total', 'A counter', ('kind',)))
+        g = r.register(Gauge('test_gauge', 'A gauge'))
+        h = r.register(Histogram('test_seconds', 'A histogram', buckets=(1, 5)))
+        r.register(CallbackMetric('test_callback', 'A callback', lambda: 42))
+
+        def work():
+            for i in range(100):
+                c.inc(labels=('a',))
+            c.inc(2, labels=('b"',))
+            g.inc()
+            h.observe(3)
+
+        threads = [threading.Thread(target=work) for i in range(4)]
+
+        for t in threads:
+            t.start()
+
+        for t in threads:
+            t.join()
+
+        g.dec()
+        h.observe(.5)
+        h.observe(10)
+
+        self.assertEqual({('a',): 400, ('b"',): 8}, c.values())
+
+        text = r.expose()
+
+        self.assertIn('# TYPE test_total counter', text)
+        self.assertEqual(400, sample(text, 'test_total{kind="a"}'))
+        self.assertEqual(8, sample(text, r'test_total{kind="b\""}'))
+        self.assertEqual(3, sample(text, 'test_gauge'))
+        self.assertEqual(1, sample(text, 'test_seconds_bucket{le="1"}'))
+        self.assertEqual(5, sample(text, 'test_seconds_bucket{le="5"}'))
+        self.assertEqual(6, sample(text, 'test_seconds_bucket{le="+Inf"}'))
+        self.assertEqual(22.5, sample(text, 'test_seconds_sum'))
+        self.assertEqual(6, sample(text, 'test_seconds_count'))
+        self.assertEqual(42, sample(text, 'test_callback'))
+
+        # The shards of the exited threads are merged
+        self.assertEqual(0, len(c._shards))
+
+    def test_shared(self):
+        import json
+        import os
+        import shutil
+        import tempfile
+        import time
+        from structured_tables.metrics import Counter, Gauge, Histogram, Registry
+
+        d = tempfile.mkdtemp()
+
+        try:
+            with open(os.path.join(d, '1234.json'), 'w') as f:  # Left by an earlier server
+                json.dump({'test_total': [[['a'], 1000]]}, f)
+
+            r = Registry(d)
+            c = r.register(Counter('test_total', 'A counter', ('kind',)))
+            g = r.register(Gauge('test_gauge', 'A gauge'))
+            h = r.register(Histogram('test_seconds', 'A histogram', buckets=(1, 5)))
+
+            self.assertEqual([], os.listdir(d))
+
+            c.inc(labels=('a',))
+            g.inc(2)
+            h.observe(3)
+
+            # Another worker, which is still running, and one that has exited
+            with open(os.path.join(d, '{}.json'.format(os.getppid())), 'w') as f:
+                json.dump({'test_total': [[['a'], 10], [['b'], 1]], 'test_gauge': [[[], 3]],
+                           'test_seconds': [[[], [1, 0, 0, .5, 1]]]}, f)
+
+            with open(os.path.join(d, '{}.json'.format(2 ** 22 + 1)), 'w') as f:
+                json.dump({'test_total': [[['a'], 100]], 'test_gauge': [[[], 50]], 'unknown': [[[], 1]]}, f)
+
+            text = r.expose()
+
+            self.assertIn('{}.json'.format(os.getpid()), os.listdir(d))
+            self.assertEqual(111, sample(text, 'test_total{kind="a"}'))
+            self.assertEqual(1, sample(text, 'test_total{kind="b"}'))
+            self.assertEqual(5, sample(text, 'test_gauge'))  # Not the gauge of the exited worker
+            self.assertEqual(1, sample(text, 'test_seconds_bucket{le="1"}'))
+            self.assertEqual(2, sample(text, 'test_seconds_count'))
+            self.assertEqual(3.5, sample(text, 'test_seconds_sum'))
+            self.assertNotIn('unknown', text)
+
+            # Without a shared directory, only this process
+            self.assertEqual({('a',): 1}, c.values())
+
+            # After a request, the values are written once the interval has passed
+            os.remove(os.path.join(d, '{}.json'.format(os.getpid())))
+            r.interval = .05
+
+            r.changed()
+            r.changed()
+            self.assertNotIn('{}.json'.format(os.getpid()), os.listdir(d))
+
+            time.sleep(.5)
+            self.assertIn('{}.json'.format(os.getpid()), os.listdir(d))
+            self.assertIsNone(r._pending)
+        finally:
+            shutil.rmtree(d)
+
+    def test_flask(self):
+        import json
+        from structured_tables.server import app
+        from structured_tables.metrics import registry
+
+        def metric(name):
+            return sample(registry.expose(), name) or 0
+
+        requests = metric('structured_tables_responses_total{endpoint="/v1/parse",code="200"}')
+        unsupported = metric('structured_tables_responses_total{endpoint="/v1/parse",code="415"}')
+        client_errors = metric('structured_tables_errors_total{class="ClientError"}')
+        terms = metric('structured_tables_terms_parsed_sum')
+
+        client = app.test_client()
+
+        response = client.post('/v1/parse', data=json.dumps([['Title', 'Metrics'], ['Note', 'a', 'b']]),
+                               content_type='application/json')
+        self.assertEqual(200, response.status_code)
+        response.close()  # The request is recorded when the server closes the response
+
+        response = client.post('/v1/parse', data='Title,Foo', content_type='text/plain')
+        self.assertEqual(415, response.status_code)
+        response.close()
+
+        response = client.get('/metrics')
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.headers['Content-Type'].startswith('text/plain'))
+
+        text = response.data.decode('utf8')
+
+        self.assertEqual(requests + 1,
+                         sample(text, 'structured_tables_responses_total{endpoint="/v1/parse",code="200"}'))
+        self.assertEqual(unsupported + 1,
+                         sample(text, 'structured_tables_responses_total{endpoint="/v1/parse",code="415"}'))
+        self.assertEqual(client_errors + 1, sample(text, 'structured_tables_errors_total{class="ClientError"}'))
+        self.assertEqual(terms + 3, sample(text, 'structured_tables_terms_parsed_sum'))
+        self.assertEqual(0, sample(text, 'structured_tables_requests_in_flight'))
+        self.assertIn('structured_tables_request_seconds_bucket{endpoint="/v1/parse",le="+Inf"}', text)
+        self.assertIn('structured_tables_stage_seconds_count{stage="parse"}', text)
+        self.assertIn('structured_tables_cache_hits_total{cache="declare"}', text)
+
+    def test_bottle(self):
+        from io import BytesIO
+        from wsgiref.util import setup_testing_defaults
+        from structured_tables.app import application
+
+        def call(method, path, data=b''):
+            environ = {'REQUEST_METHOD': method, 'PATH_INFO': path, 'CONTENT_TYPE': 'text/csv',
+                       'CONTENT_LENGTH': str(len(data)), 'wsgi.input': BytesIO(data)}
+            setup_testing_defaults(environ)
+
+            status = []
+            body = application(environ, lambda s, h, e=None: status.append(s))
+            data = b''.join(body)
+
+            if hasattr(body, 'close'):
+                body.close()
+
+            return status[0], data.decode('utf8')
+
+        self.assertEqual('200 OK', call('POST', '/v1/parse', b'Title,Bottle')[0])
+
+        status, text = call('GET', '/metrics')
+
+        self.assertEqual('200 OK', status)
+        self.assertGreaterEqual(sample(text, 'structured_tables_request_bytes_sum{endpoint="/v1/parse"}'), 12)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+
+
+class SerializeTestCase(unittest.TestCase):
+
+    def result(self):
+        from os.path import join, dirname
+        from structured_tables import CsvPathRowGenerator, TermGenerator, TermInterpreter
+
+        ti = TermInterpreter(TermGenerator(CsvPathRowGenerator(join(dirname(__file__), 'data', 'example1.csv'))))
+
+        return ti.as_dict()
+
+    def test_encoders(self):
+        import json
+        from structured_tables.serialize import make_encoder, available_encoders
+
+        d = self.result()
+        d['odd keys'] = {1: 'one', None: 'none', True: 'yes', 'q"uote': u'caf\xe9 / bar'}
+        d['empty'] = [{}, [], '']
+
+        expected = json.loads(json.dumps(d))
+
+        self.assertIn('json', available_encoders())
+
+        for name in available_encoders():
+            e = make_encoder(name)
+
+            compact = e.dumps(d)
+
+            self.assertEqual(expected, json.loads(compact), name)
+            self.assertNotIn(', "', compact)
+            self.assertEqual(expected, json.loads(''.join(e.iterencode(d))), name)
+            self.assertEqual(expected, json.loads(''.join(e.iterencode(d, depth=5))), name)
+            self.assertEqual(expected, json.loads(e.dumps(d, indent=4)), name)
+            self.assertIn('\n', e.dumps(d, indent=4))
+
+            # Each top level item is a separate chunk
+            self.assertGreater(len(list(e.iterencode(d))), len(d))
+
+    def test_choose_encoder(self):
+        from structured_tables import serialize
+
+        try:
+            self.assertEqual('json', serialize.set_encoder('json').name)
+            self.assertEqual('json', serialize.get_encoder().name)
+            self.assertEqual('{"a":[1,2]}', serialize.dumps({'a': [1, 2]}))
+
+            with self.assertRaises(ValueError):
+                serialize.make_encoder('yaml')
+
+            for cls in serialize.ENCODERS:
+                if cls.name not in serialize.available_encoders():
+                    with self.assertRaises(ImportError):
+                        serialize.make_encoder(cls.name)
+        finally:
+            serialize.set_encoder()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -58,6 +58,335 @@ class BasicTest(unittest.TestCase):
 
             self.assertListEqual([], json.loads(response.data)['errors'])
 
+    def test_bad_json(self):
+        import json
+
+        for data in ('{bad', '{"a": 1}'):
+            response = self.app.post('/v1/parse', data=data, content_type='application/json')
+
+            self.assertEqual(400, response.status_code)
+            self.assertIsNone(json.loads(response.data)['result'])
+
+    def test_parse_stream(self):
+        import json
+        from os.path import join, dirname
+
+        fn = join(dirname(__file__), 'data', 'example1.csv')
+
+        with open(fn) as f:
+            data = f.read()
+
+        expected = json.loads(self.app.post('/v1/parse', data=data, content_type='text/csv').data)
+
+        response = self.app.post('/v1/parse?stream=1', data=data, content_type='text/csv')
+
+        def strip_files(errors):
+            return [dict(e, file=None) for e in errors]
+
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(expected['result'], json.loads(response.data)['result'])
+        self.assertEqual(strip_files(expected['errors']), strip_files(json.loads(response.data)['errors']))
+
+        response = self.app.post('/v1/parse', data=data, content_type='text/csv',
+                                 headers={'Accept': 'application/x-ndjson'})
+
+        self.assertEqual('application/x-ndjson', response.mimetype)
+
+        lines = [json.loads(l) for l in response.data.splitlines()]
+
+        self.assertEqual(strip_files(expected['errors']), strip_files(lines[-1]['errors']))
+        self.assertEqual({'term': '<no_term>.title', 'value': 'Registered Voters, By County', 'args': ['', '', ''],
+                          'section': 'root', 'file': '<stream>', 'row': 2, 'col': 1}, lines[0])
+        self.assertEqual(len(expected['result']['column']),
+                         len([l for l in lines[:-1] if l['term'] == '<no_term>.column']))
+
+    def test_max_request_size(self):
+        import json
+
+        data = 'Title,' + 'x' * 4000
+
+        app.config['MAX_CONTENT_LENGTH'] = 100
+
+        try:
+            self.assertEqual(413, self.app.post('/v1/parse', data=data, content_type='text/csv').status_code)
+            self.assertEqual(413, self.app.post('/v1/parse?stream=1', data=data, content_type='text/csv').status_code)
+            self.assertEqual(413, self.app.post('/v1/parse', data=data, content_type='text/csv',
+                                                headers={'Accept': 'application/x-ndjson'}).status_code)
+            self.assertEqual(413, self.app.post('/v1/parse/batch', data=json.dumps([{'id': 'a', 'csv': data}]),
+                                                content_type='application/json').status_code)
+
+            # A chunked body has no length to check
+            response = self.app.post('/v1/parse?stream=1', data='Title,a', content_type='text/csv',
+                                     headers={'Transfer-Encoding': 'chunked'})
+            self.assertEqual(411, response.status_code)
+
+            self.assertEqual(200, self.app.post('/v1/parse?stream=1', data='Title,a',
+                                                content_type='text/csv').status_code)
+        finally:
+            app.config['MAX_CONTENT_LENGTH'] = None
+
+    def test_parse_batch(self):
+        import csv
+        from os.path import join, dirname
+
+        # The document declares metadata.csv, which is next to it in the base directory
+        with open(join(dirname(__file__), 'data', 'example1.csv')) as f:
+            data = f.read()
+
+        rows = list(csv.reader(data.splitlines()))
+
+        app.config['BASE_DIR'] = join(dirname(__file__), 'data')
+
+        try:
+            self._parse_batch(data, rows)
+        finally:
+            app.config.pop('BASE_DIR')
+
+    def _parse_batch(self, data, rows):
+        import json
+        from io import BytesIO
+        from structured_tables.cache import declare_cache
+
+        expected = json.loads(self.app.post('/v1/parse', data=data, content_type='text/csv').data)
+
+        declare_cache.clear()
+
+        response = self.app.post('/v1/parse/batch', content_type='application/json',
+                                 data=json.dumps([{'id': 'a', 'csv': data}, {'id': 'b', 'rows': rows},
+                                                  {'csv': 'Declare,nonexistent.csv\nTitle,Foo'}]))
+
+        results = json.loads(response.data)['results']
+
+        self.assertEqual(['2', 'a', 'b'], sorted(results.keys()))
+        self.assertEqual(expected['result'], results['a']['result'])
+        self.assertEqual(expected['result'], results['b']['result'])
+        self.assertEqual([], results['a']['errors'])
+        self.assertEqual({'title': 'Foo'}, results['2']['result'])
+        self.assertEqual(1, len(results['2']['errors']))
+
+        self.assertEqual(2, declare_cache.misses)  # metadata.csv once per batch, and nonexistent.csv
+        self.assertEqual(0, declare_cache.hits)
+
+        response = self.app.post('/v1/parse/batch', content_type='multipart/form-data',
+                                 data={'a': (BytesIO(data.encode('utf8')), 'a.csv'),
+                                       'b': (BytesIO(b'Title,Bar'), 'b.csv')})
+
+        results = json.loads(response.data)['results']
+
+        self.assertEqual(expected['result'], results['a']['result'])
+        self.assertEqual({'title': 'Bar'}, results['b']['result'])
+
+        # An unexpected error in one document is reported in its errors
+        response = self.app.post('/v1/parse/batch', content_type='application/json',
+                                 data=json.dumps([{'id': 'a', 'rows': [[1, 2]]}, {'id': 'b', 'csv': 'Title,Baz'}]))
+
+        self.assertEqual(200, response.status_code)
+
+        results = json.loads(response.data)['results']
+
+        self.assertIsNone(results['a']['result'])
+        self.assertTrue(results['a']['errors'][0]['error'].startswith('AttributeError'))
+        self.assertEqual({'title': 'Baz'}, results['b']['result'])
+
+        response = self.app.post('/v1/parse/batch', content_type='application/json',
+                                 data=json.dumps([{'id': 'a', 'csv': data}, {'id': 'a', 'csv': data}]))
+
+        self.assertEqual(400, response.status_code)
+
+    def test_result_cache(self):
+        import json
+        import os
+        import shutil
+        import tempfile
+        from os.path import join, dirname
+        from structured_tables.server import get_result_cache
+
+        d = tempfile.mkdtemp()
+
+        try:
+            decl_fn = join(d, 'metadata.csv')
+            shutil.copy(join(dirname(__file__), 'data', 'metadata.csv'), decl_fn)
+
+            data = 'Declare,metadata.csv\nTitle,Foo\nTable,bar\nColumn,baz\n'
+
+            app.config['BASE_DIR'] = d
+
+            cache = get_result_cache()
+            cache.clear()
+
+            r1 = self.app.post('/v1/parse', data=data, content_type='text/csv')
+            r2 = self.app.post('/v1/parse', data=data, content_type='text/csv')
+
+            self.assertEqual(1, cache.hits)
+            self.assertTrue(r1.headers['ETag'])
+            self.assertEqual(r1.headers['ETag'], r2.headers['ETag'])
+            self.assertEqual(json.loads(r1.data), json.loads(r2.data))
+            self.assertEqual({'title': 'Foo', 'table': {'name': 'bar', 'column': ['baz']}},
+                             json.loads(r2.data)['result'])
+
+            r3 = self.app.post('/v1/parse', data=data, content_type='text/csv',
+                               headers={'If-None-Match': r1.headers['ETag']})
+
+            self.assertEqual(304, r3.status_code)
+            self.assertEqual(b'', r3.data)
+
+            # A different content type is a different document
+            self.app.post('/v1/parse', data=json.dumps([['Title', 'Foo']]), content_type='application/json')
+            self.assertEqual(2, cache.hits)
+            self.assertEqual(2, cache.misses)
+
+            # Changing the Declare document invalidates the result
+            with open(decl_fn, 'a') as f:
+                f.write('\n')
+
+            os.utime(decl_fn, (0, 0))
+
+            r4 = self.app.post('/v1/parse', data=data, content_type='text/csv')
+
+            self.assertEqual(3, cache.misses)
+            self.assertNotEqual(r1.headers['ETag'], r4.headers['ETag'])
+
+            # So does changing an Include document
+            with open(join(d, 'notes.csv'), 'w') as f:
+                f.write('Note,First\n')
+
+            data = 'Include,notes.csv\nTitle,Foo\n'
+
+            self.assertEqual('First', json.loads(self.app.post('/v1/parse', data=data, content_type='text/csv').data)
+                             ['result']['note'])
+
+            with open(join(d, 'notes.csv'), 'w') as f:
+                f.write('Note,Second\n')
+
+            os.utime(join(d, 'notes.csv'), (0, 0))
+
+            self.assertEqual('Second', json.loads(self.app.post('/v1/parse', data=data, content_type='text/csv').data)
+                             ['result']['note'])
+        finally:
+            app.config.pop('BASE_DIR')
+            shutil.rmtree(d)
+
+    def test_local_refs(self):
+        import json
+        from os.path import join, dirname, realpath
+        from structured_tables.server import get_result_cache
+
+        def errors(data):
+            response = self.app.post('/v1/parse', data=data, content_type='text/csv')
+            self.assertEqual(200, response.status_code)
+            return [e['error'] for e in json.loads(response.data)['errors']]
+
+        get_result_cache().clear()
+
+        # Without a base directory, documents can't reference local files
+        for ref in ('metadata.csv', '/etc/passwd', '../../etc/passwd'):
+            for term in ('Include', 'Declare'):
+                e = errors('{},{}\nTitle,Foo\n'.format(term, ref))
+                self.assertEqual(1, len(e))
+                self.assertIn("local documents can't be referenced", e[0])
+
+        app.config['BASE_DIR'] = join(dirname(__file__), 'data')
+
+        try:
+            self.assertEqual([], errors('Declare,metadata.csv\nInclude,include3.csv\n'))
+
+            for ref in ('../../etc/passwd', '../test_server.py'):
+                for term in ('Include', 'Declare'):
+                    e = errors('{},{}\nTitle,Foo\n'.format(term, ref))
+                    self.assertEqual(1, len(e))
+                    self.assertIn('outside of the base directory', e[0])
+
+            # Absolute paths are relative to the base directory too
+            for term in ('Include', 'Declare'):
+                e = errors('{},/etc/passwd\nTitle,Foo\n'.format(term))
+                self.assertEqual(1, len(e))
+                self.assertIn('Failed to find file', e[0])
+                self.assertIn(join(realpath(join(dirname(__file__), 'data')), 'etc', 'passwd'), e[0])
+        finally:
+            app.config.pop('BASE_DIR')
+            get_result_cache().clear()
+
+    def test_serve_preload(self):
+        import json
+        import shutil
+        import tempfile
+        from os.path import join, dirname
+        from structured_tables.bundle import compile_bundle, write_bundle
+        from structured_tables.cli.serve import make_parser, preload, gunicorn_options, share_metrics
+        from structured_tables.metrics import registry
+        from structured_tables.server import get_result_cache
+
+        d = tempfile.mkdtemp()
+
+        try:
+            write_bundle(compile_bundle([join(dirname(__file__), 'data', 'metadata.csv')]), join(d, 'bundle.json'))
+
+            args = make_parser().parse_args(['-p', '8080', '-w', '3', '-m', '1000', '-b', join(d, 'bundle.json')])
+
+            self.assertIs(app, preload(args))
+            self.assertEqual({'bind': '127.0.0.1:8080', 'workers': 3, 'threads': 4, 'worker_class': 'gthread',
+                              'keepalive': 5, 'timeout': 60, 'graceful_timeout': 60, 'preload_app': True},
+                             gunicorn_options(args))
+
+            # The workers share their metrics
+            self.assertIsNone(share_metrics(make_parser().parse_args(['-w', '1'])))
+            self.assertEqual(join(d, 'metrics'), share_metrics(make_parser().parse_args(['-M', join(d, 'metrics')])))
+            self.assertTrue(share_metrics(args))
+
+            get_result_cache().clear()
+
+            # Column is a child of Table because of the bundle, although the document has no Declare term
+            response = self.app.post('/v1/parse', data='Table,bar\nColumn,baz\n', content_type='text/csv')
+            self.assertEqual({'table': {'name': 'bar', 'column': ['baz']}}, json.loads(response.data)['result'])
+
+            response = self.app.post('/v1/parse', data='Title,' + 'x' * 1000, content_type='text/csv')
+            self.assertEqual(413, response.status_code)
+        finally:
+            app.config.pop('DECLARE_BUNDLE', None)
+            app.config['MAX_CONTENT_LENGTH'] = None
+            registry.shared_dir = None
+            get_result_cache().clear()
+            shutil.rmtree(d)
+
+    def test_bottle_parse(self):
+        import json
+        from io import BytesIO
+        from wsgiref.util import setup_testing_defaults
+        from bottle import default_app
+        import structured_tables.app
+
+        def post(data, **headers):
+            environ = {'REQUEST_METHOD': 'POST', 'PATH_INFO': '/v1/parse', 'CONTENT_TYPE': 'text/csv',
+                       'CONTENT_LENGTH': str(len(data)), 'wsgi.input': BytesIO(data)}
+            environ.update(headers)
+            setup_testing_defaults(environ)
+
+            status = []
+            body = b''.join(default_app()(environ, lambda s, h, e=None: status.append((s, dict((k.lower(), v) for k, v in h)))))
+
+            return status[0][0], status[0][1], body
+
+        status, headers, body = post(b'Title,Foo')
+
+        self.assertEqual('200 OK', status)
+        self.assertEqual({'title': 'Foo'}, json.loads(body.decode('utf8'))['result'])
+
+        etag = headers['etag']
+
+        for value in (etag, '"other", ' + etag, '*'):
+            status, h, body = post(b'Title,Foo', HTTP_IF_NONE_MATCH=value)
+            self.assertTrue(status.startswith('304'), value)
+
+        for value in ('"x{}x"'.format(etag.strip('"')), 'W/' + etag, '"other"'):
+            status, h, body = post(b'Title,Foo', HTTP_IF_NONE_MATCH=value)
+            self.assertEqual('200 OK', status, value)
+
+        status, headers, body = post(b'Title,Foo', CONTENT_TYPE='text/plain')
+        self.assertTrue(status.startswith('415'))
+
+        status, headers, body = post(b'{bad', CONTENT_TYPE='application/json')
+        self.assertTrue(status.startswith('400'))
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,103 @@
+import unittest
+
+from structured_tables.benchmark import BENCHMARK
+
+
+class StatsTestCase(unittest.TestCase):
+
+    def rows(self):
+        return [
+            ['Title', 'A Title'],
+            [],
+            ['# A comment'],
+            ['Description', 'Desc', 'arg1', '', 'arg3'],
+            ['', 'no term'],
+            ['Section', 'Schema', 'DataType'],
+            ['Table', 'a_table'],
+            ['Table.Column', 'a_column', 'integer'],
+        ]
+
+    def test_counters(self):
+        from structured_tables.parser import RowGenerator, TermGenerator, TermInterpreter
+        from structured_tables.stats import ParserStats
+
+        stats = ParserStats()
+
+        ti = TermInterpreter(TermGenerator(RowGenerator(self.rows())), stats=stats)
+
+        self.assertIs(stats, ti.stats)
+
+        d = ti.as_dict()
+
+        self.assertEqual(d, TermInterpreter(TermGenerator(RowGenerator(self.rows()))).as_dict())
+
+        c = stats.counters
+        self.assertEqual(8, c['rows_read'])
+        self.assertEqual(2, c['blank_rows_skipped'])
+        self.assertEqual(1, c['comments_skipped'])
+        self.assertEqual(3, c['arg_children_created'])
+        self.assertEqual(8, c['terms_emitted'])
+        self.assertEqual(1, c['handlers_invoked'])
+        self.assertEqual({'handle_section': 1}, dict(stats.handlers))
+
+        self.assertEqual(['RowGenerator', 'TermGenerator', 'TermInterpreter', 'TermInterpreter.handle_section',
+                          'build_dict'], sorted(stats.stages))
+        self.assertEqual(8, stats.items['TermGenerator'])
+        self.assertEqual(7, stats.items['TermInterpreter'])  # Less the Section term
+
+        for s in stats.stages:
+            self.assertGreaterEqual(stats.wall[s], 0)
+
+        self.assertIn('terms_emitted', stats.format())
+        self.assertEqual(8, stats.as_dict()['stages']['TermGenerator']['items'])
+
+    def time_nested(self):
+        """Time a stage that sleeps for .02s around a nested stage that sleeps for .03s, and return the stats"""
+        import time
+        from structured_tables.stats import ParserStats
+
+        stats = ParserStats()
+
+        def slow(n):
+            for i in range(n):
+                time.sleep(.01)
+                yield i
+
+        with stats.timing('outer'):
+            time.sleep(.02)
+            list(stats.iterate(slow(3), 'inner'))
+
+        return stats
+
+    def test_exclusive_times(self):
+        stats = self.time_nested()
+
+        self.assertEqual(3, stats.items['inner'])
+        self.assertGreaterEqual(stats.wall['inner'], .03)
+        self.assertGreaterEqual(stats.wall['outer'], .02)
+
+    @unittest.skipUnless(BENCHMARK, 'Set STRUCT_TAB_BENCH to run timing comparisons')
+    def test_exclusive_times_bound(self):
+        """The time of the nested stage isn't charged to the outer one. The upper bound depends on the
+        machine being idle"""
+
+        self.assertLess(self.time_nested().wall['outer'], .03)
+
+    def test_link_terms(self):
+        from structured_tables.parser import RowGenerator, TermGenerator, TermInterpreter
+        from structured_tables.parser import link_terms, convert_to_dict
+        from structured_tables.stats import ParserStats
+
+        stats = ParserStats()
+
+        ti = TermInterpreter(TermGenerator(RowGenerator(self.rows())), stats=stats)
+
+        d = convert_to_dict(link_terms(ti, stats), stats)
+
+        self.assertEqual(d, TermInterpreter(TermGenerator(RowGenerator(self.rows()))).as_dict())
+        self.assertIn('link_terms', stats.stages)
+        self.assertIn('convert_to_dict', stats.stages)
+
+
+if __name__ == '__main__':
+    unittest.main()